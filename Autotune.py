@@ -0,0 +1,185 @@
+from __future__ import annotations
+from typing import List
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from Calc import Calc
+
+import json
+import math
+import os
+import platform
+import time
+from queue import Queue
+
+import numpy as np
+
+CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'electrostatic_simulation', 'autotune.json')
+
+
+class Autotuner:
+    """
+    Chooses the work partitioning of the cpu backend (worker count, chunk size and schedule)
+
+    Candidate plans are timed on full width sample rows spread over the grid (trial_fraction of the grid,
+    at least one block of block_pixels per worker of the largest candidate, so that the blocks and chunks
+    of the workers are partitioned as in the real run, at most max_trial_pixels since every candidate
+    is timed), the best plan and the pixel/s of every candidate are cached on disk per machine, grid shape,
+    charge count bucket, approximation settings and worker cap (max_worker, e.g. the cpu_limit of a job).
+    Grids of a single block skip the trials and use the heuristic plan.
+    """
+
+    def __init__(self, cache_path: str = CACHE_PATH, block_pixels: int = 1 << 16, trial_fraction: float = 1 / 16,
+                 max_trial_pixels: int = 1 << 21, max_worker: int | None = None):
+        self.cache_path = cache_path
+        self.block_pixels = block_pixels  # pixels evaluated at once by a cpu worker (Calc.CPU_BLOCK_PIXELS)
+        self.trial_fraction = trial_fraction
+        self.max_trial_pixels = max_trial_pixels
+        self.max_worker = max_worker  # no candidate (nor trial) uses more workers, None : no cap
+
+    @staticmethod
+    def get_machine_key() -> str:
+        return '{}-{}-{}'.format(platform.node(), platform.machine(), os.cpu_count())
+
+    @staticmethod
+    def get_bucket(value: float | None) -> str:
+        # Power of 2 below value, '-' for a disabled setting
+        if value is None:
+            return '-'
+        return '{:g}'.format(2.0 ** math.floor(math.log2(value))) if value > 0 else '0'
+
+    @staticmethod
+    def get_shape_key(calc: Calc, max_worker: int | None = None) -> str:
+        # Bucket by power of 2 so that nearby shapes, charge counts and approximation settings share one tuning
+        # (culling, the far field expansion and the tables change the cost of a chunk by large factors)
+        n_row, n_col = calc.grid_shape
+        return '{}x{}-{}-{}-cull{}-far{}-table{}-worker{}'.format(
+            Autotuner.get_bucket(n_row), Autotuner.get_bucket(n_col), Autotuner.get_bucket(len(calc.charges)),
+            calc.precision, Autotuner.get_bucket(calc.cull_tol), Autotuner.get_bucket(calc.far_field_ratio),
+            'on' if calc.table_interp is not None else '-', max_worker if max_worker is not None else '-')
+
+    @staticmethod
+    def get_default_plan(n_row: int, max_worker: int | None = None) -> dict:
+        n_worker = max(1, min(os.cpu_count() or 1, n_row, max_worker or n_row))
+        return {
+            'n_worker': n_worker,
+            'schedule': 'dynamic',
+            'chunk_rows': max(1, n_row // (n_worker * 8))
+        }
+
+    @staticmethod
+    def get_candidates(n_row: int, max_worker: int | None = None) -> List[dict]:
+        n_core = os.cpu_count() or 1
+        n_workers = sorted({max(1, min(n, n_row, max_worker or n_row)) for n in (1, n_core // 2, n_core, n_core * 2)})
+
+        candidates = []
+        for n_worker in n_workers:
+            candidates.append({'n_worker': n_worker, 'schedule': 'static', 'chunk_rows': 0})
+            for chunk_per_worker in (4, 16):
+                chunk_rows = max(1, n_row // (n_worker * chunk_per_worker))
+                candidate = {'n_worker': n_worker, 'schedule': 'dynamic', 'chunk_rows': chunk_rows}
+                if candidate not in candidates:
+                    candidates.append(candidate)
+
+        return candidates
+
+    def get_plan(self, calc: Calc, verbose: bool = True) -> dict:
+        """
+        Cached plan for the machine and grid shape of calc, tuned on the first request
+
+        :param calc: Calc to be run on cpu
+        :param verbose: print pixel/s of each candidate while tuning
+        :return: plan (see Calc.get_cpu_plan)
+        """
+
+        n_row, n_col = calc.grid_shape
+        if n_row * n_col <= self.block_pixels:
+            return self.get_default_plan(n_row, self.max_worker)
+
+        machine_key = Autotuner.get_machine_key()
+        shape_key = Autotuner.get_shape_key(calc, self.max_worker)
+
+        cache = self.load()
+        entry = cache.get(machine_key, {}).get(shape_key)
+        if entry is not None:
+            return entry['plan']
+
+        reports = self.tune(calc, verbose=verbose)
+        best = max(reports, key=lambda report: report['pixel_per_sec'])
+        entry = {'plan': best['plan'], 'reports': reports}
+
+        cache = self.load()
+        cache.setdefault(machine_key, {})[shape_key] = entry
+        self.save(cache)
+
+        return entry['plan']
+
+    def get_trial_shape(self, calc: Calc) -> tuple:
+        """
+        Shape of the trial grid : full width, rows for trial_fraction of the grid but at least
+        one block per worker of the largest candidate, max_trial_pixels (and the whole grid) at most
+        """
+
+        n_row, n_col = calc.grid_shape
+        max_worker = max(candidate['n_worker'] for candidate in Autotuner.get_candidates(n_row, self.max_worker))
+        trial_pixels = min(max(self.trial_fraction * n_row * n_col, max_worker * self.block_pixels),
+                           self.max_trial_pixels)
+
+        return min(n_row, max(2, math.ceil(trial_pixels / n_col))), n_col
+
+    def tune(self, calc: Calc, verbose: bool = True) -> List[dict]:
+        """
+        Time every candidate plan on the trial grid (see get_trial_shape)
+        The trial keeps the row count of the grid small while covering its full physical height,
+        so charge heavy rows are represented
+
+        :return: [{'plan': plan, 'pixel_per_sec': float}, ...]
+        """
+
+        n_row = calc.grid_shape[0]
+        n_trial_row, n_trial_col = self.get_trial_shape(calc)
+
+        # Rows are scaled down to the trial grid so the number of chunks per worker stays the same
+        trial_data = np.zeros((n_trial_row, n_trial_col), dtype=calc.data.dtype)
+        reports = []
+        for candidate in Autotuner.get_candidates(n_row, self.max_worker):
+            plan = dict(candidate)
+            plan['n_worker'] = min(plan['n_worker'], n_trial_row)
+            if plan['schedule'] == 'dynamic':
+                plan['chunk_rows'] = max(1, plan['chunk_rows'] * n_trial_row // n_row)
+
+            trial = type(calc)(charges=calc.charges,
+                               phy_rect=tuple(calc.phy_rect.tolist()),
+                               data=trial_data,
+                               device='cpu',
+                               precision=calc.precision,
+                               cpu_plan=plan,
+                               cull_tol=calc.cull_tol,
+                               far_field_ratio=calc.far_field_ratio,
+                               table_interp=calc.table_interp)
+            trial.tables = calc.tables  # tables are built once, not per candidate
+
+            st_tm = time.time()
+            trial.do_on_cpu(Queue(), verbose=False)
+            el_tm = time.time() - st_tm
+
+            report = {'plan': candidate, 'pixel_per_sec': n_trial_row * n_trial_col / el_tm}
+            reports.append(report)
+            if verbose is True:
+                print('autotune {} : {:.1f} pixel/s'.format(candidate, report['pixel_per_sec']))
+
+        return reports
+
+    def load(self) -> dict:
+        try:
+            with open(self.cache_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self, cache: dict) -> None:
+        os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        tmp_path = self.cache_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(cache, f, indent=2)
+        os.replace(tmp_path, self.cache_path)
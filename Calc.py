@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import math
 import time
 from typing import Tuple, List
 from typing import TYPE_CHECKING
@@ -11,9 +12,29 @@ if TYPE_CHECKING:
 import threading
 
 import numpy as np
-from numba import cuda
+from numba import cuda, float64, int32, int64
 
 import Charge
+from DevicePool import DevicePool
+from Autotune import Autotuner
+from PotentialHistogram import PotentialHistogram, HIST_SIZE, gpu_get_hist_idx
+from PotentialTable import PotentialTableCache
+from SampleGrid import SampleGrid
+
+# precision : (storage dtype, accumulation dtype)
+PRECISIONS = {
+    'float32': (np.float32, np.float32),
+    'float64': (np.float64, np.float64),
+    'mixed': (np.float32, np.float64)
+}
+
+CULL_TILE_COLS = 64  # columns of a culling tile on cpu (rows : a row chunk)
+CPU_BLOCK_PIXELS = 1 << 16  # pixels evaluated at once by a cpu worker (bounds the temporaries)
+GPU_BLOCK_THREADS = 256  # threads of a gpu block (16 x 16), size of the shared buffers of the range reduction
+GPU_HIST_SIZE = HIST_SIZE  # flat counts of PotentialHistogram
+GPU_SCENE_GROUP = 8  # batched scenes accumulated per pass over the charges in the gpu kernel (registers per thread)
+GPU_CULL_TILE_BLOCKS = 8  # gpu blocks per side of a culling tile (the cull mask holds a row per tile)
+CULL_CHUNK = 1 << 22  # tile x charge row bounds evaluated at once on the host
 
 
 class Calc:
@@ -22,46 +43,140 @@ class Calc:
                  phy_rect: Tuple[float, float, float, float],
                  data: np.ndarray,
                  ref_point: Tuple[float, float] | None = None,
-                 device: str = 'cpu'):
+                 device: str = 'cpu',
+                 precision: str = 'float32',
+                 device_pool: DevicePool | None = None,
+                 cpu_plan: dict | str = 'auto',
+                 cull_tol: float | None = None,
+                 far_field_ratio: float | None = None,
+                 table_interp: dict | None = None,
+                 membership: np.ndarray | None = None,
+                 grid: SampleGrid | None = None,
+                 collect_histogram: bool = False):
+        if precision not in PRECISIONS:
+            raise ValueError('Unknown precision : {}'.format(precision))
+        if membership is not None and (data.ndim != 3 or membership.shape != (data.shape[0], len(charges))):
+            raise ValueError('Batched data has to be (n_scene, n_row, n_col) with membership (n_scene, n_charge)')
+
         self.charges: Tuple[ChargeDist] = charges
-        self.phy_rect = np.array(phy_rect, dtype=np.float32)
+        self.precision = precision
+        self.storage_dtype, self.calc_dtype = PRECISIONS[precision]
+        self.phy_rect = np.array(phy_rect, dtype=self.calc_dtype)
         self.data = data
+        self.grid_shape: Tuple[int, int] = data.shape[-2:]
+
+        # Sample coordinates, shared with the owner (e.g. Simulation) if given
+        if grid is None:
+            grid = SampleGrid(phy_rect, self.grid_shape, dtype=self.calc_dtype)
+        if grid.shape != self.grid_shape:
+            raise ValueError('Grid of shape {} for data of shape {}'.format(grid.shape, self.grid_shape))
+        self.grid = grid
         self.ref_point = ref_point
         self.device = device
-
-    def do(self, progress_q: Queue, verbose=True) -> None:
-        self.data.fill(0.0)
-
-        ref_potential = 0.0
-        if self.ref_point is not None:
-            ref_potential = self.__get_potential(self.ref_point[0], self.ref_point[1])
-        self.data -= ref_potential
+        self.ref_cache: dict = {}  # (charges key, ref_point) : potential at ref_point
+        self.device_pool = device_pool if device_pool is not None else DevicePool()
+        self.cpu_plan = cpu_plan
+        self.pixel_per_sec: float = 0.0  # throughput of the last run on cpu
+
+        # Charges which provably contribute less than cull_tol (V) to a tile are skipped there
+        self.cull_tol = cull_tol
+        # Charge evaluations of the last run, counted in charge table rows x samples on both devices
+        # (a charge packing into several rows, e.g. ArcCharge, counts each of its rows)
+        self.cull_stats = {'n_eval': 0, 'n_culled': 0}
+        # (key, cull_stats) of the gpu cull mask last built, a resident mask of the same key is not rebuilt
+        self.gpu_cull_cache: Tuple[tuple, dict] | None = None
+
+        # (min, max) of the finite data over all scenes, reduced during the last run (saves the plots a pass over data)
+        self.data_range: Tuple[float, float] | None = None
+        # Histogram of data - get_ref_potential() collected during the last run if collect_histogram
+        # (only percentile color scales read it, see potential_color.needs_histogram), None for batched scenes
+        self.collect_histogram = collect_histogram
+        self.histogram: PotentialHistogram | None = None
+
+        # Segments farther than far_field_ratio * their half diagonal use the multipole expansion
+        # (see Charge.is_far_field for the error bound)
+        self.far_field_ratio = far_field_ratio
+
+        # Segment potentials interpolated from tables per (norm, depth) on cpu, table_interp holds
+        # the PotentialTableCache arguments (extent, n_sample, max_bytes), tables persist across runs
+        self.table_interp = table_interp
+        self.tables = PotentialTableCache(**table_interp) if table_interp is not None else None
+
+        # Batched scenes : data is (n_scene, n_row, n_col) and charges are the charges of all scenes,
+        # membership[scene, charge] is the weight of the charge in the scene (see Charge.get_unique_charges)
+        # every charge is evaluated once per pixel and scattered into the scenes
+        self.membership = membership
+
+    def do(self, progress_q: Queue, verbose=True, band_q: Queue | None = None) -> None:
+        """
+        Fill data with the potential referenced to infinity
+        The ref_point offset is not applied here (see get_ref_potential)
+
+        :param band_q: queue receiving (st_row, en_row) of every finished row band (in completion order)
+        """
+
+        self.cull_stats = {'n_eval': 0, 'n_culled': 0}
+        self.data_range = None
+        if self.collect_histogram and self.membership is None:
+            self.histogram = PotentialHistogram(self.get_ref_potential())
+        else:
+            self.histogram = None
 
         if self.device == 'cpu':
-            self.do_on_cpu(progress_q, verbose=verbose)
+            self.do_on_cpu(progress_q, verbose=verbose, band_q=band_q)
         elif self.device == 'gpu':
-            self.do_on_gpu(progress_q, verbose=verbose)
+            self.do_on_gpu(progress_q, verbose=verbose, band_q=band_q)
+
+        if verbose is True and self.cull_tol is not None:
+            n_eval = max(self.cull_stats['n_eval'], 1)
+            print('culled {} / {} charge row evaluations ({:.2f}%)'.format(
+                self.cull_stats['n_culled'], self.cull_stats['n_eval'], self.cull_stats['n_culled'] / n_eval * 100))
+
+    def do_on_cpu(self, progress_q: Queue, verbose: bool = True, band_q: Queue | None = None) -> None:
+        plan = self.get_cpu_plan(verbose=verbose)
 
-    def do_on_cpu(self, progress_q: Queue, verbose: bool = True) -> None:
         st_tm = time.time()
+        self.data.fill(0.0)
         lock = threading.Lock()
+        self.charge_bounds = Charge.get_charge_bounds(self.charges)
+        # Charge table rows of each charge object (unit of cull_stats)
+        self.charge_n_rows = np.array([len(charge.get_table_rows()) for charge in self.charges], dtype=np.int64)
+
+        n_row, n_col = self.grid_shape
+        n_worker = plan['n_worker']
+
+        # Row chunks (st_row, en_row)
+        # static : one contiguous band per worker (remainder spread over the first bands)
+        # dynamic : small chunks taken from a shared list by whichever worker is free
+        if plan['schedule'] == 'static':
+            bands = np.array_split(np.arange(n_row), n_worker)
+            worker_chunks = [[(band[0], band[-1])] if len(band) != 0 else [] for band in bands]
+            worker_next = [[0] for _ in range(n_worker)]
+        else:
+            chunk_rows = plan['chunk_rows']
+            chunks = [(st_row, min(st_row + chunk_rows, n_row) - 1) for st_row in range(0, n_row, chunk_rows)]
+            worker_chunks = [chunks] * n_worker
+            worker_next = [[0]] * n_worker
 
-        n_row, n_col = self.data.shape
-        n_worker = 32
         n_done_row = [0]
+        all_done = threading.Event()
+        errors = []  # exceptions of the workers, all_done is set on the first one
         th_list = []
         for worker_idx in range(n_worker):
-            st_row = (n_row // n_worker) * worker_idx
-            en_row = (n_row // n_worker) * (worker_idx + 1) - 1 if worker_idx != n_worker - 1 else n_row - 1
             worker = threading.Thread(target=self.cpu_worker,
-                                      args=(worker_idx, self, lock, self.data, st_row, en_row, n_done_row))
+                                      args=(worker_idx, self, lock, self.data,
+                                            worker_chunks[worker_idx], worker_next[worker_idx],
+                                            n_done_row, all_done, band_q, errors))
             th_list.append(worker)
             worker.start()
 
-        while n_done_row[0] != n_row:
-            time.sleep(0.3)
+        # At least one message, the last one at 100 % (the gpu loop reports the same way)
+        n_done = 0
+        while n_done != n_row and len(errors) == 0:
+            all_done.wait(0.3)
 
-            progress = n_done_row[0] / n_row * 100
+            n_done = n_done_row[0]
+            progress = n_done / n_row * 100
             el_tm = time.time() - st_tm
             est_tm = 100 / progress * el_tm if progress != 0 else np.NaN
 
@@ -75,57 +190,89 @@ class Calc:
             if verbose is True:
                 print('\rcalc : {:.3f}% | {:.2f}s/{:.2f}s'.format(progress, el_tm, est_tm), end='')
 
+        for worker in th_list:
+            worker.join()
+        if len(errors) != 0:
+            raise errors[0]
+
         el_tm = time.time() - st_tm
+        self.pixel_per_sec = n_row * n_col / el_tm if el_tm != 0 else np.inf
         print('\rcalc done {:.2f}s'.format(el_tm))
+        if verbose is True:
+            print('cpu plan {} : {:.1f} pixel/s'.format(plan, self.pixel_per_sec))
 
-        for worker in th_list:
-            worker.join()
+    def get_cpu_plan(self, verbose: bool = True, max_worker: int | None = None) -> dict:
+        """
+        Work partitioning of the cpu backend
+        cpu_plan 'auto' asks the autotuner (cached on disk per machine), a dict is used as it is
+
+        :param max_worker: workers of the autotuned candidates at most (None : no cap)
+        :return: {'n_worker': int, 'schedule': 'static' | 'dynamic', 'chunk_rows': int}
+        """
+
+        if isinstance(self.cpu_plan, dict):
+            return self.cpu_plan
+
+        return Autotuner(block_pixels=CPU_BLOCK_PIXELS, max_worker=max_worker).get_plan(self, verbose=verbose)
 
-    def do_on_gpu(self, progress_q: Queue, verbose: bool = True) -> None:
+    def do_on_gpu(self, progress_q: Queue, verbose: bool = True, band_q: Queue | None = None) -> None:
         st_tm = time.time()
 
-        # Index
-        # 0 ~ 3 : x1, y1, x2, y2
-        # 4 ~ 7 : unit vec
-        # 8 ~ 9 : density
-        # 10 : depth
-        # 11 : form
-        charge_info_arr = np.zeros((len(self.charges), 12), dtype=np.float32)
-        for idx, charge in enumerate(self.charges):
-            buf = np.zeros(12, dtype=np.float32)
-            buf[0:2] = charge.p1
-            buf[2:4] = charge.p2
-            buf[4:6] = charge.u_vec[0]
-            buf[6:8] = charge.u_vec[1]
-            buf[8] = charge.density
-            buf[10] = charge.depth
-            buf[11] = Charge.FORM_CONSTANT if charge.form == 'constant' else 1.0
-            charge_info_arr[idx] = buf
-
-        n_data = self.data.shape[0] * self.data.shape[1]
-        d_phy_rect = cuda.to_device(self.phy_rect)
-        d_data = cuda.to_device(self.data)
-        d_charge = cuda.to_device(charge_info_arr)
-        d_cnt = cuda.to_device(np.array([0], dtype=np.int32))
+        pool = self.device_pool
+        charges_key = Charge.get_charges_key(self.charges)
+        charge_info_arr, owner = Charge.get_charge_table(self.charges, dtype=self.calc_dtype, with_owner=True)
+        n_row, n_col = self.grid_shape
+        n_scene = 1 if self.membership is None else self.membership.shape[0]
+        membership = np.ones((1, len(self.charges))) if self.membership is None else self.membership
+        row_membership = membership[:, owner].astype(self.calc_dtype)
 
         n_thread_in_block = (16, 16)
         n_block_in_grid = (
-            self.data.shape[1] // n_thread_in_block[0] + 1,
-            self.data.shape[0] // n_thread_in_block[1] + 1
+            n_col // n_thread_in_block[0] + 1,
+            n_row // n_thread_in_block[1] + 1
         )
-
-        kernel_s = cuda.stream()
-        progress_s = cuda.stream()
-
-        gpu_kernel[n_block_in_grid, n_thread_in_block, kernel_s](d_phy_rect, d_data, d_charge, d_cnt)
-
-        h_cnt = [0]
-        while h_cnt[0] != n_data:
+        n_block = n_block_in_grid[0] * n_block_in_grid[1]
+
+        # Data grid is allocated on the device and fully overwritten by the kernel (no upload)
+        d_x = pool.to_device('grid_x', self.grid.x.astype(self.calc_dtype), key=self.grid.key())
+        d_y = pool.to_device('grid_y', self.grid.y.astype(self.calc_dtype), key=self.grid.key())
+        d_data = pool.get('data', self.data.shape, self.data.dtype)
+        d_charge = pool.to_device('charges', charge_info_arr, key=(charges_key, self.precision))
+        d_membership = pool.to_device('membership', row_membership)
+        cull_key = (charges_key, self.cull_tol, self.grid.key())
+        if pool.has('cull_mask', cull_key) and self.gpu_cull_cache is not None and self.gpu_cull_cache[0] == cull_key:
+            d_cull_mask = pool.buffers['cull_mask']
+            self.cull_stats = dict(self.gpu_cull_cache[1])
+        else:
+            d_cull_mask = pool.to_device('cull_mask', self.get_gpu_cull_mask(charge_info_arr, n_block_in_grid,
+                                                                             n_thread_in_block), key=cull_key)
+            self.gpu_cull_cache = (cull_key, dict(self.cull_stats))
+        pool.get('block_done', (n_block,), np.uint8)
+        pool.fill('block_done', 0)
+        d_block_done = pool.buffers['block_done']
+        d_range = pool.to_device('data_range', np.array([np.inf, -np.inf]))
+        # An empty histogram disables the collection in the kernel
+        d_hist = pool.get('histogram', (GPU_HIST_SIZE if self.histogram is not None else 0,), np.int64)
+        if self.histogram is not None:
+            pool.fill('histogram', 0)
+        ref_potential = float(self.histogram.ref_potential) if self.histogram is not None else 0.0
+
+        kernel_s = pool.stream('kernel')
+        progress_s = pool.stream('progress')
+
+        cuda.synchronize()
+        far_field_ratio = self.calc_dtype(self.far_field_ratio if self.far_field_ratio is not None else 0)
+        gpu_kernel[n_block_in_grid, n_thread_in_block, kernel_s](d_x, d_y, d_data.reshape(n_scene, n_row, n_col),
+                                                                 d_charge, d_membership, d_cull_mask, d_block_done,
+                                                                 d_range, d_hist, ref_potential, far_field_ratio)
+
+        n_done_block = 0
+        while n_done_block != n_block:
             time.sleep(0.3)
 
-            h_cnt[0] = d_cnt.copy_to_host(stream=progress_s)[0]
+            n_done_block = int(np.count_nonzero(d_block_done.copy_to_host(stream=progress_s)))
 
-            progress = h_cnt[0] / n_data * 100
+            progress = n_done_block / n_block * 100
             el_tm = time.time() - st_tm
             est_tm = 100 / progress * el_tm if progress != 0 else np.NaN
 
@@ -141,75 +288,402 @@ class Calc:
         el_tm = time.time() - st_tm
         print('\rcalc done {:.2f}s'.format(el_tm))
 
-        # kernel_s.synchronize()
+        kernel_s.synchronize()
+
+        # Device copy of data stays resident in the pool for the plot stage
+        d_data.copy_to_host(self.data, stream=kernel_s)
+        data_range = d_range.copy_to_host(stream=kernel_s)
+        kernel_s.synchronize()
+        self.data_range = (float(data_range[0]), float(data_range[1])) if data_range[0] <= data_range[1] else None
+        if self.histogram is not None:
+            self.histogram.set_flat(d_hist.copy_to_host())
+        # Batched data is not read back by the plots
+        pool.set_key('data', self.get_data_key() if self.membership is None else None)
+
+        if band_q is not None:
+            band_q.put((0, n_row - 1))
+
+    def get_data_key(self) -> tuple:
+        """
+        Description of the potential held in data, tags the resident device copy (see DevicePool)
+        A pool shared by several simulations (e.g. a JobScheduler runner) never reuses a copy of another
+        grid, precision or approximation
+        """
+
+        return (Charge.get_charges_key(self.charges), self.grid.key(), self.precision,
+                self.cull_tol, self.far_field_ratio)
+
+    def get_gpu_cull_mask(self, charge_info_arr: np.ndarray,
+                          n_block_in_grid: Tuple[int, int], n_thread_in_block: Tuple[int, int]) -> np.ndarray:
+        """
+        Culling mask of the gpu kernel, one tile per GPU_CULL_TILE_BLOCKS x GPU_CULL_TILE_BLOCKS blocks
+        (the mask stays small on large grids), charge table rows are culled one by one
+
+        :return: (n_tile, n_charge_row) uint8 array (1 : evaluate), tile index : tile_y * n_tile_x + tile_x,
+                 (1, n_charge_row) array of ones if culling is disabled
+        """
+
+        n_row, n_col = self.grid_shape
+        n_charge_row = charge_info_arr.shape[0]
+        if self.cull_tol is None:
+            self.cull_stats['n_eval'] += n_row * n_col * n_charge_row
+            return np.ones((1, n_charge_row), dtype=np.uint8)
+
+        tile_cols = n_thread_in_block[0] * GPU_CULL_TILE_BLOCKS
+        tile_rows = n_thread_in_block[1] * GPU_CULL_TILE_BLOCKS
+        n_tile_x = -(-n_block_in_grid[0] // GPU_CULL_TILE_BLOCKS)
+        n_tile_y = -(-n_block_in_grid[1] // GPU_CULL_TILE_BLOCKS)
+        tile_y, tile_x = np.divmod(np.arange(n_tile_x * n_tile_y), n_tile_x)
+        st_col = np.minimum(tile_x * tile_cols, n_col - 1)
+        en_col = np.minimum(st_col + tile_cols, n_col) - 1
+        st_row = np.minimum(tile_y * tile_rows, n_row - 1)
+        en_row = np.minimum(st_row + tile_rows, n_row) - 1
+
+        # Bounds of a chunk of tiles at once (bounded host temporaries)
+        tile_rects = self.get_tile_rects(st_row, en_row, st_col, en_col)
+        q_abs, bbox = Charge.get_row_bounds(charge_info_arr.astype(np.float64))
+        mask = np.zeros((len(tile_rects), n_charge_row), dtype=np.uint8)
+        chunk_tiles = max(1, CULL_CHUNK // max(n_charge_row, 1))
+        for st_tile in range(0, len(tile_rects), chunk_tiles):
+            mask[st_tile:st_tile + chunk_tiles] = Charge.get_cull_mask(q_abs, bbox,
+                                                                       tile_rects[st_tile:st_tile + chunk_tiles],
+                                                                       self.cull_tol)
+
+        # Tiles out of the grid have no pixel
+        n_pixel = np.where((tile_x * tile_cols < n_col) & (tile_y * tile_rows < n_row),
+                           (en_col - st_col + 1) * (en_row - st_row + 1), 0)
+        n_active = np.sum(mask, axis=1, dtype=np.int64)
+        self.cull_stats['n_eval'] += int(np.sum(n_pixel) * n_charge_row)
+        self.cull_stats['n_culled'] += int(np.sum(n_pixel * (n_charge_row - n_active)))
+
+        return mask
+
+    def get_cpu_tiles(self, st_row: int, en_row: int, lock: threading.Lock) -> List[tuple]:
+        """
+        Culling tiles of a row chunk on cpu, charge objects are culled with all of their rows
+
+        :return: [(st_col, en_col, indices of the charges to evaluate), ...]
+        """
+
+        n_col = self.grid_shape[1]
+        n_charge_row = int(np.sum(self.charge_n_rows))
+        if self.cull_tol is None:
+            tiles = [(0, n_col - 1, np.arange(len(self.charges)))]
+            n_culled = 0
+        else:
+            st_col = np.arange(0, n_col, CULL_TILE_COLS)
+            en_col = np.minimum(st_col + CULL_TILE_COLS, n_col) - 1
+            tile_rects = self.get_tile_rects(st_row, en_row, st_col, en_col)
+            mask = Charge.get_cull_mask(*self.charge_bounds, tile_rects, self.cull_tol)
+
+            tiles = []
+            n_culled = 0
+            for tile_idx in range(len(st_col)):
+                charge_indices = np.flatnonzero(mask[tile_idx])
+                tiles.append((int(st_col[tile_idx]), int(en_col[tile_idx]), charge_indices))
+                n_culled += (en_col[tile_idx] - st_col[tile_idx] + 1) * \
+                    (n_charge_row - int(np.sum(self.charge_n_rows[charge_indices])))
 
-        self.data[:] = d_data.copy_to_host()
-
-        del progress_s
-        del kernel_s
-        del d_cnt
-        del d_charge
-        del d_data
-        del d_phy_rect
+        lock.acquire()
+        self.cull_stats['n_eval'] += (en_row - st_row + 1) * n_col * n_charge_row
+        self.cull_stats['n_culled'] += int(n_culled) * (en_row - st_row + 1)
+        lock.release()
 
-    def __get_potential(self, x: float, y: float) -> float:
-        res = 0.0
+        return tiles
 
-        for charge in self.charges:
-            res += charge.get_potential(x, y)
+    def get_tile_rects(self, st_row, en_row, st_col, en_col) -> np.ndarray:
+        """
+        Physical rects of tiles given by (arrays of) inclusive sample index ranges
 
-        return res
+        :return: (n_tile, 4) array of x_min, y_min, x_max, y_max
+        """
 
-    def __get_sample_phy_pos(self, col_idx: int, row_idx: int):
-        phy_rect = self.phy_rect
-        n_row, n_col = self.data.shape
+        x_min, y_max = self.grid.x[st_col], self.grid.y[st_row]
+        x_max, y_min = self.grid.x[en_col], self.grid.y[en_row]
+        n_tile = max(np.size(st_row), np.size(st_col))
 
-        sample_x = phy_rect[0] + (phy_rect[2] - phy_rect[0]) * col_idx / (n_col - 1)
-        sample_y = phy_rect[1] - (phy_rect[1] - phy_rect[3]) * row_idx / (n_row - 1)
+        return np.stack([np.broadcast_to(v, n_tile) for v in (x_min, y_min, x_max, y_max)], axis=1).astype(np.float64)
 
-        return sample_x, sample_y
+    def get_ref_potential(self) -> float | np.ndarray:
+        """
+        Potential at ref_point, which plots subtract from data
+        Cached per charge set, so changing only ref_point never touches the data grid
 
-    @staticmethod
-    def cpu_worker(th_idx: int, calc: Calc, lock: threading.Lock,
-                   data: np.ndarray, st_row: int, en_row: int,
-                   n_done_row: List[int]):
-        buf = np.zeros((en_row - st_row + 1, data.shape[1]), dtype=np.float32)
+        :return: potential at ref_point (0 if ref_point is None, i.e. infinity),
+                 (n_scene,) array for batched scenes
+        """
 
-        for row_idx in range(st_row, en_row + 1):
-            for col_idx in range(data.shape[1]):
-                sample_x, sample_y = Calc.__get_sample_phy_pos(calc, col_idx, row_idx)
-                potential = Calc.__get_potential(calc, sample_x, sample_y)
+        if self.ref_point is None:
+            return 0.0 if self.membership is None else np.zeros(self.membership.shape[0])
 
-                buf[row_idx - st_row][col_idx] += potential
+        key = (Charge.get_charges_key(self.charges), tuple(self.ref_point))
+        if key not in self.ref_cache:
+            # Single point, always exact
+            if self.membership is None:
+                self.ref_cache[key] = float(self.__get_potential(self.ref_point[0], self.ref_point[1], exact=True))
+            else:
+                potentials = np.array([self.__get_potential(self.ref_point[0], self.ref_point[1], [charge], exact=True)
+                                       for charge in self.charges], dtype=np.float64)
+                self.ref_cache[key] = self.membership @ potentials
 
-            lock.acquire()
-            n_done_row[0] += 1
-            lock.release()
+        return self.ref_cache[key]
 
-        lock.acquire()
-        data[st_row:en_row + 1] += buf
-        lock.release()
+    def __get_potential(self, x: float, y: float, charges: List[ChargeDist] | None = None,
+                        exact: bool = False) -> float:
+        res = 0.0
+        far_field_ratio = None if exact else self.far_field_ratio
+        tables = None if exact else self.tables
 
+        for charge in (self.charges if charges is None else charges):
+            res += charge.get_potential(x, y, dtype=self.calc_dtype, far_field_ratio=far_field_ratio, tables=tables)
 
-@cuda.jit('void(float32[:], float32[:,:], float32[:,:], int32[:])')
-def gpu_kernel(phy_rect, data, charges, cnt):
-    x, y = cuda.grid(2)
-    if not (x < data.shape[1] and y < data.shape[0]):
-        return
+        return res
 
-    n_row, n_col = data.shape
+    @staticmethod
+    def get_finite_range(buf: np.ndarray, storage_dtype) -> Tuple[float, float] | None:
+        """
+        (min, max) of the finite values of buf as stored in storage_dtype, None if there is none
+        (non-finite values come from degenerate charges, the gpu kernel skips them the same way)
+        """
 
-    sample_x = phy_rect[0] + (phy_rect[2] - phy_rect[0]) * x / (n_col - 1)
-    sample_y = phy_rect[1] - (phy_rect[1] - phy_rect[3]) * y / (n_row - 1)
+        block_min, block_max = buf.min(), buf.max()
+        if not (np.isfinite(block_min) and np.isfinite(block_max)):
+            finite = buf[np.isfinite(buf)]
+            if finite.size == 0:
+                return None
+            block_min, block_max = finite.min(), finite.max()
 
-    res = 0.0
-    for charge in charges:
-        res += Charge.gpu_get_potential(sample_x, sample_y, charge)
+        return float(storage_dtype(block_min)), float(storage_dtype(block_max))
 
-    data[y][x] += res
+    @staticmethod
+    def cpu_worker(th_idx: int, calc: Calc, lock: threading.Lock,
+                   data: np.ndarray, chunks: List[Tuple[int, int]], next_chunk: List[int],
+                   n_done_row: List[int], all_done: threading.Event, band_q: Queue | None = None,
+                   errors: List[Exception] | None = None):
+        """
+        Evaluate row chunks until none is left
+        An exception is appended to errors (and all_done set) instead of ending the thread silently,
+        the other workers stop at their next chunk and do_on_cpu raises it
+        """
+
+        errors = errors if errors is not None else []
+        try:
+            Calc.cpu_work(calc, lock, data, chunks, next_chunk, n_done_row, all_done, band_q, errors)
+        except Exception as e:
+            lock.acquire()
+            errors.append(e)
+            lock.release()
+            all_done.set()
 
-    cuda.atomic.add(cnt, 0, 1)
+    @staticmethod
+    def cpu_work(calc: Calc, lock: threading.Lock,
+                 data: np.ndarray, chunks: List[Tuple[int, int]], next_chunk: List[int],
+                 n_done_row: List[int], all_done: threading.Event, band_q: Queue | None,
+                 errors: List[Exception]):
+        while True:
+            # Take the next row chunk (chunks and next_chunk may be shared with other workers)
+            lock.acquire()
+            chunk_idx = next_chunk[0]
+            next_chunk[0] += 1
+            lock.release()
+            if chunk_idx >= len(chunks) or len(errors) != 0:
+                break
+
+            st_row, en_row = chunks[chunk_idx]
+            tiles = calc.get_cpu_tiles(st_row, en_row, lock)
+
+            # Charges are evaluated on whole blocks of rows x tile columns at once,
+            # chunks do not overlap so every block is written once
+            n_row, n_col = calc.grid_shape
+            block_rows = max(1, CPU_BLOCK_PIXELS // n_col)
+            for st_block in range(st_row, en_row + 1, block_rows):
+                en_block = min(st_block + block_rows, en_row + 1) - 1
+                buf = np.zeros(data.shape[:-2] + (en_block - st_block + 1, n_col), dtype=calc.calc_dtype)
+
+                for st_col, en_col, charge_indices in tiles:
+                    sample_x, sample_y = calc.grid.mesh(st_block, en_block, st_col, en_col)
+
+                    if calc.membership is None:
+                        charges = [calc.charges[charge_idx] for charge_idx in charge_indices]
+                        potential = Calc.__get_potential(calc, sample_x, sample_y, charges)
+                        buf[:, st_col:en_col + 1] += potential
+                        continue
+
+                    # Batched scenes share the evaluation of every charge (and the sample coordinates)
+                    for charge_idx in charge_indices:
+                        potential = Calc.__get_potential(calc, sample_x, sample_y, [calc.charges[charge_idx]])
+                        scene_indices = np.flatnonzero(calc.membership[:, charge_idx])
+                        weights = calc.membership[scene_indices, charge_idx].astype(calc.calc_dtype)
+                        buf[scene_indices, :, st_col:en_col + 1] += weights[:, None, None] * potential
+
+                data[..., st_block:en_block + 1, :] = buf
+                if band_q is not None:
+                    band_q.put((st_block, en_block))
+
+                # Range (and histogram) of the stored values, reduced while the block is still in cache
+                # ('mixed' stores float32, the gpu kernel bins the stored values as well)
+                block_range = Calc.get_finite_range(buf, calc.storage_dtype)
+                if calc.histogram is not None:
+                    block_hist = PotentialHistogram.from_data(data[..., st_block:en_block + 1, :],
+                                                              calc.histogram.ref_potential)
+
+                lock.acquire()
+                if calc.data_range is None:
+                    calc.data_range = block_range
+                elif block_range is not None:
+                    calc.data_range = (min(calc.data_range[0], block_range[0]),
+                                       max(calc.data_range[1], block_range[1]))
+                if calc.histogram is not None:
+                    calc.histogram.merge(block_hist)
+                n_done_row[0] += en_block - st_block + 1
+                if n_done_row[0] == n_row:
+                    all_done.set()
+                lock.release()
+
+
+@cuda.jit(['void(float32[:], float32[:], float32[:,:,:], float32[:,:], float32[:,:], uint8[:,:], uint8[:], float64[:], '
+           'int64[:], float64, float32)',
+           'void(float64[:], float64[:], float64[:,:,:], float64[:,:], float64[:,:], uint8[:,:], uint8[:], float64[:], '
+           'int64[:], float64, float64)',
+           'void(float64[:], float64[:], float32[:,:,:], float64[:,:], float64[:,:], uint8[:,:], uint8[:], float64[:], '
+           'int64[:], float64, float64)'])
+def gpu_kernel(x_axis, y_axis, data, charges, membership, cull_mask, block_done, data_range, hist, ref_potential,
+               far_field_ratio):
+    """
+    Signatures : float32, float64, mixed (float32 data, float64 compute)
+    x_axis, y_axis : sample coordinates of the columns and rows (see SampleGrid)
+    data : (n_scene, n_row, n_col), membership : (n_scene, n_charge_row) weight of every charge row in each scene
+    cull_mask : (n_tile, n_charge_row) rows evaluated per culling tile (see Calc.get_gpu_cull_mask), a single row
+                for every block
+    Every scene accumulates in a register of the compute precision and is stored once in data (fully overwritten)
+    data_range : (min, max) of the finite data, reduced per block and merged atomically (initialised to (inf, -inf))
+    hist : flat PotentialHistogram counts of data - ref_potential (single scene, zero filled beforehand),
+           empty if the histogram is not collected
+    """
 
-    # n_data = data.shape[0] * data.shape[1]
-    # if cnt[0] % 10000000 == 0 or cnt[0] == n_data:
-    #     print('(', round(cnt[0] / n_data * 100, 3), '%)')
+    x, y = cuda.grid(2)
+    n_scene, n_row, n_col = data.shape
+    block_idx = cuda.blockIdx.y * cuda.gridDim.x + cuda.blockIdx.x
+    mask_idx = 0
+    if cull_mask.shape[0] > 1:
+        n_tile_x = (cuda.gridDim.x + GPU_CULL_TILE_BLOCKS - 1) // GPU_CULL_TILE_BLOCKS
+        mask_idx = (cuda.blockIdx.y // GPU_CULL_TILE_BLOCKS) * n_tile_x + cuda.blockIdx.x // GPU_CULL_TILE_BLOCKS
+
+    # No early return, every thread of the block has to reach syncthreads
+    if x < n_col and y < n_row:
+        sample_x = x_axis[x]
+        sample_y = y_axis[y]
+
+        zero = x_axis[0] * 0  # compute precision of the axes
+
+        # Scenes are accumulated in registers of the compute precision, GPU_SCENE_GROUP scenes per pass
+        # over the charges, and stored once
+        acc = cuda.local.array(GPU_SCENE_GROUP, x_axis.dtype)
+        for group_st in range(0, n_scene, GPU_SCENE_GROUP):
+            n_group = min(GPU_SCENE_GROUP, n_scene - group_st)
+            for group_idx in range(n_group):
+                acc[group_idx] = zero
+
+            # End terms carried along a polyline chain (c : last vertex, f : first vertex of the chain)
+            # a culled or far field row invalidates the carried terms
+            c_r, c_log = zero, zero
+            f_r, f_log = zero, zero
+            c_valid = False
+            f_valid = False
+            for charge_idx in range(charges.shape[0]):
+                charge = charges[charge_idx]
+                active = cull_mask[mask_idx, charge_idx] != 0
+
+                if charge[11] == Charge.FORM_POLYLINE:
+                    flag = int(charge[9])
+                    if not flag & Charge.POLYLINE_CONTINUE:
+                        c_valid = False
+                        f_valid = False
+                    if not active:
+                        c_valid = False
+                        continue
+
+                    local_x, local_y, half_depth, a = Charge.gpu_get_polyline_local(sample_x, sample_y, charge)
+                    if Charge.gpu_is_far_field(local_x, local_y, half_depth, a, far_field_ratio):
+                        c_valid = False
+                        potential = charge[8] / (4 * Charge.pi * Charge.eps) * \
+                            Charge.gpu_calc_far_constant(local_x, local_y, half_depth, a)
+                    else:
+                        if flag & Charge.POLYLINE_CONTINUE and c_valid:
+                            r_1, log_1 = c_r, c_log
+                        else:
+                            r_1, log_1 = Charge.gpu_calc_end_terms(sample_x - charge[0], sample_y - charge[1],
+                                                                   half_depth)
+                        if not flag & Charge.POLYLINE_CONTINUE:
+                            f_r, f_log = r_1, log_1
+                            f_valid = True
+                        if flag & Charge.POLYLINE_CLOSE and f_valid:
+                            r_2, log_2 = f_r, f_log
+                        else:
+                            r_2, log_2 = Charge.gpu_calc_end_terms(sample_x - charge[2], sample_y - charge[3],
+                                                                   half_depth)
+                        c_r, c_log = r_2, log_2
+                        c_valid = True
+
+                        potential = Charge.gpu_calc_polyline_0(local_x, local_y, half_depth, a, charge,
+                                                               r_1, log_1, r_2, log_2)
+                elif active:
+                    potential = Charge.gpu_get_potential(sample_x, sample_y, charge, far_field_ratio)
+                else:
+                    continue
+
+                for group_idx in range(n_group):
+                    weight = membership[group_st + group_idx, charge_idx]
+                    if weight != 0:
+                        acc[group_idx] += weight * potential
+
+            for group_idx in range(n_group):
+                data[group_st + group_idx, y, x] = acc[group_idx]
+
+    # Range of the stored values of the thread, then of the block (tree reduction in shared memory)
+    thread_idx = cuda.threadIdx.y * cuda.blockDim.x + cuda.threadIdx.x
+    block_min = cuda.shared.array(GPU_BLOCK_THREADS, float64)
+    block_max = cuda.shared.array(GPU_BLOCK_THREADS, float64)
+    block_min[thread_idx] = np.inf
+    block_max[thread_idx] = -np.inf
+    if x < n_col and y < n_row:
+        for scene_idx in range(n_scene):
+            value = data[scene_idx, y, x]
+            if math.isfinite(value):
+                block_min[thread_idx] = min(block_min[thread_idx], value)
+                block_max[thread_idx] = max(block_max[thread_idx], value)
+    cuda.syncthreads()
+
+    stride = GPU_BLOCK_THREADS // 2
+    while stride > 0:
+        if thread_idx < stride:
+            block_min[thread_idx] = min(block_min[thread_idx], block_min[thread_idx + stride])
+            block_max[thread_idx] = max(block_max[thread_idx], block_max[thread_idx + stride])
+        cuda.syncthreads()
+        stride //= 2
+
+    if thread_idx == 0:
+        cuda.atomic.min(data_range, 0, block_min[0])
+        cuda.atomic.max(data_range, 1, block_max[0])
+
+    # Histogram of the block in shared memory, merged once per bin (the condition is uniform over the block)
+    if n_scene == 1 and hist.shape[0] != 0:
+        block_hist = cuda.shared.array(GPU_HIST_SIZE, int32)
+        for hist_idx in range(thread_idx, GPU_HIST_SIZE, GPU_BLOCK_THREADS):
+            block_hist[hist_idx] = 0
+        cuda.syncthreads()
+
+        if x < n_col and y < n_row:
+            # Stored value (float32 in 'mixed') minus ref_potential in float64, as PotentialHistogram.add
+            cuda.atomic.add(block_hist, gpu_get_hist_idx(float64(data[0, y, x]) - ref_potential), 1)
+        cuda.syncthreads()
+
+        for hist_idx in range(thread_idx, GPU_HIST_SIZE, GPU_BLOCK_THREADS):
+            if block_hist[hist_idx] != 0:
+                cuda.atomic.add(hist, hist_idx, int64(block_hist[hist_idx]))
+
+    # Progress : each block raises its own flag once all of its threads are done
+    # (no contention on a single global counter)
+    cuda.syncthreads()
+    if cuda.threadIdx.x == 0 and cuda.threadIdx.y == 0:
+        block_done[block_idx] = 1
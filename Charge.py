@@ -1,4 +1,9 @@
+from __future__ import annotations
 from typing import Tuple
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from PotentialTable import PotentialTableCache
 
 import math
 
@@ -9,12 +14,43 @@ pi = np.pi
 eps = 8.8541878128e-12  # electric permittivity of vacuum
 
 FORM_CONSTANT = 0
+FORM_LINEAR = 1
+FORM_POINT = 2
+FORM_POLYLINE = 3
+
+FORMS = {
+    'constant': FORM_CONSTANT,
+    'linear': FORM_LINEAR,
+    'point': FORM_POINT,
+    'polyline': FORM_POLYLINE
+}
+
+# Polyline row flags (column 9)
+POLYLINE_CONTINUE = 1  # p1 is p2 of the previous row
+POLYLINE_CLOSE = 2  # p2 is p1 of the first row of the chain
+
+N_CHARGE_INFO = 12
+
+TINY = 1e-30  # added to squared distances, keeps the end terms finite on the segment line without branches
 
 
 class ChargeDist:
+    """
+    Charge distributed on a segment (x1, y1) ~ (x2, y2) extruded by depth along z
+
+    form 'constant' : density is a surface charge density
+    form 'linear' : density is a pair (density at (x1, y1), density at (x2, y2))
+                    linearly interpolated along the segment
+    """
+
     def __init__(self, x1, y1, x2, y2,
                  density=1e-8, depth=1e-1,
                  form='constant'):
+        if form not in FORMS:
+            raise ValueError('Unknown form : {}'.format(form))
+        if form == 'linear':
+            density = (float(density[0]), float(density[1]))
+
         self.p1: np.ndarray | None = None
         self.p2: np.ndarray | None = None
         self.cntr: np.ndarray | None = None
@@ -27,8 +63,9 @@ class ChargeDist:
         self.form = form
 
     def set_points(self, x1, y1, x2, y2):
-        self.p1 = np.array((x1, y1), dtype=np.float32)
-        self.p2 = np.array((x2, y2), dtype=np.float32)
+        # Geometry is kept in float64, backends cast it to their compute precision
+        self.p1 = np.array((x1, y1), dtype=np.float64)
+        self.p2 = np.array((x2, y2), dtype=np.float64)
         self.cntr = (self.p1 + self.p2) / 2
 
         p1_to_p2 = self.p2 - self.p1
@@ -37,47 +74,580 @@ class ChargeDist:
         u_vec_0 = p1_to_p2 / self.norm
         self.u_vec = (  # Unit vectors
             u_vec_0,  # + local x direction
-            np.array((-u_vec_0[1], u_vec_0[0]), dtype=np.float32)  # + local y direction
+            np.array((-u_vec_0[1], u_vec_0[0]), dtype=np.float64)  # + local y direction
         )
 
-    def get_potential(self, x, y):
-        cntr_to_r = np.array((x, y), dtype=np.float32) - self.cntr
+    def key(self) -> tuple:
+        """
+        Hashable description of the charge (equal keys give equal potentials)
+
+        :return: tuple of form, points, density and depth
+        """
+
+        return (self.form, *self.p1.tolist(), *self.p2.tolist(), self.density, self.depth)
+
+    def get_table_rows(self) -> np.ndarray:
+        """
+        Rows of the charge table (see get_charge_table)
+        """
+
+        buf = np.zeros((1, N_CHARGE_INFO), dtype=np.float64)
+        buf[0, 0:2] = self.p1
+        buf[0, 2:4] = self.p2
+        buf[0, 4:6] = self.u_vec[0]
+        buf[0, 6:8] = self.u_vec[1]
+        if self.form == 'linear':
+            buf[0, 8:10] = self.density
+        else:
+            buf[0, 8] = self.density
+        buf[0, 10] = self.depth
+        buf[0, 11] = FORMS[self.form]
+
+        return buf
+
+    def get_potential(self, x, y, dtype=np.float32, far_field_ratio=None,
+                      tables: PotentialTableCache | None = None):
+        """
+        Potential at (x, y) evaluated in dtype precision
+
+        :param x: x of the sample point (scalar or array)
+        :param y: y of the sample point (scalar or array, broadcast with x)
+        :param dtype: floating point type used for the evaluation (np.float32 or np.float64)
+        :param far_field_ratio: use the multipole expansion farther than far_field_ratio * sqrt(a^2 + h^2)
+                                from the center (see is_far_field), None for the exact expression only
+        :param tables: interpolate the unit density potential of the (norm, depth) table inside its range
+                       (see PotentialTable), None to always evaluate the closed form
+        :return: potential at the sample point(s)
+        """
+
+        local_x, local_y = get_local_pos(x, y, self.cntr, self.u_vec, dtype)
+        half_depth = dtype(self.depth / 2)
+        a = dtype(self.norm / 2)
+
+        if self.form == 'constant':
+            near, far = self.__calc_constant_0, self.__calc_far_constant_0
+        else:
+            near, far = self.__calc_linear_0, self.__calc_far_linear_0
+
+        def calc(x_, y_):
+            return calc_split(x_, y_, half_depth, a, far_field_ratio,
+                              lambda x__, y__: near(x__, y__, half_depth, a, dtype),
+                              lambda x__, y__: far(x__, y__, half_depth, a, dtype))
 
-        # Local position
-        local_x = np.dot(cntr_to_r, self.u_vec[0])
-        local_y = np.dot(cntr_to_r, self.u_vec[1])
+        if tables is None:
+            return calc(local_x, local_y)
 
+        table = tables.get(self.norm, self.depth)
+        inside = table.contains(local_x, local_y)
+        if np.all(inside):
+            return self.__calc_table_0(table, local_x, local_y, dtype)
+
+        outside = ~inside
+        res = np.empty(local_x.shape, dtype=dtype)
+        res[inside] = self.__calc_table_0(table, local_x[inside], local_y[inside], dtype)
+        res[outside] = calc(local_x[outside], local_y[outside])
+
+        return res
+
+    def __calc_table_0(self, table, x, y, dtype):
         if self.form == 'constant':
-            return self.__calc_constant_0(local_x, local_y)
+            buf = table.interp(x, y)
+            return (self.density / (4 * pi * eps) * buf).astype(dtype)
+
+        buf0, buf1 = table.interp(x, y, linear=True)
+        density_c, slope = self.__get_linear_coef(np.float64)
+        return (1 / (4 * pi * eps) * ((density_c + slope * x) * buf0 + slope * buf1)).astype(dtype)
+
+    def __calc_constant_0(self, x, y, half_depth, a, dtype):
+        r_1, log_1 = calc_end_terms(a + x, y, half_depth)
+        r_2, log_2 = calc_end_terms(a - x, y, half_depth)
+
+        buf = calc_constant(x, y, half_depth, a, r_1, r_2, log_1, log_2)
+        return dtype(self.density / (4 * pi * eps)) * buf
+
+    def __calc_far_constant_0(self, x, y, half_depth, a, dtype):
+        return dtype(self.density / (4 * pi * eps)) * calc_far_constant(x, y, half_depth, a)
+
+    def __calc_linear_0(self, x, y, half_depth, a, dtype):
+        # density(s) = density_c + slope * s (s : local x, -a at p1 and a at p2)
+        # s = x + (s - x), the (s - x) part integrates in closed form (calc_linear)
+        density_c, slope = self.__get_linear_coef(dtype)
+
+        r_1, log_1 = calc_end_terms(a + x, y, half_depth)
+        r_2, log_2 = calc_end_terms(a - x, y, half_depth)
+
+        buf0 = calc_constant(x, y, half_depth, a, r_1, r_2, log_1, log_2)
+        buf1 = calc_linear(x, y, half_depth, a, r_1, r_2, log_1, log_2)
+        return dtype(1 / (4 * pi * eps)) * ((density_c + slope * x) * buf0 + slope * buf1)
+
+    def __calc_far_linear_0(self, x, y, half_depth, a, dtype):
+        density_c, slope = self.__get_linear_coef(dtype)
+
+        buf0 = calc_far_constant(x, y, half_depth, a)
+        buf1 = calc_far_dipole(x, y, half_depth, a)
+        return dtype(1 / (4 * pi * eps)) * (density_c * buf0 + slope * buf1)
+
+    def __get_linear_coef(self, dtype):
+        density_c = dtype((self.density[0] + self.density[1]) / 2)
+        slope = dtype((self.density[1] - self.density[0]) / self.norm)
+
+        return density_c, slope
+
+
+def get_local_pos(x, y, cntr, u_vec, dtype):
+    """
+    Local position of (arrays of) sample points in the frame of a segment (center cntr, unit vectors u_vec)
+    """
+
+    cntr_to_r_x = np.asarray(x, dtype=dtype) - dtype(cntr[0])
+    cntr_to_r_y = np.asarray(y, dtype=dtype) - dtype(cntr[1])
+
+    local_x = cntr_to_r_x * dtype(u_vec[0][0]) + cntr_to_r_y * dtype(u_vec[0][1])
+    local_y = cntr_to_r_x * dtype(u_vec[1][0]) + cntr_to_r_y * dtype(u_vec[1][1])
+
+    return np.broadcast_arrays(local_x, local_y)
+
+
+def calc_split(x, y, h, a, far_field_ratio, calc_near, calc_far):
+    """
+    calc_near(x, y) on the near field points and calc_far(x, y) on the far field points (see is_far_field)
+
+    :param x: local x (array)
+    :param y: local y (array of the shape of x)
+    :return: array of the shape of x
+    """
+
+    if far_field_ratio is None:
+        return calc_near(x, y)
+
+    far = is_far_field(x, y, h, a, far_field_ratio)
+    near = ~far
+
+    res = np.empty(x.shape, dtype=x.dtype)
+    res[far] = calc_far(x[far], y[far])
+    res[near] = calc_near(x[near], y[near])
+
+    return res
+
+
+def is_far_field(x, y, h, a, far_field_ratio):
+    """
+    Whether the local point (x, y) is farther than far_field_ratio * sqrt(a^2 + h^2) from the center
+    of the segment, i.e. in the range of calc_far_constant and calc_far_dipole
+
+    Accuracy bound
+    With t = sqrt(a^2 + h^2) / r = 1 / far_field_ratio at worst, every source point is within t * r
+    of the center, so the Legendre series of 1 / |r - r'| converges term by term below t^n.
+    The expansion drops terms of order >= 4 (constant density, odd orders vanish by symmetry)
+    and >= 3 for the slope of the 'linear' form, so
+        |error| <= |Q| / (4 pi eps r) * t^4 / (1 - t^2)   (constant)
+        |error| <= |Q| / (4 pi eps r) * t^3 / (1 - t)     ('linear', Q : total absolute charge)
+    e.g. far_field_ratio 10 : 1e-4 (constant), 30 : 1.2e-6, 60 : 7.7e-8 (float32 resolution)
+    relative to the monopole potential.
+    """
+
+    return x ** 2 + y ** 2 > far_field_ratio ** 2 * (a ** 2 + h ** 2)
+
+
+def calc_far_constant(x, y, h, a):
+    """
+    Monopole + quadrupole expansion of calc_constant (uniform 2a x 2h rectangle in the local x-z plane)
+    """
+
+    r2 = x ** 2 + y ** 2
+    r = np.sqrt(r2)
+
+    return 4 * a * h / r * (1 + (a ** 2 * x ** 2 / r2 - (a ** 2 + h ** 2) / 3) / (2 * r2))
+
+
+def calc_far_dipole(x, y, h, a):
+    """
+    Dipole expansion of the unit slope density s (zero net charge, quadrupole vanishes)
+    """
+
+    r = np.sqrt(x ** 2 + y ** 2)
+
+    return 4 * h * a ** 3 / 3 * x / r ** 3
+
+
+def calc_end_terms(u, y, half_depth):
+    """
+    Terms of a segment end which are shared by z = +half_depth and -half_depth
+    (and by adjacent edges of a polyline)
+
+    log((r + h) / (r - h)) is evaluated as 2 asinh(h / rho) (rho : planar distance to the end),
+    r - h cancels for rho << h. TINY keeps rho non zero on the end itself, where the log is
+    only ever multiplied by a zero factor.
+
+    :param u: local x distance from the sample point to the end
+    :param y: local y of the sample point
+    :param half_depth: half of the depth
+    :return: r (distance to the end at z = +-half_depth), log((r + half_depth) / (r - half_depth))
+    """
+
+    rho2 = u ** 2 + y ** 2 + TINY
+    r = np.sqrt(rho2 + half_depth ** 2)
+    log = 2 * np.arcsinh(half_depth / np.sqrt(rho2))
+
+    return r, log
+
+
+def calc_constant(x, y, h, a, r_1, r_2, log_1, log_2):
+    """
+    Depth integrated potential of a unit density segment (without 1 / (4 pi eps))
+    The antiderivative in z is odd in z (log, atan and atanh terms), so z = +h and z = -h
+    are fused into one evaluation
+
+    1 : end at local -a (p1), 2 : end at local +a (p2)
+    r, log : see calc_end_terms
+
+    Branch free forms (valid for arrays and on the segment line)
+    y atan(h u / (y r)) = |y| atan2(h u, |y| r) (even in y, 0 at y = 0)
+    atanh(u / r) = asinh(u / sqrt(y^2 + h^2)) (no cancellation of r - u on the extended line)
+    """
+
+    buf01 = a - x
+    buf02 = a + x
+    buf03 = np.abs(y)
+    buf04 = np.sqrt(y ** 2 + h ** 2)
+
+    buf20 = buf01 * log_2
+    buf21 = buf02 * log_1
+    buf22 = buf03 * np.arctan2(h * buf01, buf03 * r_2)
+    buf23 = buf03 * np.arctan2(h * buf02, buf03 * r_1)
+    buf24 = np.arcsinh(buf01 / buf04)
+    buf25 = np.arcsinh(buf02 / buf04)
+
+    return buf20 + buf21 - 2 * (buf22 + buf23) + 2 * h * (buf24 + buf25)
+
+
+def calc_linear(x, y, h, a, r_1, r_2, log_1, log_2):
+    """
+    Depth integrated potential of a density s - x along the segment (without 1 / (4 pi eps))
+    Shares the end terms with calc_constant, each end contributes h r + rho^2 asinh(h / rho)
+    which goes to h^2 (no 0 * inf) on the end itself
+    """
+
+    buf01 = (a - x) ** 2 + y ** 2
+    buf02 = (a + x) ** 2 + y ** 2
+
+    return h * (r_2 - r_1) + (buf01 * log_2 - buf02 * log_1) / 2
+
+
+class PointCharge:
+    """
+    Point (x, y) of the plane extruded by depth along z, i.e. a straight wire
+    density is a line charge density along z
+
+    The potential is clamped inside radius (wire radius) to stay finite at the point itself
+    """
+
+    def __init__(self, x, y, density=1e-8, depth=1e-1, radius=1e-4):
+        self.p = np.array((x, y), dtype=np.float64)
+        self.density = density
+        self.depth = depth
+        self.radius = radius
+        self.form = 'point'
+
+    def key(self) -> tuple:
+        return (self.form, *self.p.tolist(), self.density, self.depth, self.radius)
+
+    def get_table_rows(self) -> np.ndarray:
+        buf = np.zeros((1, N_CHARGE_INFO), dtype=np.float64)
+        buf[0, 0:2] = self.p
+        buf[0, 2] = self.radius
+        buf[0, 8] = self.density
+        buf[0, 10] = self.depth
+        buf[0, 11] = FORM_POINT
+
+        return buf
+
+    def get_potential(self, x, y, dtype=np.float32, far_field_ratio=None, tables=None):
+        return calc_point(x, y, self.get_table_rows().astype(dtype))
+
+
+class ArcCharge:
+    """
+    Charge distributed on a circular arc extruded by depth along z
+    Arc of radius around (cx, cy) from st_angle to en_angle (radian, counterclockwise)
+    density is a surface charge density (as in ChargeDist 'constant')
+
+    The arc length integral is evaluated by n_quad points Gauss-Legendre quadrature,
+    each quadrature node is packed as a 'point' row (weighted wire), so arcs and point charges
+    share one batched evaluation.
+    Nodes are clamped to half of the node spacing, the quadrature is accurate
+    farther than about one node spacing (radius * arc angle / n_quad) from the arc.
+    """
+
+    def __init__(self, cx, cy, radius, st_angle, en_angle, density=1e-8, depth=1e-1, n_quad=16):
+        self.cntr = np.array((cx, cy), dtype=np.float64)
+        self.radius = radius
+        self.st_angle = st_angle
+        self.en_angle = en_angle
+        self.density = density
+        self.depth = depth
+        self.n_quad = n_quad
+        self.form = 'arc'
+
+    def key(self) -> tuple:
+        return (self.form, *self.cntr.tolist(), self.radius, self.st_angle, self.en_angle,
+                self.density, self.depth, self.n_quad)
+
+    def get_table_rows(self) -> np.ndarray:
+        nodes, weights = np.polynomial.legendre.leggauss(self.n_quad)
+        half_angle = (self.en_angle - self.st_angle) / 2
+        angles = self.st_angle + half_angle * (nodes + 1)
+
+        buf = np.zeros((self.n_quad, N_CHARGE_INFO), dtype=np.float64)
+        buf[:, 0] = self.cntr[0] + self.radius * np.cos(angles)
+        buf[:, 1] = self.cntr[1] + self.radius * np.sin(angles)
+        buf[:, 2] = abs(self.radius * half_angle) / self.n_quad  # half of the mean node spacing
+        buf[:, 8] = self.density * abs(self.radius * half_angle) * weights  # charge per depth of the node
+        buf[:, 10] = self.depth
+        buf[:, 11] = FORM_POINT
+
+        return buf
+
+    def get_potential(self, x, y, dtype=np.float32, far_field_ratio=None, tables=None):
+        return calc_point(x, y, self.get_table_rows().astype(dtype))
 
-    def __calc_constant_0(self, x, y):
-        half_depth = self.depth / 2
 
-        buf = self.__calc_constant_1(x, y, half_depth) - self.__calc_constant_1(x, y, -half_depth)
-        return self.density / (4 * pi * eps) * buf
+class ChargePolyline:
+    """
+    Constant density charge on a chain of segments (polygon if closed) extruded by depth along z
 
-    def __calc_constant_1(self, x, y, z):
-        a = self.norm / 2
+    Equivalent to one ChargeDist per edge, but the terms which only depend on a vertex
+    (distance to the vertex and its log, see calc_end_terms) are evaluated once per vertex
+    and shared by the two adjacent edges.
+    """
 
-        buf00 = x ** 2 + y ** 2 + z ** 2
-        buf01 = a - x
-        buf02 = a + x
+    def __init__(self, points, density=1e-8, depth=1e-1, closed=False):
+        self.points = np.array(points, dtype=np.float64).reshape(-1, 2)
+        if len(self.points) < 2:
+            raise ValueError('Polyline needs at least 2 points')
+
+        self.density = density
+        self.depth = depth
+        self.closed = closed
+        self.form = 'polyline'
+
+        vertices = np.concatenate([self.points, self.points[:1]]) if closed else self.points
+        self.edges = [ChargeDist(*vertices[idx], *vertices[idx + 1], density=density, depth=depth)
+                      for idx in range(len(vertices) - 1)]
+
+    def key(self) -> tuple:
+        return (self.form, *self.points.flatten().tolist(), self.density, self.depth, self.closed)
+
+    def get_table_rows(self) -> np.ndarray:
+        buf = np.concatenate([edge.get_table_rows() for edge in self.edges])
+        buf[:, 11] = FORM_POLYLINE
+        buf[1:, 9] = POLYLINE_CONTINUE
+        if self.closed:
+            buf[-1, 9] += POLYLINE_CLOSE
+
+        return buf
+
+    def get_potential(self, x, y, dtype=np.float32, far_field_ratio=None, tables=None):
+        if tables is not None:
+            # Edges interpolate the table of their shape, vertex terms are not needed
+            return sum(edge.get_potential(x, y, dtype, far_field_ratio, tables) for edge in self.edges)
+
+        half_depth = dtype(self.depth / 2)
+        vertices = self.points.astype(dtype)
+        x, y = np.broadcast_arrays(np.asarray(x, dtype=dtype), np.asarray(y, dtype=dtype))
+
+        # End terms only depend on the distance to the vertex, they are shared by adjacent edges
+        # (evaluated on demand, edges entirely in the far field do not need them)
+        terms = {}
+
+        def get_terms(vertex_idx):
+            vertex_idx %= len(vertices)
+            if vertex_idx not in terms:
+                vertex = vertices[vertex_idx]
+                terms[vertex_idx] = calc_end_terms(x - vertex[0], y - vertex[1], half_depth)
+            return terms[vertex_idx]
+
+        res = np.zeros(x.shape, dtype=dtype)
+        for idx, edge in enumerate(self.edges):
+            local_x, local_y = get_local_pos(x, y, edge.cntr, edge.u_vec, dtype)
+            a = dtype(edge.norm / 2)
+
+            if far_field_ratio is None:
+                r_1, log_1 = get_terms(idx)
+                r_2, log_2 = get_terms(idx + 1)
+                res += calc_constant(local_x, local_y, half_depth, a, r_1, r_2, log_1, log_2)
+                continue
+
+            far = is_far_field(local_x, local_y, half_depth, a, far_field_ratio)
+            near = ~far
+            res[far] += calc_far_constant(local_x[far], local_y[far], half_depth, a)
+            if np.any(near):
+                r_1, log_1 = get_terms(idx)
+                r_2, log_2 = get_terms(idx + 1)
+                res[near] += calc_constant(local_x[near], local_y[near], half_depth, a,
+                                           r_1[near], r_2[near], log_1[near], log_2[near])
+
+        return dtype(self.density / (4 * pi * eps)) * res
+
+
+def calc_point(x, y, rows):
+    """
+    Potential of 'point' rows of the charge table (wires along z) at (arrays of) (x, y)
+    """
+
+    dtype = rows.dtype.type
+    x, y = np.broadcast_arrays(np.asarray(x, dtype=dtype), np.asarray(y, dtype=dtype))
+
+    res = np.zeros(x.shape, dtype=dtype)
+    for row in rows:
+        dist = np.sqrt((x - row[0]) ** 2 + (y - row[1]) ** 2)
+        dist = np.maximum(dist, row[2])
+        res += row[8] * 2 * np.arcsinh(row[10] / 2 / dist)
+
+    return dtype(1 / (4 * pi * eps)) * res
+
+
+def get_charges_key(charges) -> tuple:
+    return tuple(charge.key() for charge in charges)
+
+
+def get_unique_charges(charge_sets) -> Tuple[list, np.ndarray]:
+    """
+    Charges shared by several charge sets (scenes), deduplicated by key
+
+    :param charge_sets: list of charge lists
+    :return: unique charges, membership (n_set, n_unique) count of each unique charge in each set
+    """
+
+    unique = []
+    unique_idx = {}  # key : index in unique
+    entries = []
+    for set_idx, charges in enumerate(charge_sets):
+        for charge in charges:
+            key = charge.key()
+            if key not in unique_idx:
+                unique_idx[key] = len(unique)
+                unique.append(charge)
+            entries.append((set_idx, unique_idx[key]))
+
+    membership = np.zeros((len(charge_sets), len(unique)), dtype=np.float64)
+    for set_idx, charge_idx in entries:
+        membership[set_idx, charge_idx] += 1
+
+    return unique, membership
+
+
+def get_row_bounds(rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Upper bound of the absolute charge and bounding box of each row of the charge table
+
+    :param rows: rows of the charge table
+    :return: q_abs (n_row,), bbox (n_row, 4) of x_min, y_min, x_max, y_max
+    """
+
+    forms = rows[:, 11]
+    is_point = forms == FORM_POINT
+    x1, y1 = rows[:, 0], rows[:, 1]
+    x2 = np.where(is_point, x1, rows[:, 2])
+    y2 = np.where(is_point, y1, rows[:, 3])
+
+    length = np.where(is_point, 1.0, np.sqrt((x2 - x1) ** 2 + (y2 - y1) ** 2))
+    density_abs = np.where(forms == FORM_LINEAR,
+                           np.maximum(np.abs(rows[:, 8]), np.abs(rows[:, 9])),
+                           np.abs(rows[:, 8]))
+    q_abs = density_abs * length * rows[:, 10]
+
+    bbox = np.stack([np.minimum(x1, x2), np.minimum(y1, y2), np.maximum(x1, x2), np.maximum(y1, y2)], axis=1)
+    return q_abs, bbox
 
-        buf10 = a ** 2 - 2 * a * x + buf00
-        buf11 = a ** 2 + 2 * a * x + buf00
 
-        buf20 = (buf01 * np.log(np.sqrt(buf10) + z)) if buf01 != 0 else 0
-        buf21 = (buf02 * np.log(np.sqrt(buf11) + z)) if buf02 != 0 else 0
-        buf22 = (y * np.arctan((z * buf01) / (y * np.sqrt(buf10)))) if y != 0 else 0
-        buf23 = (y * np.arctan((z * buf02) / (y * np.sqrt(buf11)))) if y != 0 else 0
-        buf24 = (z * np.arctanh(buf01 / np.sqrt(buf01 ** 2 + y ** 2 + z ** 2))) if z != 0 else 0
-        buf25 = (z * np.arctanh(buf02 / np.sqrt(buf02 ** 2 + y ** 2 + z ** 2))) if z != 0 else 0
+def get_charge_bounds(charges) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    get_row_bounds per charge object (sum of charge and union of boxes of its rows)
+    """
 
-        return buf20 + buf21 - buf22 - buf23 + buf24 + buf25
+    q_abs = np.zeros(len(charges), dtype=np.float64)
+    bbox = np.zeros((len(charges), 4), dtype=np.float64)
+    for idx, charge in enumerate(charges):
+        row_q_abs, row_bbox = get_row_bounds(charge.get_table_rows())
+        q_abs[idx] = np.sum(row_q_abs)
+        bbox[idx, 0:2] = np.min(row_bbox[:, 0:2], axis=0)
+        bbox[idx, 2:4] = np.max(row_bbox[:, 2:4], axis=0)
 
+    return q_abs, bbox
+
+
+def get_cull_mask(q_abs: np.ndarray, bbox: np.ndarray, tile_rects: np.ndarray, cull_tol: float) -> np.ndarray:
+    """
+    Which charges may contribute at least cull_tol to some point of each tile
+
+    Every source point of a charge is at least d away from a tile (d : planar distance between
+    the tile and the bounding box of the charge), so |potential| <= q_abs / (4 pi eps d).
+
+    :param q_abs: upper bound of the absolute charge (n_charge,)
+    :param bbox: bounding box of the charges (n_charge, 4) of x_min, y_min, x_max, y_max
+    :param tile_rects: rect of the tiles (n_tile, 4) of x_min, y_min, x_max, y_max
+    :param cull_tol: tolerance of a skipped contribution (V)
+    :return: (n_tile, n_charge) bool array, False for culled charges
+    """
+
+    dx = np.maximum(0, np.maximum(bbox[None, :, 0] - tile_rects[:, None, 2], tile_rects[:, None, 0] - bbox[None, :, 2]))
+    dy = np.maximum(0, np.maximum(bbox[None, :, 1] - tile_rects[:, None, 3], tile_rects[:, None, 1] - bbox[None, :, 3]))
+    dist = np.sqrt(dx ** 2 + dy ** 2)
+
+    with np.errstate(divide='ignore'):
+        bound = q_abs[None, :] / (4 * pi * eps * dist)
+
+    return bound >= cull_tol
+
+
+def get_charge_table(charges, dtype=np.float32, with_owner: bool = False):
+    """
+    Pack charges into the table consumed by the gpu kernels
+
+    Index ('constant', 'linear', 'polyline')
+    0 ~ 3 : x1, y1, x2, y2
+    4 ~ 7 : unit vec
+    8 ~ 9 : density (density at p1, p2 for 'linear', density and POLYLINE_* flags for 'polyline')
+    10 : depth
+    11 : form
+
+    Index ('point')
+    0 ~ 1 : x, y
+    2 : radius
+    8 : density
+    10 : depth
+    11 : form
+
+    A charge may pack into several rows (e.g. ArcCharge), rows are grouped by form
+    so the kernels evaluate one form over consecutive rows (the order inside a form is kept,
+    polyline rows of a chain stay adjacent)
+
+    :param charges: charge distributions
+    :param dtype: floating point type of the table
+    :param with_owner: also return the index of the charge of each row
+    :return: (n_row, N_CHARGE_INFO) array (, (n_row,) owner index array)
+    """
+
+    if len(charges) == 0:
+        charge_info_arr = np.zeros((0, N_CHARGE_INFO), dtype=dtype)
+        return (charge_info_arr, np.zeros(0, dtype=np.int64)) if with_owner else charge_info_arr
+
+    rows = [charge.get_table_rows() for charge in charges]
+    charge_info_arr = np.concatenate(rows)
+    owner = np.concatenate([np.full(len(buf), idx, dtype=np.int64) for idx, buf in enumerate(rows)])
+
+    order = np.argsort(charge_info_arr[:, 11], kind='stable')
+    charge_info_arr = charge_info_arr[order].astype(dtype)
+
+    return (charge_info_arr, owner[order]) if with_owner else charge_info_arr
+
+
+@cuda.jit(device=True)
+def gpu_get_potential(r_x, r_y, charge, far_field_ratio):
+    if charge[11] == FORM_POINT:
+        return gpu_calc_point(r_x, r_y, charge)
 
-@cuda.jit
-def gpu_get_potential(r_x, r_y, charge):
     cntr_x = (charge[0] + charge[2]) / 2
     cntr_y = (charge[1] + charge[3]) / 2
     cntr_to_r_x = r_x - cntr_x
@@ -92,41 +662,137 @@ def gpu_get_potential(r_x, r_y, charge):
     local_y = cntr_to_r_x * u2_x + cntr_to_r_y * u2_y
 
     if charge[11] == FORM_CONSTANT:
-        return gpu_calc_constant_0(local_x, local_y, charge)
+        return gpu_calc_constant_0(local_x, local_y, charge, far_field_ratio)
+    elif charge[11] == FORM_LINEAR:
+        return gpu_calc_linear_0(local_x, local_y, charge, far_field_ratio)
 
     return 0
 
 
-@cuda.jit
-def gpu_calc_constant_0(x, y, charge):
+@cuda.jit(device=True)
+def gpu_calc_constant_0(x, y, charge, far_field_ratio):
     half_depth = charge[10] / 2
     dx = charge[2] - charge[0]
     dy = charge[3] - charge[1]
-    norm = math.sqrt(dx ** 2 + dy ** 2)
+    a = math.sqrt(dx ** 2 + dy ** 2) / 2
 
-    buf0 = gpu_calc_constant_1(x, y, half_depth, norm)
-    buf1 = gpu_calc_constant_1(x, y, -half_depth, norm)
-    buf = buf0 - buf1
+    if gpu_is_far_field(x, y, half_depth, a, far_field_ratio):
+        return charge[8] / (4 * pi * eps) * gpu_calc_far_constant(x, y, half_depth, a)
+
+    r_1, log_1 = gpu_calc_end_terms(a + x, y, half_depth)
+    r_2, log_2 = gpu_calc_end_terms(a - x, y, half_depth)
+
+    buf = gpu_calc_constant(x, y, half_depth, a, r_1, r_2, log_1, log_2)
 
     return charge[8] / (4 * pi * eps) * buf
 
 
-@cuda.jit
-def gpu_calc_constant_1(x, y, z, norm):
+@cuda.jit(device=True)
+def gpu_calc_linear_0(x, y, charge, far_field_ratio):
+    half_depth = charge[10] / 2
+    dx = charge[2] - charge[0]
+    dy = charge[3] - charge[1]
+    norm = math.sqrt(dx ** 2 + dy ** 2)
     a = norm / 2
 
-    buf00 = x ** 2 + y ** 2 + z ** 2
+    density_c = (charge[8] + charge[9]) / 2
+    slope = (charge[9] - charge[8]) / norm
+
+    if gpu_is_far_field(x, y, half_depth, a, far_field_ratio):
+        buf0 = gpu_calc_far_constant(x, y, half_depth, a)
+        buf1 = gpu_calc_far_dipole(x, y, half_depth, a)
+        return 1 / (4 * pi * eps) * (density_c * buf0 + slope * buf1)
+
+    r_1, log_1 = gpu_calc_end_terms(a + x, y, half_depth)
+    r_2, log_2 = gpu_calc_end_terms(a - x, y, half_depth)
+
+    buf0 = gpu_calc_constant(x, y, half_depth, a, r_1, r_2, log_1, log_2)
+    buf1 = gpu_calc_linear(x, y, half_depth, a, r_1, r_2, log_1, log_2)
+
+    return 1 / (4 * pi * eps) * ((density_c + slope * x) * buf0 + slope * buf1)
+
+
+@cuda.jit(device=True)
+def gpu_is_far_field(x, y, h, a, far_field_ratio):
+    # far_field_ratio <= 0 : disabled
+    return far_field_ratio > 0 and x ** 2 + y ** 2 > far_field_ratio ** 2 * (a ** 2 + h ** 2)
+
+
+@cuda.jit(device=True)
+def gpu_calc_far_constant(x, y, h, a):
+    r2 = x ** 2 + y ** 2
+    r = math.sqrt(r2)
+
+    return 4 * a * h / r * (1 + (a ** 2 * x ** 2 / r2 - (a ** 2 + h ** 2) / 3) / (2 * r2))
+
+
+@cuda.jit(device=True)
+def gpu_calc_far_dipole(x, y, h, a):
+    r = math.sqrt(x ** 2 + y ** 2)
+
+    return 4 * h * a ** 3 / 3 * x / r ** 3
+
+
+@cuda.jit(device=True)
+def gpu_calc_end_terms(u, y, half_depth):
+    rho2 = u ** 2 + y ** 2 + TINY
+    r = math.sqrt(rho2 + half_depth ** 2)
+    log = 2 * math.asinh(half_depth / math.sqrt(rho2))
+
+    return r, log
+
+
+@cuda.jit(device=True)
+def gpu_calc_constant(x, y, h, a, r_1, r_2, log_1, log_2):
     buf01 = a - x
     buf02 = a + x
+    buf03 = abs(y)
+    buf04 = math.sqrt(y ** 2 + h ** 2)
+
+    buf20 = buf01 * log_2
+    buf21 = buf02 * log_1
+    buf22 = buf03 * math.atan2(h * buf01, buf03 * r_2)
+    buf23 = buf03 * math.atan2(h * buf02, buf03 * r_1)
+    buf24 = math.asinh(buf01 / buf04)
+    buf25 = math.asinh(buf02 / buf04)
+
+    return buf20 + buf21 - 2 * (buf22 + buf23) + 2 * h * (buf24 + buf25)
+
+
+@cuda.jit(device=True)
+def gpu_calc_linear(x, y, h, a, r_1, r_2, log_1, log_2):
+    buf01 = (a - x) ** 2 + y ** 2
+    buf02 = (a + x) ** 2 + y ** 2
+
+    return h * (r_2 - r_1) + (buf01 * log_2 - buf02 * log_1) / 2
+
+
+@cuda.jit(device=True)
+def gpu_calc_point(x, y, charge):
+    half_depth = charge[10] / 2
+    dist = math.sqrt((x - charge[0]) ** 2 + (y - charge[1]) ** 2)
+    dist = max(dist, charge[2])
+
+    return charge[8] / (4 * pi * eps) * 2 * math.asinh(half_depth / dist)
+
+
+@cuda.jit(device=True)
+def gpu_get_polyline_local(r_x, r_y, charge):
+    half_depth = charge[10] / 2
+    dx = charge[2] - charge[0]
+    dy = charge[3] - charge[1]
+    a = math.sqrt(dx ** 2 + dy ** 2) / 2
+
+    cntr_to_r_x = r_x - (charge[0] + charge[2]) / 2
+    cntr_to_r_y = r_y - (charge[1] + charge[3]) / 2
+    x = cntr_to_r_x * charge[4] + cntr_to_r_y * charge[5]
+    y = cntr_to_r_x * charge[6] + cntr_to_r_y * charge[7]
 
-    buf10 = a ** 2 - 2 * a * x + buf00
-    buf11 = a ** 2 + 2 * a * x + buf00
+    return x, y, half_depth, a
 
-    buf20 = (buf01 * math.log(math.sqrt(buf10) + z)) if buf01 != 0 else 0
-    buf21 = (buf02 * math.log(math.sqrt(buf11) + z)) if buf02 != 0 else 0
-    buf22 = (y * math.atan((z * buf01) / (y * math.sqrt(buf10)))) if y != 0 else 0
-    buf23 = (y * math.atan((z * buf02) / (y * math.sqrt(buf11)))) if y != 0 else 0
-    buf24 = (z * math.atanh(buf01 / math.sqrt(buf01 ** 2 + y ** 2 + z ** 2))) if z != 0 else 0
-    buf25 = (z * math.atanh(buf02 / math.sqrt(buf02 ** 2 + y ** 2 + z ** 2))) if z != 0 else 0
 
-    return buf20 + buf21 - buf22 - buf23 + buf24 + buf25
+@cuda.jit(device=True)
+def gpu_calc_polyline_0(x, y, half_depth, a, charge, r_1, log_1, r_2, log_2):
+    buf = gpu_calc_constant(x, y, half_depth, a, r_1, r_2, log_1, log_2)
+
+    return charge[8] / (4 * pi * eps) * buf
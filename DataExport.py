@@ -0,0 +1,110 @@
+from __future__ import annotations
+from typing import Tuple
+
+import json
+import os
+import zlib
+
+import numpy as np
+
+ZARR_CHUNKS = (256, 256)
+
+
+def create_npy_memmap(path: str, shape: Tuple[int, int], dtype) -> np.memmap:
+    """
+    .npy file mapped into memory, to be filled in place (e.g. as Simulation.data)
+
+    :return: writable memmap of shape and dtype
+    """
+
+    return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+
+
+def save_meta(path: str, meta: dict) -> None:
+    """
+    Write meta as the JSON sidecar of a .npy file (path + '.json')
+    """
+
+    with open(path + '.json', 'w') as f:
+        json.dump(meta, f, indent=2)
+
+
+def save_npy(path: str, data: np.ndarray, meta: dict) -> None:
+    """
+    Save data as a memory mappable .npy file (np.load(path, mmap_mode='r')) with its JSON sidecar
+    """
+
+    np.save(path, data)
+    save_meta(path, meta)
+
+
+def save_zarr(path: str, data: np.ndarray, meta: dict,
+              chunks: Tuple[int, int] = ZARR_CHUNKS, level: int = 5) -> None:
+    """
+    Save data as a chunked, zlib compressed store in the zarr v2 directory layout
+    (readable by zarr.open(path)), meta is stored as the attributes (.zattrs)
+
+    :param path: directory of the store
+    :param data: 2D array
+    :param meta: JSON serializable attributes
+    :param chunks: chunk shape
+    :param level: zlib compression level
+    :return: None
+    """
+
+    os.makedirs(path, exist_ok=True)
+    zarray = {
+        'zarr_format': 2,
+        'shape': list(data.shape),
+        'chunks': list(chunks),
+        'dtype': data.dtype.str,
+        'compressor': {'id': 'zlib', 'level': level},
+        'fill_value': 0.0,
+        'filters': None,
+        'order': 'C'
+    }
+    with open(os.path.join(path, '.zarray'), 'w') as f:
+        json.dump(zarray, f, indent=2)
+    with open(os.path.join(path, '.zattrs'), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+    # Every chunk is stored in full, edge chunks are padded with fill_value
+    for chunk_row in range(0, data.shape[0], chunks[0]):
+        for chunk_col in range(0, data.shape[1], chunks[1]):
+            buf = np.zeros(chunks, dtype=data.dtype)
+            src = data[chunk_row:chunk_row + chunks[0], chunk_col:chunk_col + chunks[1]]
+            buf[:src.shape[0], :src.shape[1]] = src
+
+            name = '{}.{}'.format(chunk_row // chunks[0], chunk_col // chunks[1])
+            with open(os.path.join(path, name), 'wb') as f:
+                f.write(zlib.compress(buf.tobytes(), level))
+
+
+def load_zarr(path: str) -> Tuple[np.ndarray, dict]:
+    """
+    Read a store written by save_zarr
+
+    :return: data, meta
+    """
+
+    with open(os.path.join(path, '.zarray'), 'r') as f:
+        zarray = json.load(f)
+    with open(os.path.join(path, '.zattrs'), 'r') as f:
+        meta = json.load(f)
+
+    chunks = tuple(zarray['chunks'])
+    dtype = np.dtype(zarray['dtype'])
+    data = np.full(zarray['shape'], zarray['fill_value'], dtype=dtype)
+    for chunk_row in range(0, data.shape[0], chunks[0]):
+        for chunk_col in range(0, data.shape[1], chunks[1]):
+            name = '{}.{}'.format(chunk_row // chunks[0], chunk_col // chunks[1])
+            chunk_path = os.path.join(path, name)
+            if not os.path.exists(chunk_path):
+                continue
+
+            with open(chunk_path, 'rb') as f:
+                buf = np.frombuffer(zlib.decompress(f.read()), dtype=dtype).reshape(chunks)
+            dst = data[chunk_row:chunk_row + chunks[0], chunk_col:chunk_col + chunks[1]]
+            dst[...] = buf[:dst.shape[0], :dst.shape[1]]
+
+    return data, meta
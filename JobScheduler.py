@@ -0,0 +1,323 @@
+from __future__ import annotations
+from typing import List
+
+import heapq
+import itertools
+import os
+import shutil
+import threading
+from collections import deque
+from queue import Queue
+
+from Charge import get_charges_key
+from DevicePool import DevicePool
+from Simulation import Simulation
+
+PRIORITIES = {
+    'interactive': 0,
+    'batch': 1
+}
+
+
+class Job:
+    def __init__(self, job_id: int, sim_conf: dict, out_path: str, priority: str, cpu_limit: int):
+        self.job_id = job_id
+        self.sim_conf = sim_conf
+        self.out_paths: List[str] = [out_path]  # identical submissions share the job, results are copied
+        self.priority = priority
+        self.cpu_limit = cpu_limit
+        self.state = 'queued'  # 'queued', 'running', 'done', 'failed' or 'cancelled'
+        self.progress: dict = {}  # last progress message
+        self.error: Exception | None = None
+        self.done = threading.Event()
+        self.sim: Simulation | None = None  # held while running, then only for the keep_results latest done jobs
+
+    def get_status(self) -> dict:
+        return {
+            'job_id': self.job_id,
+            'state': self.state,
+            'priority': self.priority,
+            'cpu_limit': self.cpu_limit,
+            'out_paths': list(self.out_paths),
+            'progress': dict(self.progress),
+            'error': repr(self.error) if self.error is not None else None
+        }
+
+
+class JobProgressQueue:
+    """
+    Stands in for the progress_q of Simulation.run, tags the messages of a job with its id
+    and forwards them to the scheduler
+    """
+
+    def __init__(self, scheduler: JobScheduler, job: Job):
+        self.scheduler = scheduler
+        self.job = job
+
+    def put(self, msg: dict) -> None:
+        msg = dict(msg, job_id=self.job.job_id)
+        self.job.progress = msg
+        self.scheduler.progress_q.put(msg)
+
+
+class JobScheduler:
+    """
+    Local scheduler running sim_conf jobs on a fixed number of runner threads
+
+    - 'interactive' jobs run before 'batch' jobs, first come first served within a priority
+    - each job uses at most cpu_limit cpu workers (Calc plan n_worker, also while autotuning it)
+    - a job identical to a queued or running one (same conf) is merged into it,
+      its output is copied from the shared result (an interactive duplicate raises the priority)
+    - runners are long lived, compiled kernels, device buffers (one DevicePool per runner) and
+      potential tables (one PotentialTableCache per table_interp, shared) stay warm across jobs
+    - the Simulation (data and img) of the keep_results latest done jobs is kept for get_simulation,
+      older results are released (the output files stay), the records of the keep_jobs latest ended jobs
+      are kept for get_status, older ones are forgotten as by remove
+    - progress_q receives the progress dicts of Simulation.run tagged with 'job_id',
+      {'task': 'queue', 'depth': queued jobs, 'running': running jobs} when the queue changes and
+      {'task': 'job', 'job_id': id, 'state': state} when a job ends
+    """
+
+    def __init__(self, n_runner: int = 2, cpu_limit: int | None = None, progress_q: Queue | None = None,
+                 keep_results: int = 8, keep_jobs: int = 1024):
+        self.n_runner = n_runner
+        self.keep_results = keep_results
+        self.keep_jobs = max(keep_jobs, keep_results)
+        self.cpu_limit = cpu_limit if cpu_limit is not None else max(1, (os.cpu_count() or 1) // n_runner)
+        self.progress_q = progress_q if progress_q is not None else Queue()
+
+        self.jobs: dict = {}  # job_id : Job
+        self.active: dict = {}  # conf key : Job (queued or running)
+        self.heap: list = []  # (priority rank, sequence, job), stale entries are skipped
+        self.sequence = itertools.count()
+        self.job_ids = itertools.count(1)
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.table_caches: dict = {}  # table_interp items : PotentialTableCache shared by the jobs
+        self.results = deque()  # done jobs holding their Simulation, oldest first
+        self.ended = deque()  # ended jobs still in jobs, oldest first
+
+        self.runners = [threading.Thread(target=self.runner, daemon=True) for _ in range(n_runner)]
+        for runner in self.runners:
+            runner.start()
+
+    @staticmethod
+    def get_conf_key(sim_conf: dict) -> tuple:
+        """
+        Hashable description of a sim_conf (equal keys render equal results)
+        """
+
+        def freeze(value):
+            if isinstance(value, dict):
+                return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+            if isinstance(value, (list, tuple)):
+                return tuple(freeze(v) for v in value)
+            return value
+
+        return tuple(sorted((key, get_charges_key(value) if key == 'charges' else freeze(value))
+                            for key, value in sim_conf.items()))
+
+    def submit(self, sim_conf: dict, out_path: str = 'result.png', priority: str = 'batch',
+               cpu_limit: int | None = None) -> int:
+        """
+        Queue a simulation
+
+        :param sim_conf: conf of Simulation
+        :param out_path: path of the output image
+        :param priority: 'interactive' or 'batch'
+        :param cpu_limit: cpu workers of the job (default : cpu_limit of the scheduler)
+        :return: job id (the id of the merged job for a duplicate)
+        """
+
+        if priority not in PRIORITIES:
+            raise ValueError('Unknown priority : {}'.format(priority))
+
+        key = JobScheduler.get_conf_key(sim_conf)
+        cpu_limit = min(cpu_limit, self.cpu_limit) if cpu_limit is not None else self.cpu_limit
+
+        with self.cond:
+            if self.stopped:
+                raise RuntimeError('Scheduler is shut down')
+
+            job = self.active.get(key)
+            if job is not None:
+                if out_path not in job.out_paths:
+                    job.out_paths.append(out_path)
+                if job.state == 'queued' and PRIORITIES[priority] < PRIORITIES[job.priority]:
+                    job.priority = priority
+                    heapq.heappush(self.heap, (PRIORITIES[priority], next(self.sequence), job))
+                return job.job_id
+
+            job = Job(next(self.job_ids), sim_conf, out_path, priority, cpu_limit)
+            self.jobs[job.job_id] = job
+            self.active[key] = job
+            heapq.heappush(self.heap, (PRIORITIES[priority], next(self.sequence), job))
+            self.put_queue_status()
+            self.cond.notify()
+
+        return job.job_id
+
+    def cancel(self, job_id: int) -> bool:
+        """
+        Cancel a queued job (running jobs are not interrupted)
+
+        :return: whether the job was cancelled
+        """
+
+        with self.cond:
+            job = self.jobs[job_id]
+            if job.state != 'queued':
+                return False
+
+            self.finish(job, 'cancelled')
+            self.put_queue_status()
+
+        return True
+
+    def get_status(self, job_id: int) -> dict:
+        with self.cond:
+            return self.jobs[job_id].get_status()
+
+    def get_simulation(self, job_id: int) -> Simulation | None:
+        """
+        Simulation of a finished job (data, img and get_meta of the result)
+        None unless the job is done and among the keep_results latest ones
+        """
+
+        with self.cond:
+            job = self.jobs[job_id]
+            return job.sim if job.state == 'done' else None
+
+    def remove(self, job_id: int) -> bool:
+        """
+        Forget an ended job and release its result
+
+        :return: whether the job was removed (queued and running jobs are kept)
+        """
+
+        with self.cond:
+            job = self.jobs[job_id]
+            if job.state in ('queued', 'running'):
+                return False
+
+            self.forget(job)
+            self.ended.remove(job)
+
+        return True
+
+    def get_queue_depth(self) -> int:
+        with self.cond:
+            return sum(1 for job in self.active.values() if job.state == 'queued')
+
+    def wait(self, job_id: int, timeout: float | None = None) -> dict:
+        """
+        Block until the job ends
+
+        :return: status of the job (see Job.get_status)
+        """
+
+        job = self.jobs[job_id]
+        job.done.wait(timeout)
+        with self.cond:
+            return job.get_status()
+
+    def shutdown(self, wait: bool = True) -> None:
+        """
+        Cancel the queued jobs and stop the runners after their current job
+        """
+
+        with self.cond:
+            self.stopped = True
+            for job in list(self.active.values()):
+                if job.state == 'queued':
+                    self.finish(job, 'cancelled')
+            self.cond.notify_all()
+
+        if wait is True:
+            for runner in self.runners:
+                runner.join()
+
+    def put_queue_status(self) -> None:
+        # Called with cond held
+        states = [job.state for job in self.active.values()]
+        self.progress_q.put({
+            'task': 'queue',
+            'depth': states.count('queued'),
+            'running': states.count('running')
+        })
+
+    def finish(self, job: Job, state: str, error: Exception | None = None) -> None:
+        # Called with cond held
+        job.state = state
+        job.error = error
+        self.active.pop(JobScheduler.get_conf_key(job.sim_conf), None)
+
+        if state == 'done' and self.keep_results > 0:
+            self.results.append(job)
+            while len(self.results) > self.keep_results:
+                self.results.popleft().sim = None
+        else:
+            job.sim = None
+
+        self.ended.append(job)
+        while len(self.ended) > self.keep_jobs:
+            self.forget(self.ended.popleft())
+        job.done.set()
+        self.progress_q.put({'task': 'job', 'job_id': job.job_id, 'state': state})
+
+    def forget(self, job: Job) -> None:
+        # Called with cond held, job has ended
+        del self.jobs[job.job_id]
+        if job in self.results:
+            self.results.remove(job)
+        job.sim = None
+
+    def take(self) -> Job | None:
+        with self.cond:
+            while True:
+                while len(self.heap) != 0:
+                    rank, _, job = heapq.heappop(self.heap)
+                    if job.state == 'queued' and rank == PRIORITIES[job.priority]:
+                        job.state = 'running'
+                        self.put_queue_status()
+                        return job
+                if self.stopped:
+                    return None
+                self.cond.wait()
+
+    def runner(self) -> None:
+        device_pool = DevicePool()
+        while True:
+            job = self.take()
+            if job is None:
+                return
+
+            try:
+                sim = Simulation(job.sim_conf, device_pool=device_pool)
+                if sim.calc.tables is not None:
+                    with self.cond:
+                        table_key = tuple(sorted(sim.calc.table_interp.items()))
+                        sim.calc.tables = self.table_caches.setdefault(table_key, sim.calc.tables)
+                if sim.device == 'cpu':
+                    plan = sim.calc.get_cpu_plan(verbose=False, max_worker=job.cpu_limit)
+                    sim.calc.cpu_plan = dict(plan, n_worker=min(plan['n_worker'], job.cpu_limit))
+                job.sim = sim
+
+                sim.run(JobProgressQueue(self, job), out_path=job.out_paths[0], verbose=False)
+
+                with self.cond:
+                    out_paths = list(job.out_paths)
+                for out_path in out_paths[1:]:
+                    shutil.copyfile(out_paths[0], out_path)
+            except Exception as e:
+                with self.cond:
+                    self.finish(job, 'failed', e)
+                    self.put_queue_status()
+                continue
+
+            with self.cond:
+                # Outputs merged after the copy above are copied here, under the lock
+                for out_path in job.out_paths[len(out_paths):]:
+                    shutil.copyfile(job.out_paths[0], out_path)
+                self.finish(job, 'done')
+                self.put_queue_status()
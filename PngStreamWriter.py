@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+import os
+import struct
+import zlib
+
+import numpy as np
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+class PngStreamWriter:
+    """
+    8 bit RGB PNG written row band by row band (filter type 0, zlib stream over the bands)
+    Only the compressor state and the current band are held in memory.
+    """
+
+    def __init__(self, path: str, width: int, height: int, level: int = 6):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.n_written_row = 0
+
+        self.compressor = zlib.compressobj(level)
+        self.file = open(path, 'wb')
+        self.file.write(PNG_SIGNATURE)
+        # bit depth 8, color type 2 (RGB), deflate, filter method 0, no interlace
+        self.write_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+
+    def __enter__(self) -> PngStreamWriter:
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write_chunk(self, chunk_type: bytes, data: bytes) -> None:
+        self.file.write(struct.pack('>I', len(data)))
+        self.file.write(chunk_type)
+        self.file.write(data)
+        self.file.write(struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff))
+
+    def write_rows(self, rows: np.ndarray) -> None:
+        """
+        Append rows to the image
+
+        :param rows: (n_row, width, 3) uint8 array
+        :return: None
+        """
+
+        if rows.shape[1:] != (self.width, 3):
+            raise ValueError('Rows of shape {} do not match the image width {}'.format(rows.shape, self.width))
+        if self.n_written_row + rows.shape[0] > self.height:
+            raise ValueError('More than {} rows written'.format(self.height))
+
+        # Each scanline is prefixed by its filter type byte (0 : none)
+        buf = np.zeros((rows.shape[0], self.width * 3 + 1), dtype=np.uint8)
+        buf[:, 1:] = rows.reshape(rows.shape[0], -1)
+
+        compressed = self.compressor.compress(buf.tobytes())
+        if len(compressed) != 0:
+            self.write_chunk(b'IDAT', compressed)
+        self.n_written_row += rows.shape[0]
+
+    def close(self) -> None:
+        if self.n_written_row != self.height:
+            self.file.close()
+            raise ValueError('{} of {} rows written'.format(self.n_written_row, self.height))
+
+        self.write_chunk(b'IDAT', self.compressor.flush())
+        self.write_chunk(b'IEND', b'')
+        self.file.close()
+
+    def abort(self) -> None:
+        """
+        Close the file and remove the incomplete image
+        """
+
+        self.file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,111 @@
+from __future__ import annotations
+
+import math
+
+import numpy as np
+from numba import cuda
+
+HIST_LOG_MIN = -12  # log10 of the smallest resolved |value| (smaller values count in the first bin)
+HIST_LOG_MAX = 12  # log10 of the largest resolved |value| (larger values count in the last bin)
+HIST_BINS_PER_DECADE = 32
+HIST_N_BIN = (HIST_LOG_MAX - HIST_LOG_MIN) * HIST_BINS_PER_DECADE
+HIST_NONFINITE = 2 * HIST_N_BIN  # slot of the non-finite values in the flat counts (see gpu_get_hist_idx)
+HIST_SIZE = 2 * HIST_N_BIN + 1  # flat counts : [negative or zero bins, positive bins, non-finite]
+
+
+class PotentialHistogram:
+    """
+    Counts of data - ref_potential in log spaced bins of the magnitude (HIST_BINS_PER_DECADE per decade), by sign
+    Partial histograms are merged, so Calc workers (and gpu blocks) collect it during the pass over data.
+    Percentiles are resolved to a bin (about 7.5 % of the value).
+    Non-finite values (e.g. on a degenerate charge) are counted apart in n_nonfinite and left out of the bins.
+    """
+
+    def __init__(self, ref_potential: float = 0.0):
+        self.ref_potential = ref_potential
+        self.counts = np.zeros((2, HIST_N_BIN), dtype=np.int64)  # [negative or zero, positive][bin]
+        self.n_nonfinite = 0
+
+    @classmethod
+    def from_data(cls, data: np.ndarray, ref_potential: float = 0.0) -> PotentialHistogram:
+        hist = cls(ref_potential)
+        hist.add(data)
+        return hist
+
+    @staticmethod
+    def get_bins(abs_values: np.ndarray) -> np.ndarray:
+        """
+        Bin of finite magnitudes (non-finite ones have to be masked out beforehand)
+        """
+
+        with np.errstate(divide='ignore'):
+            idx = np.floor((np.log10(abs_values) - HIST_LOG_MIN) * HIST_BINS_PER_DECADE)
+
+        return np.clip(idx, 0, HIST_N_BIN - 1).astype(np.intp)
+
+    @staticmethod
+    def get_upper_edges() -> np.ndarray:
+        return 10.0 ** (HIST_LOG_MIN + np.arange(1, HIST_N_BIN + 1) / HIST_BINS_PER_DECADE)
+
+    def add(self, data: np.ndarray) -> None:
+        values = (data.astype(np.float64) - self.ref_potential).reshape(-1)
+        finite = np.isfinite(values)
+        if not np.all(finite):
+            self.n_nonfinite += int(values.size - np.count_nonzero(finite))
+            values = values[finite]
+
+        bins = PotentialHistogram.get_bins(np.abs(values))
+        positive = values > 0.0
+
+        self.counts[1] += np.bincount(bins[positive], minlength=HIST_N_BIN)
+        self.counts[0] += np.bincount(bins[~positive], minlength=HIST_N_BIN)
+
+    def merge(self, other: PotentialHistogram) -> None:
+        self.counts += other.counts
+        self.n_nonfinite += other.n_nonfinite
+
+    def set_flat(self, flat: np.ndarray) -> None:
+        """
+        Set the counts from the flat (HIST_SIZE,) counts of the gpu kernel
+        """
+
+        self.counts[...] = flat[:HIST_NONFINITE].reshape(2, HIST_N_BIN)
+        self.n_nonfinite = int(flat[HIST_NONFINITE])
+
+    @property
+    def n_total(self) -> int:
+        # Finite values only
+        return int(self.counts.sum())
+
+    def get_abs_percentile(self, q: float) -> float:
+        """
+        q-th percentile of |data - ref_potential| (upper edge of the bin holding it)
+
+        :param q: percentile (0 ~ 100)
+        :return: magnitude
+        """
+
+        cum = np.cumsum(self.counts.sum(axis=0))
+        if cum[-1] == 0:
+            return float('nan')
+        bin_idx = min(int(np.searchsorted(cum, q / 100 * cum[-1])), HIST_N_BIN - 1)
+
+        return float(PotentialHistogram.get_upper_edges()[bin_idx])
+
+
+@cuda.jit(device=True)
+def gpu_get_hist_idx(value):
+    """
+    Index of value in the flat (HIST_SIZE) counts of PotentialHistogram, HIST_NONFINITE for nan and inf
+    """
+
+    if not math.isfinite(value):
+        return HIST_NONFINITE
+
+    abs_value = abs(value)
+    bin_idx = 0
+    if abs_value > 0:
+        bin_idx = int(math.floor((math.log10(abs_value) - HIST_LOG_MIN) * HIST_BINS_PER_DECADE))
+        bin_idx = min(max(bin_idx, 0), HIST_N_BIN - 1)
+
+    return bin_idx + HIST_N_BIN if value > 0 else bin_idx
@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import Charge
+
+
+class PotentialTable:
+    """
+    Sampled unit density potential of one segment shape (norm, depth) in its local (x, y) frame
+
+    Two channels are stored, calc_constant and calc_linear (without 1 / (4 pi eps)),
+    so 'constant' and 'linear' charges of the shape share the table.
+    calc_constant is even in x and y, calc_linear is odd in x and even in y,
+    only the quadrant |x|, |y| <= half_size is sampled (n_sample x n_sample, bilinear interpolation).
+
+    With the default extent and n_sample, the interpolation error is below 1% of the peak calc_constant
+    (the table value at the center, times a for calc_linear) for depth / norm between 0.1 and 10
+    (tests/test_potential_table.py). It is largest next to the segment line, where the potential has a kink,
+    and is not bounded for thinner or coarser tables.
+    """
+
+    def __init__(self, norm: float, depth: float, extent: float = 8.0, n_sample: int = 512):
+        self.norm = norm
+        self.depth = depth
+
+        self.a = norm / 2
+        self.half_depth = depth / 2
+        self.half_size = extent * np.sqrt(self.a ** 2 + self.half_depth ** 2)
+        self.n_sample = n_sample
+        self.step = self.half_size / (n_sample - 1)
+
+        axis = np.linspace(0, self.half_size, n_sample)
+        x, y = np.meshgrid(axis, axis)  # [y index][x index]
+        h, a = self.half_depth, self.a
+
+        r_1, log_1 = Charge.calc_end_terms(a + x, y, h)
+        r_2, log_2 = Charge.calc_end_terms(a - x, y, h)
+        self.constant = Charge.calc_constant(x, y, h, a, r_1, r_2, log_1, log_2)
+        self.linear = Charge.calc_linear(x, y, h, a, r_1, r_2, log_1, log_2)
+
+    @property
+    def nbytes(self) -> int:
+        return self.constant.nbytes + self.linear.nbytes
+
+    def contains(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        return (np.abs(x) <= self.half_size) & (np.abs(y) <= self.half_size)
+
+    def interp(self, x: np.ndarray, y: np.ndarray, linear: bool = False):
+        """
+        Interpolated calc_constant (and calc_linear if linear) at local positions inside the table
+        (see contains)
+
+        :return: constant or (constant, linear), float64 arrays of the shape of x
+        """
+
+        n = self.n_sample
+        fx = np.abs(x).astype(np.float64) / self.step
+        fy = np.abs(y).astype(np.float64) / self.step
+        idx_x = np.minimum(fx.astype(np.intp), n - 2)
+        idx_y = np.minimum(fy.astype(np.intp), n - 2)
+        tx = fx - idx_x
+        ty = fy - idx_y
+        flat_idx = idx_y * n + idx_x
+
+        res = []
+        for table in ((self.constant, self.linear) if linear else (self.constant,)):
+            table = table.reshape(-1)
+            buf0 = table.take(flat_idx)
+            buf1 = table.take(flat_idx + 1)
+            buf2 = table.take(flat_idx + n)
+            buf3 = table.take(flat_idx + n + 1)
+
+            buf0 += (buf1 - buf0) * tx
+            buf2 += (buf3 - buf2) * tx
+            buf0 += (buf2 - buf0) * ty
+            res.append(buf0)
+
+        if not linear:
+            return res[0]
+
+        return res[0], np.sign(x) * res[1]
+
+
+class PotentialTableCache:
+    """
+    PotentialTable per (norm, depth), built on first use
+    Least recently used tables are evicted beyond max_bytes (the table in use is always kept).
+    Shared by the cpu workers.
+    """
+
+    def __init__(self, extent: float = 8.0, n_sample: int = 512, max_bytes: int = 64 << 20):
+        self.extent = extent
+        self.n_sample = n_sample
+        self.max_bytes = max_bytes
+
+        self.tables: OrderedDict = OrderedDict()  # (norm, depth) : PotentialTable
+        self.n_bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, norm: float, depth: float) -> PotentialTable:
+        # Rounded to 9 significant digits, copies of a shape at other positions and orientations
+        # differ in the last bits of norm
+        key = (float('{:.9g}'.format(norm)), float('{:.9g}'.format(depth)))
+
+        self.lock.acquire()
+        table = self.tables.get(key)
+        if table is not None:
+            self.tables.move_to_end(key)
+        self.lock.release()
+        if table is not None:
+            return table
+
+        # Built outside of the lock, two workers may build the same table once
+        table = PotentialTable(*key, extent=self.extent, n_sample=self.n_sample)
+
+        self.lock.acquire()
+        if key not in self.tables:
+            self.tables[key] = table
+            self.n_bytes += table.nbytes
+        while self.n_bytes > self.max_bytes and len(self.tables) > 1:
+            _, evicted = self.tables.popitem(last=False)
+            self.n_bytes -= evicted.nbytes
+        self.lock.release()
+
+        return table
+
+    def clear(self) -> None:
+        self.lock.acquire()
+        self.tables.clear()
+        self.n_bytes = 0
+        self.lock.release()
@@ -0,0 +1,356 @@
+from __future__ import annotations
+
+import argparse
+import itertools
+import json
+import os
+import re
+import tempfile
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Queue
+
+import numpy as np
+
+from Calc import PRECISIONS
+import Charge
+from Charge import ChargeDist, PointCharge, ArcCharge, ChargePolyline
+from JobScheduler import JobScheduler
+import Resample
+from Simulation import Simulation, PLOT_MODULES
+
+CHARGE_TYPES = {
+    'segment': ChargeDist,
+    'point': PointCharge,
+    'arc': ArcCharge,
+    'polyline': ChargePolyline
+}
+
+REQUIRED_KEYS = ('phy_rect', 'mpp', 'down_sampling', 'plots', 'device', 'charges')
+# Keys a client may set, server side settings (e.g. data_path, cpu_plan, stream, table_interp) are not exposed
+OPTIONAL_KEYS = ('ref_point', 'precision', 'cull_tol', 'far_field_ratio', 'resample', 'supersample')
+
+MAX_SCENE_PIXELS = 1 << 26  # image pixels of a scene
+MAX_CHARGE_ROWS = 1 << 12  # charge table rows of a scene (see Charge.get_charge_table)
+MAX_EVENT_JOBS = 256  # ended jobs whose progress events are kept for /jobs/<id>/events
+
+JOB_PATH = re.compile(r'^/jobs/(\d+)(/events|/result\.png|/data)?$')
+
+
+def get_numbers(value, n: int, name: str) -> tuple:
+    numbers = tuple(float(v) for v in value)
+    if len(numbers) != n or not all(np.isfinite(numbers)):
+        raise ValueError('{} has to be {} finite numbers'.format(name, n))
+
+    return numbers
+
+
+def validate_charge(charge) -> None:
+    """
+    Reject charges whose potential is not finite (e.g. zero length segments or edges, zero radius points)
+
+    :raise ValueError: invalid charge
+    """
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rows = charge.get_table_rows()
+
+    if not np.all(np.isfinite(rows)):
+        raise ValueError('Degenerate {} charge (zero length segment or non-finite value)'.format(charge.form))
+    if np.any(rows[:, 10] <= 0):
+        raise ValueError('Charge depth has to be positive')
+    if np.any((rows[:, 11] == Charge.FORM_POINT) & (rows[:, 2] <= 0)):
+        raise ValueError('Point and arc radius has to be positive')
+
+
+def parse_scene(scene: dict) -> dict:
+    """
+    sim_conf of a scene JSON, the scene is a sim_conf (REQUIRED_KEYS and OPTIONAL_KEYS only) whose charges are
+    {'type': 'segment' | 'point' | 'arc' | 'polyline', keyword arguments of the charge class}
+
+    :return: sim_conf
+    :raise ValueError: invalid scene
+    """
+
+    missing = [key for key in REQUIRED_KEYS if key not in scene]
+    if len(missing) != 0:
+        raise ValueError('Missing scene keys : {}'.format(', '.join(missing)))
+    unknown = [key for key in scene if key not in REQUIRED_KEYS + OPTIONAL_KEYS]
+    if len(unknown) != 0:
+        raise ValueError('Unknown scene keys : {}'.format(', '.join(unknown)))
+
+    sim_conf = {key: scene[key] for key in OPTIONAL_KEYS if key in scene}
+    sim_conf['phy_rect'] = get_numbers(scene['phy_rect'], 4, 'phy_rect')
+    ref_point = scene.get('ref_point', None)
+    sim_conf['ref_point'] = get_numbers(ref_point, 2, 'ref_point') if ref_point is not None else None
+
+    sim_conf['mpp'] = float(scene['mpp'])
+    sim_conf['down_sampling'] = int(scene['down_sampling'])
+    if not sim_conf['mpp'] > 0 or sim_conf['down_sampling'] < 1:
+        raise ValueError('mpp has to be positive and down_sampling at least 1')
+    if scene.get('precision', 'float32') not in PRECISIONS:
+        raise ValueError('Unknown precision : {}'.format(scene['precision']))
+    if scene.get('resample', 'nearest') not in Resample.RESAMPLE_METHODS:
+        raise ValueError('Unknown resample method : {}'.format(scene['resample']))
+    if int(scene.get('supersample', 1)) < 1:
+        raise ValueError('supersample has to be at least 1')
+    if scene['device'] not in ('cpu', 'gpu'):
+        raise ValueError('Unknown device : {}'.format(scene['device']))
+    sim_conf['device'] = scene['device']
+
+    if not isinstance(scene['plots'], dict):
+        raise ValueError('plots has to be an object')
+    unknown = [plot for plot in scene['plots'] if plot not in PLOT_MODULES]
+    if len(unknown) != 0:
+        raise ValueError('Unknown plots : {}'.format(', '.join(unknown)))
+    sim_conf['plots'] = scene['plots']
+
+    sizes = Simulation.get_adjusted_size(sim_conf['phy_rect'], sim_conf['down_sampling'], sim_conf['mpp'])
+    n_pixel = sizes['image_size'][0] * sizes['image_size'][1] * int(scene.get('supersample', 1)) ** 2
+    if n_pixel > MAX_SCENE_PIXELS:
+        raise ValueError('Scene of {} pixels, at most {}'.format(n_pixel, MAX_SCENE_PIXELS))
+
+    charges = []
+    n_charge_row = 0
+    for charge in scene['charges']:
+        charge = dict(charge)
+        charge_type = charge.pop('type', 'segment')
+        if charge_type not in CHARGE_TYPES:
+            raise ValueError('Unknown charge type : {}'.format(charge_type))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            charge = CHARGE_TYPES[charge_type](**charge)
+        validate_charge(charge)
+        n_charge_row += len(charge.get_table_rows())
+        charges.append(charge)
+    if n_charge_row > MAX_CHARGE_ROWS:
+        raise ValueError('Scene of {} charge rows, at most {}'.format(n_charge_row, MAX_CHARGE_ROWS))
+    sim_conf['charges'] = charges
+
+    return sim_conf
+
+
+class RenderServer(ThreadingHTTPServer):
+    """
+    Local HTTP front of a JobScheduler (the runners stay warm between requests)
+
+    POST   /jobs                 scene JSON (see parse_scene), optional 'priority' and 'cpu_limit' keys
+                                 -> 202 {'job_id'}
+    GET    /jobs/<id>            status of the job (see Job.get_status)
+    GET    /jobs/<id>/events     progress dicts of the job as server-sent events, until the job ends
+    GET    /jobs/<id>/result.png result image
+    GET    /jobs/<id>/data       raw float32 data (C order, little endian), shape in X-Shape,
+                                 Simulation.get_meta in X-Meta
+    DELETE /jobs/<id>            cancel a queued job or release an ended one
+    GET    /queue                {'depth', 'running'}
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 8765), n_runner: int = 2, cpu_limit: int | None = None,
+                 out_dir: str | None = None):
+        super().__init__(address, RenderRequestHandler)
+        self.out_dir = out_dir if out_dir is not None else tempfile.mkdtemp(prefix='render_')
+        self.out_ids = itertools.count(1)
+
+        self.events: dict = {}  # job_id : list of progress dicts (missing once evicted or removed)
+        self.ended = deque()  # ended jobs holding events, the oldest are evicted beyond MAX_EVENT_JOBS
+        self.queue_status = {'task': 'queue', 'depth': 0, 'running': 0}
+        self.cond = threading.Condition()
+
+        progress_q = Queue()
+        self.scheduler = JobScheduler(n_runner=n_runner, cpu_limit=cpu_limit, progress_q=progress_q)
+        self.dispatcher = threading.Thread(target=self.dispatch, args=(progress_q,), daemon=True)
+        self.dispatcher.start()
+
+    def dispatch(self, progress_q: Queue) -> None:
+        # Fans the scheduler messages out to the event lists of the jobs
+        while True:
+            msg = progress_q.get()
+            if msg is None:
+                return
+
+            with self.cond:
+                if msg['task'] == 'queue':
+                    self.queue_status = msg
+                else:
+                    self.events.setdefault(msg['job_id'], []).append(msg)
+                if msg['task'] == 'job':
+                    self.ended.append(msg['job_id'])
+                    while len(self.ended) > MAX_EVENT_JOBS:
+                        self.events.pop(self.ended.popleft(), None)
+                self.cond.notify_all()
+
+    def submit(self, scene: dict) -> int:
+        scene = dict(scene)
+        priority = scene.pop('priority', 'batch')
+        cpu_limit = scene.pop('cpu_limit', None)
+        sim_conf = parse_scene(scene)
+        out_path = os.path.join(self.out_dir, 'result_{}.png'.format(next(self.out_ids)))
+        job_id = self.scheduler.submit(sim_conf, out_path, priority=priority,
+                                       cpu_limit=int(cpu_limit) if cpu_limit is not None else None)
+
+        with self.cond:
+            job = self.scheduler.jobs.get(job_id)
+            if job is not None and job.state in ('queued', 'running'):
+                self.events.setdefault(job_id, [])
+
+        return job_id
+
+    def server_close(self) -> None:
+        super().server_close()
+        self.scheduler.shutdown()
+        self.scheduler.progress_q.put(None)
+
+
+class RenderRequestHandler(BaseHTTPRequestHandler):
+    server: RenderServer
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def send_json(self, obj, code: int = 200) -> None:
+        body = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, code: int, message: str) -> None:
+        self.send_json({'error': message}, code)
+
+    def get_job_id(self):
+        match = JOB_PATH.match(self.path)
+        if match is None:
+            return None, None
+
+        job_id = int(match.group(1))
+        if job_id not in self.server.scheduler.jobs:
+            return None, None
+
+        return job_id, match.group(2)
+
+    def do_POST(self) -> None:
+        if self.path != '/jobs':
+            self.send_error_json(404, 'Not found')
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            scene = json.loads(self.rfile.read(length))
+            job_id = self.server.submit(scene)
+        except (ValueError, TypeError, KeyError) as e:
+            self.send_error_json(400, str(e))
+            return
+
+        self.send_json({'job_id': job_id}, 202)
+
+    def do_DELETE(self) -> None:
+        job_id, sub = self.get_job_id()
+        if job_id is None or sub is not None:
+            self.send_error_json(404, 'Not found')
+            return
+
+        scheduler = self.server.scheduler
+        if scheduler.cancel(job_id):
+            self.send_json(scheduler.get_status(job_id))
+        elif scheduler.remove(job_id):
+            with self.server.cond:
+                self.server.events.pop(job_id, None)
+            self.send_json({'job_id': job_id, 'state': 'removed'})
+        else:
+            self.send_error_json(409, 'Job is running')
+
+    def do_GET(self) -> None:
+        if self.path == '/queue':
+            with self.server.cond:
+                status = self.server.queue_status
+            self.send_json({'depth': status['depth'], 'running': status['running']})
+            return
+
+        job_id, sub = self.get_job_id()
+        if job_id is None:
+            self.send_error_json(404, 'Not found')
+        elif sub is None:
+            self.send_json(self.server.scheduler.get_status(job_id))
+        elif sub == '/events':
+            self.send_events(job_id)
+        else:
+            self.send_result(job_id, sub)
+
+    def send_events(self, job_id: int) -> None:
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+
+        server = self.server
+        n_sent = 0
+        while True:
+            with server.cond:
+                while job_id in server.events and len(server.events[job_id]) <= n_sent:
+                    server.cond.wait()
+                msgs = server.events[job_id][n_sent:] if job_id in server.events else None
+
+            if msgs is None:
+                # Events evicted (or the job removed), the job has ended
+                job = server.scheduler.jobs.get(job_id)
+                msgs = [{'task': 'job', 'job_id': job_id, 'state': job.state if job is not None else 'removed'}]
+            n_sent += len(msgs)
+
+            for msg in msgs:
+                self.wfile.write('data: {}\n\n'.format(json.dumps(msg)).encode())
+            self.wfile.flush()
+
+            if msgs[-1]['task'] == 'job':
+                return
+
+    def send_result(self, job_id: int, sub: str) -> None:
+        sim = self.server.scheduler.get_simulation(job_id)
+        if sim is None:
+            state = self.server.scheduler.get_status(job_id)['state']
+            if state == 'done':
+                self.send_error_json(410, 'Result released')
+            else:
+                self.send_error_json(409, 'Job is {}'.format(state))
+            return
+
+        if sub == '/result.png':
+            with open(self.server.scheduler.get_status(job_id)['out_paths'][0], 'rb') as f:
+                body = f.read()
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+        else:
+            body = np.ascontiguousarray(sim.data, dtype='<f4').tobytes()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('X-Shape', ','.join(str(v) for v in sim.data.shape))
+            self.send_header('X-Meta', json.dumps(sim.get_meta()))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--runners', type=int, default=2)
+    parser.add_argument('--cpu-limit', type=int, default=None)
+    parser.add_argument('--out-dir', default=None)
+    args = parser.parse_args()
+
+    server = RenderServer((args.host, args.port), n_runner=args.runners, cpu_limit=args.cpu_limit,
+                          out_dir=args.out_dir)
+    print('Serving on http://{}:{} (results in {})'.format(args.host, args.port, server.out_dir))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,96 @@
+from __future__ import annotations
+from typing import Tuple
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from SampleGrid import SampleGrid
+
+import numpy as np
+
+RESAMPLE_METHODS = ('nearest', 'bilinear', 'bicubic')
+
+# Data rows beyond the nearest one read by the interpolation
+RESAMPLE_HALO = {
+    'nearest': 0,
+    'bilinear': 1,
+    'bicubic': 2
+}
+
+
+def get_weights(pos: np.ndarray, n: int, method: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Interpolation taps of positions pos along an axis of n samples (clamped at the edges)
+
+    :return: indices (n_tap, n_pos), weights (n_tap, n_pos)
+    """
+
+    base = np.floor(pos)
+    t = pos - base
+    base = base.astype(np.intp)
+
+    if method == 'bilinear':
+        offsets = (0, 1)
+        weights = np.stack((1 - t, t))
+    elif method == 'bicubic':
+        # Catmull-Rom (Keys, a = -0.5)
+        offsets = (-1, 0, 1, 2)
+        t2 = t * t
+        t3 = t2 * t
+        weights = np.stack((-0.5 * t3 + t2 - 0.5 * t,
+                            1.5 * t3 - 2.5 * t2 + 1,
+                            -1.5 * t3 + 2 * t2 + 0.5 * t,
+                            0.5 * t3 - 0.5 * t2))
+    else:
+        raise ValueError('Unknown resample method : {}'.format(method))
+
+    indices = np.stack([np.clip(base + offset, 0, n - 1) for offset in offsets])
+
+    return indices, weights
+
+
+def upsample_rows(data: np.ndarray, grid: SampleGrid, st_img: int, en_img: int, method: str) -> np.ndarray:
+    """
+    Potential at the pixels of image rows st_img ~ en_img (inclusive), the pixel centers are given
+    by grid (see SampleGrid.get_img_pos, down_sampling pixels per sample)
+
+    :param data: (n_row, n_col) samples on grid
+    :param method: 'nearest' (blocks of identical pixels), 'bilinear' or 'bicubic'
+    :return: (en_img - st_img + 1, n_img_col) array
+    """
+
+    n_row, n_col = data.shape
+    row_pos = grid.get_img_pos(st_img, en_img)
+    col_pos = grid.get_img_pos(0, n_col * grid.down_sampling - 1)
+
+    if method == 'nearest':
+        rows = np.clip(np.floor(row_pos + 0.5).astype(np.intp), 0, n_row - 1)
+        cols = np.clip(np.floor(col_pos + 0.5).astype(np.intp), 0, n_col - 1)
+        return data[rows[:, None], cols[None, :]]
+
+    row_idx, row_w = get_weights(row_pos, n_row, method)
+    col_idx, col_w = get_weights(col_pos, n_col, method)
+
+    # Separable : along the rows, then along the columns
+    tmp = np.zeros((row_idx.shape[1], n_col), dtype=np.float64)
+    for idx, w in zip(row_idx, row_w):
+        tmp += w[:, None] * data[idx]
+
+    res = np.zeros((row_idx.shape[1], col_idx.shape[1]), dtype=np.float64)
+    for idx, w in zip(col_idx, col_w):
+        res += tmp[:, idx] * w[None, :]
+
+    return res
+
+
+def block_average_rows(data: np.ndarray, st_img: int, en_img: int, factor: int) -> np.ndarray:
+    """
+    Potential at the pixels of image rows st_img ~ en_img (inclusive), the image being the mean of
+    factor x factor sample blocks of data (supersampling)
+
+    :return: (en_img - st_img + 1, n_col // factor) array
+    """
+
+    rows = data[st_img * factor:(en_img + 1) * factor].astype(np.float64)
+    n_row, n_col = rows.shape
+
+    return rows.reshape(n_row // factor, factor, n_col // factor, factor).mean(axis=(1, 3))
@@ -0,0 +1,84 @@
+from __future__ import annotations
+from typing import Tuple
+
+import numpy as np
+
+
+class SampleGrid:
+    """
+    Physical coordinates of the data samples, built once as 1D axes
+    x[col_idx] and y[row_idx] (y decreases with the row index), broadcast into 2D on demand
+
+    phy_rect is the rect of the outermost sample points, full_phy_rect the rect of the outermost image pixels
+    (see Simulation.get_adjusted_size), image pixels are down_sampling x down_sampling per sample,
+    or supersample x supersample samples per image pixel.
+    """
+
+    def __init__(self,
+                 phy_rect: Tuple[float, float, float, float],
+                 shape: Tuple[int, int],
+                 dtype=np.float64,
+                 full_phy_rect: Tuple[float, float, float, float] | None = None,
+                 down_sampling: int = 1,
+                 supersample: int = 1):
+        self.phy_rect = tuple(float(v) for v in phy_rect)
+        self.full_phy_rect = tuple(float(v) for v in (full_phy_rect if full_phy_rect is not None else phy_rect))
+        self.shape = tuple(shape)
+        self.dtype = dtype
+        self.down_sampling = down_sampling
+        self.supersample = supersample
+
+        n_row, n_col = self.shape
+        phy_rect = np.array(phy_rect, dtype=dtype)
+        self.x = phy_rect[0] + (phy_rect[2] - phy_rect[0]) * np.arange(n_col) / (n_col - 1)
+        self.y = phy_rect[1] - (phy_rect[1] - phy_rect[3]) * np.arange(n_row) / (n_row - 1)
+        self.x = self.x.astype(dtype)
+        self.y = self.y.astype(dtype)
+
+    @classmethod
+    def from_sizes(cls, sizes: dict, down_sampling: int, dtype=np.float64, supersample: int = 1) -> SampleGrid:
+        """
+        Grid of the result of Simulation.get_adjusted_size
+        """
+
+        return cls(sizes['adj_phy_rect'], sizes['data_shape'], dtype=dtype,
+                   full_phy_rect=sizes['full_adj_phy_rect'], down_sampling=down_sampling, supersample=supersample)
+
+    def key(self) -> tuple:
+        return (*self.phy_rect, *self.shape, np.dtype(self.dtype).str)
+
+    def mesh(self, st_row: int = 0, en_row: int | None = None,
+             st_col: int = 0, en_col: int | None = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Sample coordinates of rows st_row ~ en_row and columns st_col ~ en_col (inclusive)
+
+        :return: x (1, n_col) and y (n_row, 1) views, broadcast together to 2D
+        """
+
+        en_row = self.shape[0] - 1 if en_row is None else en_row
+        en_col = self.shape[1] - 1 if en_col is None else en_col
+
+        return self.x[None, st_col:en_col + 1], self.y[st_row:en_row + 1, None]
+
+    def get_index(self, x, y) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Nearest sample of (arrays of) physical positions, clipped to the grid
+
+        :return: row index, col index
+        """
+
+        n_row, n_col = self.shape
+        col = np.rint((np.asarray(x) - self.phy_rect[0]) / (self.phy_rect[2] - self.phy_rect[0]) * (n_col - 1))
+        row = np.rint((self.phy_rect[1] - np.asarray(y)) / (self.phy_rect[1] - self.phy_rect[3]) * (n_row - 1))
+
+        return np.clip(row, 0, n_row - 1).astype(np.int64), np.clip(col, 0, n_col - 1).astype(np.int64)
+
+    def get_img_pos(self, st_img: int, en_img: int) -> np.ndarray:
+        """
+        Centers of the image pixels st_img ~ en_img (inclusive, rows or columns) in sample index units
+        (x[0] + pos * (x[1] - x[0]) is the physical coordinate, the outermost ones lie on full_phy_rect)
+
+        :return: (en_img - st_img + 1,) array
+        """
+
+        return (np.arange(st_img, en_img + 1) + 0.5) * self.supersample / self.down_sampling - 0.5
@@ -3,20 +3,59 @@ from typing import Tuple
 from typing import TYPE_CHECKING
 
 if TYPE_CHECKING:
-    from queue import Queue
     from Charge import ChargeDist
 
+import asyncio
+import json
+import math
+import os
+import threading
+import time
+from queue import Queue
+
 import numpy as np
 from PIL import Image
 
-from Calc import Calc
+from Autotune import Autotuner
+from Calc import Calc, PRECISIONS
+from Charge import get_charges_key, get_unique_charges
+import DataExport
+from DevicePool import DevicePool
+from PngStreamWriter import PngStreamWriter
+from PotentialHistogram import PotentialHistogram
+import Resample
+from SampleGrid import SampleGrid
+from TileWriter import TileWriter
 
 import plots.potential_color as potential_color
 import plots.potential_contour as potential_contour
 
+PLOT_MODULES = {
+    'potential_color': potential_color,
+    'potential_contour': potential_contour
+}
+
+STREAM_COARSE = 8  # data rows and columns per sample of the coarse pass estimating the color scale
+STREAM_QUEUE_SIZE = 4  # image bands waiting for the encoder
+RESAMPLE_BAND_ROWS = 256  # image rows per band of the resampled plots
+
+
+class AsyncProgressQueue:
+    """
+    progress_q of a run in a worker thread, forwarding the messages to an asyncio.Queue of the event loop
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue()
+
+    def put(self, msg) -> None:
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, msg)
+
 
 class Simulation:
-    def __init__(self, conf: dict):
+    def __init__(self, conf: dict, device_pool: DevicePool | None = None):
+        self.conf = conf
         self.charges: Tuple[ChargeDist] = conf['charges']
         self.phy_rect: Tuple[float, float, float, float] = conf['phy_rect']
         self.full_phy_rect: Tuple[float, float, float, float] = (0, 0, 0, 0)
@@ -24,13 +63,50 @@ class Simulation:
         self.down_sampling: int = conf['down_sampling']
         self.plots: dict = conf['plots']
         self.device = conf['device']
+        self.precision: str = conf.get('precision', 'float32')  # 'float32', 'float64' or 'mixed'
+
+        # Pipelined run : row bands flow through the plots into a streaming PNG encoder while later
+        # bands compute, the full image is never allocated.
+        # The color scale is fixed before the first band : without plots['potential_color']['max_abs'] it is
+        # taken from a coarse pass (1 / STREAM_COARSE of the rows and columns) when data has to be computed,
+        # so the image can differ from the one of a non streamed run (finer extremes saturate).
+        # Give max_abs for the same image as run() without stream.
+        self.stream: bool = conf.get('stream', False)
+
+        # data is computed directly into a memory mapped .npy file at data_path if given
+        # (the metadata sidecar is written after each run, see DataExport)
+        self.data_path: str | None = conf.get('data_path', None)
+
+        # Potential at the image pixels : data upscaled by down_sampling with resample
+        # ('nearest' : blocks of identical pixels, 'bilinear', 'bicubic'),
+        # or the mean of supersample x supersample samples per pixel (anti-aliasing, down_sampling has to be 1)
+        self.resample: str = conf.get('resample', 'nearest')
+        self.supersample: int = conf.get('supersample', 1)
+        if self.resample not in Resample.RESAMPLE_METHODS:
+            raise ValueError('Unknown resample method : {}'.format(self.resample))
+        if self.supersample != 1 and self.down_sampling != 1:
+            raise ValueError('supersample needs down_sampling 1')
 
         self.__init_data()
+        # Device buffers kept resident across stages and runs (a long lived owner, e.g. a JobScheduler runner,
+        # may pass its pool to keep them across simulations)
+        self.device_pool = device_pool if device_pool is not None else DevicePool()
         self.calc: Calc = Calc(charges=self.charges,
                                phy_rect=self.phy_rect,
                                data=self.data,
                                ref_point=conf['ref_point'],
-                               device=self.device)
+                               device=self.device,
+                               precision=self.precision,
+                               device_pool=self.device_pool,
+                               cpu_plan=conf.get('cpu_plan', 'auto'),
+                               cull_tol=conf.get('cull_tol', None),
+                               far_field_ratio=conf.get('far_field_ratio', None),
+                               table_interp=conf.get('table_interp', None),
+                               grid=self.grid,
+                               collect_histogram=potential_color.needs_histogram(self.plots))
+        self.data_key: tuple | None = None  # charges key of the potential held in data
+        self.data_range: Tuple[float, float] | None = None  # (min, max) of data, reduced by Calc
+        self.histogram: PotentialHistogram | None = None  # histogram of data collected by Calc
 
     def __init_data(self) -> None:
         """
@@ -43,18 +119,39 @@ class Simulation:
 
         # Adjust physical rect and get data shape
         sizes = Simulation.get_adjusted_size(self.phy_rect, self.down_sampling, self.mpp)
+        if self.supersample != 1:
+            # Samples at the centers of the supersample x supersample sub pixels
+            ss = self.supersample
+            margin = (ss - 1) / (2 * ss) * self.mpp
+            img_rect = sizes['adj_phy_rect']
+            sizes['adj_phy_rect'] = (img_rect[0] - margin, img_rect[1] + margin,
+                                     img_rect[2] + margin, img_rect[3] - margin)
+            sizes['data_shape'] = (sizes['data_shape'][0] * ss, sizes['data_shape'][1] * ss)
         self.phy_rect = sizes['adj_phy_rect']
         self.full_phy_rect = sizes['full_adj_phy_rect']
-        n_data_row, n_data_col = sizes['data_shape']
 
         # Init data array
-        self.data = np.zeros(sizes['data_shape'], dtype=np.float32)
+        if self.precision not in PRECISIONS:
+            raise ValueError('Unknown precision : {}'.format(self.precision))
+        storage_dtype, calc_dtype = PRECISIONS[self.precision]
+        if self.data_path is not None:
+            self.data = DataExport.create_npy_memmap(self.data_path, sizes['data_shape'], storage_dtype)
+        else:
+            self.data = np.zeros(sizes['data_shape'], dtype=storage_dtype)
 
-        # Init image array
-        n_img_row = n_data_row * self.down_sampling
-        n_img_col = n_data_col * self.down_sampling
-        self.img = np.zeros((n_img_row, n_img_col, 3), dtype=np.uint8)
-        self.img.fill(255)
+        # Sample coordinates shared by Calc, probes and plots
+        self.grid = SampleGrid.from_sizes(sizes, self.down_sampling, dtype=calc_dtype, supersample=self.supersample)
+
+        # Init image array (not held in streaming mode)
+        self.img: np.ndarray | None = None
+        if not self.stream:
+            self.img = np.zeros((*self.get_img_shape(), 3), dtype=np.uint8)
+            self.img.fill(255)
+
+    def get_img_shape(self) -> Tuple[int, int]:
+        n_data_row, n_data_col = self.data.shape
+        return (n_data_row * self.down_sampling // self.supersample,
+                n_data_col * self.down_sampling // self.supersample)
 
     @staticmethod
     def get_adjusted_size(phy_rect: Tuple[float, float, float, float], down_sampling: int, mpp: float) -> dict:
@@ -116,13 +213,237 @@ class Simulation:
             'full_adj_phy_rect': full_adj_phy_rect
         }
 
+    def set_ref_point(self, ref_point: Tuple[float, float] | None) -> None:
+        """
+        Change the reference point of the potential
+        The next run re-renders the plots without recomputing data
+
+        :param ref_point: point of zero potential (None for infinity)
+        :return: None
+        """
+
+        self.calc.ref_point = ref_point
+
+    def set_plots(self, plots: dict) -> None:
+        """
+        Change the plots (e.g. the 'norm' or 'percentile' of potential_color)
+        The next run re-colors the cached data without recomputing it
+        (a new 'percentile' scale reads data once, later Calc runs collect its histogram)
+
+        :param plots: plots of the conf
+        :return: None
+        """
+
+        self.plots = plots
+        self.calc.collect_histogram = potential_color.needs_histogram(plots)
+
+    def calc_batch(self, charge_sets: list, progress_q: Queue, verbose: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Potential of several charge sets (scenes) on the grid of this simulation in one Calc pass
+        Charges shared by scenes are evaluated once per pixel (see Charge.get_unique_charges),
+        sample coordinates, workers and device buffers are shared by all scenes.
+        data and img of the simulation are not touched.
+
+        :param charge_sets: list of charge lists
+        :param progress_q: queue for sending progress info (see run)
+        :param verbose: print running information
+        :return: data (n_scene, n_row, n_col) referenced to infinity, potential at ref_point of each scene
+        """
+
+        charges, membership = get_unique_charges(charge_sets)
+        data = np.zeros((len(charge_sets),) + self.data.shape, dtype=self.data.dtype)
+
+        calc = Calc(charges=charges,
+                    phy_rect=self.phy_rect,
+                    data=data,
+                    ref_point=self.calc.ref_point,
+                    device=self.device,
+                    precision=self.precision,
+                    device_pool=self.device_pool,
+                    cpu_plan=self.calc.cpu_plan,
+                    cull_tol=self.calc.cull_tol,
+                    far_field_ratio=self.calc.far_field_ratio,
+                    table_interp=self.calc.table_interp,
+                    membership=membership,
+                    grid=self.grid)
+        calc.tables = self.calc.tables
+        calc.do(progress_q, verbose=verbose)
+
+        return data, calc.get_ref_potential()
+
+    def probe(self, x, y):
+        """
+        Potential (referenced to ref_point) at the nearest samples of (arrays of) physical positions
+        Reads data, run has to be called first
+        """
+
+        row_idx, col_idx = self.grid.get_index(x, y)
+        return self.data[row_idx, col_idx] - self.calc.get_ref_potential()
+
+    def get_meta(self) -> dict:
+        """
+        Metadata of data (data is referenced to infinity, subtract ref_potential for ref_point)
+
+        :return: JSON serializable dict
+        """
+
+        ref_point = self.calc.ref_point
+        return {
+            'shape': list(self.data.shape),
+            'dtype': self.data.dtype.str,
+            'phy_rect': [float(v) for v in self.phy_rect],
+            'full_phy_rect': [float(v) for v in self.full_phy_rect],
+            'mpp': self.mpp,
+            'down_sampling': self.down_sampling,
+            'resample': self.resample,
+            'supersample': self.supersample,
+            'ref_point': list(ref_point) if ref_point is not None else None,
+            'ref_potential': self.calc.get_ref_potential(),
+            'precision': self.precision
+        }
+
+    def export(self, path: str, fmt: str = 'npy') -> None:
+        """
+        Save data and its metadata
+
+        :param path: file path ('npy', metadata in path + '.json') or directory ('zarr')
+        :param fmt: 'npy' (memory mappable) or 'zarr' (zarr v2 layout, zlib compressed chunks)
+        :return: None
+        """
+
+        if fmt == 'npy':
+            DataExport.save_npy(path, self.data, self.get_meta())
+        elif fmt == 'zarr':
+            DataExport.save_zarr(path, self.data, self.get_meta())
+        else:
+            raise ValueError('Unknown export format : {}'.format(fmt))
+
+    def run_pyramid(self, progress_q: Queue, out_dir: str, tile_size: int = 256, verbose: bool = True) -> dict:
+        """
+        Write a zoomable tile pyramid instead of one image
+
+        Level n_level - 1 is sampled at mpp, level z at mpp * 2 ** (n_level - 1 - z), level 0 is about one tile.
+        Every level is computed from the potential at its own sample spacing (get_adjusted_size of its mpp)
+        and streamed into out_dir/{level}/{col}_{row}.png tiles (see TileWriter), the full resolution level
+        fills data as run does.
+        The size of a level is the one of get_adjusted_size at its mpp (an even sample count covering phy_rect),
+        not an exact half of the next level, so the width and height of every level are in the description.
+        All levels share one color scale, plots['potential_color']['max_abs'] if given,
+        else the scale of level 0 (see potential_color.get_scale).
+        out_dir/pyramid.json holds the returned description.
+
+        :param progress_q: queue of the progress dicts of run, plus {'task': 'pyramid', ...} after each level
+        :param out_dir: output directory
+        :param tile_size: tile width and height in pixels
+        :param verbose: print running information
+        :return: {'tile_size', 'tile_path', 'max_abs', 'ref_potential', 'levels': [{'level', 'mpp', 'phy_rect', ...}]}
+        """
+
+        st_tm = time.time()
+        sizes = Simulation.get_adjusted_size(self.conf['phy_rect'], self.down_sampling, self.mpp)
+        n_img = max(sizes['image_size'])
+        n_level = max(0, math.ceil(math.log2(n_img / tile_size))) + 1
+
+        max_abs = self.plots.get('potential_color', {}).get('max_abs', None)
+        level_pool = DevicePool()  # coarse levels stay out of the buffers of this simulation
+        levels = []
+        for level in range(n_level):
+            scale = 2 ** (n_level - 1 - level)
+            if scale == 1:
+                sim = self
+            else:
+                level_conf = dict(self.conf, mpp=self.mpp * scale, stream=True, data_path=None)
+                sim = Simulation(level_conf, device_pool=level_pool)
+
+            if max_abs is None:
+                data_key = get_charges_key(sim.charges)
+                if data_key != sim.data_key:
+                    sim.calc.do(progress_q, verbose=verbose)
+                    sim.data_key = data_key
+                    sim.data_range = sim.calc.data_range
+                    sim.histogram = sim.calc.histogram
+                max_abs = sim.__get_stream_max_abs(sim.calc.get_ref_potential(), False)
+
+            n_img_row, n_img_col = sim.get_img_shape()
+            writer = TileWriter(os.path.join(out_dir, str(level)), n_img_col, n_img_row, tile_size)
+            sim.__run_stream(progress_q, '', verbose, writer=writer, max_abs=max_abs)
+
+            levels.append({
+                'level': level,
+                'mpp': sim.mpp,
+                'phy_rect': [float(v) for v in sim.phy_rect],
+                'full_phy_rect': [float(v) for v in sim.full_phy_rect],
+                'width': n_img_col,
+                'height': n_img_row,
+                'n_tile_col': writer.n_tile_col,
+                'n_tile_row': writer.n_tile_row
+            })
+
+            progress = (level + 1) / n_level * 100
+            el_tm = time.time() - st_tm
+            progress_q.put({
+                'task': 'pyramid',
+                'progress': progress,
+                'el_tm': el_tm,
+                'est_tm': 100 / progress * el_tm
+            })
+
+        pyramid = {
+            'tile_size': tile_size,
+            'tile_path': '{level}/{col}_{row}.png',
+            'max_abs': max_abs,
+            'ref_potential': self.calc.get_ref_potential(),
+            'levels': levels
+        }
+        with open(os.path.join(out_dir, 'pyramid.json'), 'w') as f:
+            json.dump(pyramid, f, indent=2)
+
+        return pyramid
+
+    async def run_async(self, out_path: str = 'result.png', verbose: bool = False, executor=None):
+        """
+        Run the simulation in executor (default executor of the loop if None) without blocking the event loop
+
+            async for msg in sim.run_async(out_path):
+                ...
+
+        Errors of the run are raised by the iterator after the last message.
+        Leaving the loop early does not stop the run.
+
+        :param out_path: path of an output file
+        :param verbose: print running information
+        :param executor: concurrent.futures executor running Simulation.run
+        :return: async iterator of the progress dicts of run
+        """
+
+        loop = asyncio.get_running_loop()
+        progress_q = AsyncProgressQueue(loop)
+        future = loop.run_in_executor(executor, self.run, progress_q, out_path, verbose)
+        # Scheduled after every message put by the run
+        future.add_done_callback(lambda _: progress_q.queue.put_nowait(None))
+
+        while True:
+            msg = await progress_q.queue.get()
+            if msg is None:
+                break
+            yield msg
+
+        await future
+
+    def __sync_data_path(self) -> None:
+        if self.data_path is not None:
+            self.data.flush()
+            DataExport.save_meta(self.data_path, self.get_meta())
+
     def run(self, progress_q: Queue, out_path: str = 'result.png', verbose: bool = True) -> None:
         """
         Run the simulation and save result image at out_path
+        data holds the potential referenced to infinity and is only recomputed when the charges change,
+        the ref_point offset is folded into the plots
 
         :param progress_q: queue for sending progress info to gui thread
                            e.g. {'task': 'calc', 'progress': 25.1, 'el_tm': 1.03, 'est_tm': 11.7}
-                                task: current task (e.g. 'calc', 'potential_color', 'potential_contour')
+                                task: current task (e.g. 'calc', 'potential_color', 'potential_contour', 'encode')
                                 progress: percentage of progress (out of 100)
                                 el_tm: elapsed time,
                                 est_tm: estimated time to done
@@ -131,20 +452,247 @@ class Simulation:
         :return: None
         """
 
+        if self.stream is True:
+            self.__run_stream(progress_q, out_path, verbose)
+            return
+
         # Fill data array
-        self.calc.do(progress_q, verbose=verbose)
+        data_key = get_charges_key(self.charges)
+        if data_key != self.data_key:
+            self.calc.do(progress_q, verbose=verbose)
+            self.data_key = data_key
+            self.data_range = self.calc.data_range
+            self.histogram = self.calc.histogram
+        ref_potential = self.calc.get_ref_potential()
 
         # Pile up plots
-        plot_module = {
-            'potential_color': potential_color,
-            'potential_contour': potential_contour
-        }
-        for plot, conf in self.plots.items():
-            if self.device == 'cpu':
-                plot_module[plot].cpu(self.img, self.data, conf)
-            elif self.device == 'gpu':
-                plot_module[plot].gpu(self.img, self.data, conf)
+        if self.resample != 'nearest' or self.supersample != 1:
+            self.__plot_resampled(ref_potential)
+        else:
+            plot_module = PLOT_MODULES
+            if self.device == 'gpu':
+                # data is already resident after Calc, the image is initialised on the device
+                self.device_pool.to_device('data', self.data, key=self.calc.get_data_key())
+                self.device_pool.get('img', self.img.shape, self.img.dtype)
+                self.device_pool.fill('img', 255)
+            else:
+                self.img.fill(255)
+
+            for plot, conf in self.plots.items():
+                if plot == 'potential_color' and self.device == 'cpu':
+                    plot_module[plot].cpu(self.img, self.data, conf, ref_potential,
+                                          data_range=self.data_range, histogram=self.histogram)
+                elif plot == 'potential_color' and self.device == 'gpu':
+                    plot_module[plot].gpu(self.img, self.data, conf, ref_potential, pool=self.device_pool,
+                                          data_range=self.data_range, histogram=self.histogram)
+                elif self.device == 'cpu':
+                    plot_module[plot].cpu(self.img, self.data, conf, ref_potential)
+                elif self.device == 'gpu':
+                    plot_module[plot].gpu(self.img, self.data, conf, ref_potential, pool=self.device_pool)
+
+            if self.device == 'gpu':
+                self.device_pool.buffers['img'].copy_to_host(self.img)
+
+        self.__sync_data_path()
 
         # Save image
         res = Image.fromarray(self.img)
         res.save(out_path)
+
+    def __get_pixels(self, st_img: int, en_img: int) -> np.ndarray:
+        """
+        Potential at the pixels of image rows st_img ~ en_img (inclusive), see resample and supersample
+        """
+
+        if self.supersample != 1:
+            return Resample.block_average_rows(self.data, st_img, en_img, self.supersample)
+
+        return Resample.upsample_rows(self.data, self.grid, st_img, en_img, self.resample)
+
+    def __get_needed_data_rows(self) -> np.ndarray:
+        """
+        Last data row read by the pixels of each image row
+
+        :return: (n_img_row,) array
+        """
+
+        n_row = self.data.shape[0]
+        n_img_row = self.get_img_shape()[0]
+        if self.supersample != 1:
+            return (np.arange(n_img_row) + 1) * self.supersample - 1
+
+        pos = self.grid.get_img_pos(0, n_img_row - 1)
+        if self.resample == 'nearest':
+            return np.floor(pos + 0.5).astype(np.intp)
+
+        return np.minimum(np.floor(pos).astype(np.intp) + Resample.RESAMPLE_HALO[self.resample], n_row - 1)
+
+    def __plot_img_rows(self, img: np.ndarray, st_img: int, en_img: int, ref_potential: float,
+                        max_abs: float) -> None:
+        """
+        Plot image rows st_img ~ en_img into img (which holds those rows) from the pixel potential,
+        the pixels of image row en_img + 1 are read as the bottom neighbour of the contour
+        """
+
+        pixels = self.__get_pixels(st_img, min(en_img + 1, self.get_img_shape()[0] - 1))
+        for plot, conf in self.plots.items():
+            if plot == 'potential_color':
+                PLOT_MODULES[plot].cpu_rows(img, pixels, 0, en_img - st_img, conf, ref_potential, max_abs)
+            else:
+                PLOT_MODULES[plot].cpu_rows(img, pixels, 0, en_img - st_img, conf, ref_potential)
+
+    def __plot_resampled(self, ref_potential: float) -> None:
+        # Resampled plots run on cpu for both devices, band by band to bound the pixel potential buffer
+        max_abs = potential_color.get_scale(self.data, self.plots.get('potential_color', {}), ref_potential,
+                                            self.data_range, self.histogram)
+        n_img_row = self.img.shape[0]
+
+        self.img.fill(255)
+        for st_img in range(0, n_img_row, RESAMPLE_BAND_ROWS):
+            en_img = min(st_img + RESAMPLE_BAND_ROWS, n_img_row) - 1
+            self.__plot_img_rows(self.img[st_img:en_img + 1], st_img, en_img, ref_potential, max_abs)
+
+    def __run_stream(self, progress_q: Queue, out_path: str, verbose: bool,
+                     writer: PngStreamWriter | TileWriter | None = None, max_abs: float | None = None) -> None:
+        """
+        Pipelined run : Calc (and its workers) -> plot thread -> encoder thread
+        Finished data rows are colored and contoured band by band in row order and written by PngStreamWriter,
+        so the wall time approaches max(compute, encode) instead of their sum.
+        The plots run on cpu for both devices (on gpu the kernel delivers the grid at once).
+
+        The color scale has to be known before the first band, it is taken from
+        plots['potential_color']['max_abs'] if given, from data (or its percentile) if it is up to date,
+        otherwise from a coarse pass (values beyond it saturate), unless max_abs is given
+
+        :param writer: sink of the image rows (PngStreamWriter at out_path if None)
+        """
+
+        data_key = get_charges_key(self.charges)
+        recompute = data_key != self.data_key
+        ref_potential = self.calc.get_ref_potential()
+        if max_abs is None:
+            max_abs = self.__get_stream_max_abs(ref_potential, recompute)
+        if writer is None:
+            n_img_row, n_img_col = self.get_img_shape()
+            writer = PngStreamWriter(out_path, n_img_col, n_img_row)
+
+        band_q = Queue()
+        img_q = Queue(maxsize=STREAM_QUEUE_SIZE)
+        errors = []
+        plot_th = threading.Thread(target=self.__stream_plots, args=(band_q, img_q, ref_potential, max_abs, errors))
+        encode_th = threading.Thread(target=self.__stream_encode, args=(img_q, writer, progress_q, errors))
+        plot_th.start()
+        encode_th.start()
+
+        try:
+            if recompute:
+                self.calc.do(progress_q, verbose=verbose, band_q=band_q)
+                self.data_key = data_key
+                self.data_range = self.calc.data_range
+                self.histogram = self.calc.histogram
+            else:
+                band_q.put((0, self.data.shape[0] - 1))
+        finally:
+            band_q.put(None)
+            plot_th.join()
+            encode_th.join()
+
+        if len(errors) != 0:
+            raise errors[0]
+
+        self.__sync_data_path()
+
+    def __get_stream_max_abs(self, ref_potential: float, recompute: bool) -> float:
+        color_conf = self.plots.get('potential_color', {})
+        if 'max_abs' in color_conf:
+            return float(color_conf['max_abs'])
+
+        if recompute:
+            n_row, n_col = self.data.shape
+            coarse = np.zeros((max(2, n_row // STREAM_COARSE), max(2, n_col // STREAM_COARSE)), dtype=self.data.dtype)
+            coarse_calc = Calc(charges=self.charges,
+                               phy_rect=self.phy_rect,
+                               data=coarse,
+                               ref_point=self.calc.ref_point,
+                               device='cpu',
+                               precision=self.precision,
+                               cpu_plan=Autotuner.get_default_plan(coarse.shape[0]),
+                               cull_tol=self.calc.cull_tol,
+                               far_field_ratio=self.calc.far_field_ratio,
+                               table_interp=self.calc.table_interp,
+                               collect_histogram=self.calc.collect_histogram)
+            coarse_calc.do(Queue(), verbose=False)
+            return potential_color.get_scale(coarse, color_conf, ref_potential,
+                                             coarse_calc.data_range, coarse_calc.histogram)
+
+        return potential_color.get_scale(self.data, color_conf, ref_potential, self.data_range, self.histogram)
+
+    def __stream_plots(self, band_q: Queue, img_q: Queue, ref_potential: float, max_abs: float,
+                       errors: list) -> None:
+        n_row = self.data.shape[0]
+        n_img_row, n_img_col = self.get_img_shape()
+        needed = self.__get_needed_data_rows()  # last data row read by each image row
+        done = np.zeros(n_row, dtype=bool)
+        next_img = 0  # first image row not plotted yet
+
+        try:
+            while next_img < n_img_row:
+                band = band_q.get()
+                if band is None:
+                    break
+                done[band[0]:band[1] + 1] = True
+
+                # Plot the image rows whose pixels and bottom neighbour (contour) read only the finished prefix
+                n_prefix = int(np.argmin(done)) if not np.all(done) else n_row
+                if n_prefix == n_row:
+                    en_img = n_img_row - 1
+                else:
+                    en_img = int(np.searchsorted(needed, n_prefix)) - 2
+                if en_img < next_img:
+                    continue
+
+                img = np.zeros((en_img - next_img + 1, n_img_col, 3), dtype=np.uint8)
+                img.fill(255)
+                self.__plot_img_rows(img, next_img, en_img, ref_potential, max_abs)
+
+                img_q.put(img)
+                next_img = en_img + 1
+        except Exception as e:
+            errors.append(e)
+        finally:
+            img_q.put(None)
+
+    def __stream_encode(self, img_q: Queue, writer: PngStreamWriter | TileWriter, progress_q: Queue,
+                        errors: list) -> None:
+        st_tm = time.time()
+        n_img_row = self.get_img_shape()[0]
+
+        finished = False
+        closed = False
+        try:
+            while True:
+                rows = img_q.get()
+                if rows is None:
+                    finished = True
+                    break
+                writer.write_rows(rows)
+
+                progress = writer.n_written_row / n_img_row * 100
+                el_tm = time.time() - st_tm
+                progress_q.put({
+                    'task': 'encode',
+                    'progress': progress,
+                    'el_tm': el_tm,
+                    'est_tm': 100 / progress * el_tm
+                })
+            writer.close()
+            closed = True
+        except Exception as e:
+            errors.append(e)
+            # Keep draining so that the plot thread never blocks on a full queue
+            while not finished and img_q.get() is not None:
+                pass
+        finally:
+            if not closed:
+                # No truncated image left behind
+                writer.abort()
@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+import os
+
+import numpy as np
+from PIL import Image
+
+
+class TileWriter:
+    """
+    RGB image written row band by row band as tile_size x tile_size PNG tiles
+    out_dir/{col}_{row}.png (edge tiles are cropped to the image)
+    Same interface as PngStreamWriter, only one row of tiles is held in memory.
+    """
+
+    def __init__(self, out_dir: str, width: int, height: int, tile_size: int = 256):
+        self.out_dir = out_dir
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        self.n_written_row = 0
+
+        self.bands: list = []  # rows of the current tile row
+        self.n_band_row = 0
+        self.tile_row = 0
+        os.makedirs(out_dir, exist_ok=True)
+
+    def __enter__(self) -> TileWriter:
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+
+    @property
+    def n_tile_col(self) -> int:
+        return -(-self.width // self.tile_size)
+
+    @property
+    def n_tile_row(self) -> int:
+        return -(-self.height // self.tile_size)
+
+    def write_rows(self, rows: np.ndarray) -> None:
+        """
+        Append rows to the image
+
+        :param rows: (n_row, width, 3) uint8 array
+        :return: None
+        """
+
+        if rows.shape[1:] != (self.width, 3):
+            raise ValueError('Rows of shape {} do not match the image width {}'.format(rows.shape, self.width))
+        if self.n_written_row + rows.shape[0] > self.height:
+            raise ValueError('More than {} rows written'.format(self.height))
+
+        self.bands.append(rows)
+        self.n_band_row += rows.shape[0]
+        self.n_written_row += rows.shape[0]
+        while self.n_band_row >= self.tile_size:
+            self.flush_tile_row(self.tile_size)
+
+    def flush_tile_row(self, n_row: int) -> None:
+        buf = np.concatenate(self.bands, axis=0) if len(self.bands) != 1 else self.bands[0]
+        for tile_col in range(self.n_tile_col):
+            tile = buf[:n_row, tile_col * self.tile_size:(tile_col + 1) * self.tile_size]
+            path = os.path.join(self.out_dir, '{}_{}.png'.format(tile_col, self.tile_row))
+            Image.fromarray(np.ascontiguousarray(tile)).save(path)
+
+        self.bands = [buf[n_row:]] if buf.shape[0] != n_row else []
+        self.n_band_row -= n_row
+        self.tile_row += 1
+
+    def close(self) -> None:
+        if self.n_written_row != self.height:
+            raise ValueError('{} of {} rows written'.format(self.n_written_row, self.height))
+
+        if self.n_band_row != 0:
+            self.flush_tile_row(self.n_band_row)
+
+    def abort(self) -> None:
+        """
+        Drop the rows of the unfinished tile row (the tiles already written are kept)
+        """
+
+        self.bands = []
+        self.n_band_row = 0
@@ -0,0 +1,199 @@
+import argparse
+import time
+from queue import Queue
+
+import numpy as np
+
+from Simulation import Simulation
+from Calc import PRECISIONS
+from Charge import ChargeDist
+
+
+def get_sim_conf(device: str, mpp: float) -> dict:
+    return {
+        'phy_rect': (-0.4, 0.4, 0.4, -0.4),
+        'mpp': mpp,
+        'down_sampling': 1,
+        'plots': {},
+        'ref_point': (0.0, 0.3),
+        'device': device,
+        'charges': [
+            ChargeDist(-0.1, 0.05, 0.1, 0.05, density=1e-8, depth=0.4),
+            ChargeDist(-0.1, -0.05, 0.1, -0.05, density=-1e-8, depth=0.4)
+        ]
+    }
+
+
+def bench_precision(device: str, mpp: float) -> None:
+    """
+    Run the same scene with every precision and compare speed and error against float64
+
+    :param device: 'cpu' or 'gpu'
+    :param mpp: meter per pixel of the scene
+    :return: None
+    """
+
+    results = {}
+    for precision in PRECISIONS:
+        sim_conf = get_sim_conf(device, mpp)
+        sim_conf['precision'] = precision
+        sim = Simulation(sim_conf)
+
+        st_tm = time.time()
+        sim.calc.do(Queue(), verbose=False)
+        el_tm = time.time() - st_tm
+
+        results[precision] = (el_tm, sim.data.astype(np.float64))
+
+    ref = results['float64'][1]
+    scale = np.max(np.abs(ref))
+    n_pixel = ref.shape[0] * ref.shape[1]
+
+    print('{:>8} | {:>10} | {:>12} | {:>10} | {:>10}'.format(
+        'precision', 'time(s)', 'pixel/s', 'max err', 'max rel'))
+    for precision, (el_tm, data) in results.items():
+        err = np.max(np.abs(data - ref))
+        print('{:>9} | {:>10.3f} | {:>12.1f} | {:>10.3e} | {:>10.3e}'.format(
+            precision, el_tm, n_pixel / el_tm, err, err / scale))
+
+
+def bench_far_field(device: str, mpp: float) -> None:
+    """
+    Run a wide scene of small segments with and without the far field expansion
+    and compare speed and error against the exact evaluation
+
+    :param device: 'cpu' or 'gpu'
+    :param mpp: meter per pixel of the scene (scaled by 10, the scene is 10 times wider)
+    :return: None
+    """
+
+    rng = np.random.default_rng(0)
+    charges = []
+    for cx, cy in rng.uniform(-3.0, 3.0, size=(16, 2)):
+        angle = rng.uniform(0, np.pi)
+        dx, dy = 0.02 * np.cos(angle), 0.02 * np.sin(angle)
+        charges.append(ChargeDist(cx - dx, cy - dy, cx + dx, cy + dy,
+                                  density=rng.choice((-1e-8, 1e-8)), depth=0.04))
+
+    results = {}
+    for far_field_ratio in (None, 10.0, 30.0, 60.0):
+        sim_conf = get_sim_conf(device, mpp * 10)
+        sim_conf['phy_rect'] = (-4.0, 4.0, 4.0, -4.0)
+        sim_conf['charges'] = charges
+        sim_conf['precision'] = 'float64'
+        sim_conf['far_field_ratio'] = far_field_ratio
+        sim = Simulation(sim_conf)
+
+        st_tm = time.time()
+        sim.calc.do(Queue(), verbose=False)
+        el_tm = time.time() - st_tm
+
+        results[far_field_ratio] = (el_tm, sim.data.copy())
+
+    ref = results[None][1]
+    scale = np.max(np.abs(ref))
+    n_pixel = ref.shape[0] * ref.shape[1]
+
+    print('{:>9} | {:>10} | {:>12} | {:>10} | {:>10}'.format(
+        'ratio', 'time(s)', 'pixel/s', 'max err', 'max rel'))
+    for far_field_ratio, (el_tm, data) in results.items():
+        err = np.max(np.abs(data - ref))
+        print('{:>9} | {:>10.3f} | {:>12.1f} | {:>10.3e} | {:>10.3e}'.format(
+            str(far_field_ratio), el_tm, n_pixel / el_tm, err, err / scale))
+
+
+def bench_table(device: str, mpp: float) -> None:
+    """
+    Run a scene of many copies of one segment shape with and without table interpolation
+    and compare speed and error against the closed form
+
+    :param device: 'cpu' (tables are a cpu mode)
+    :param mpp: meter per pixel of the scene
+    :return: None
+    """
+
+    rng = np.random.default_rng(0)
+    charges = []
+    for cx, cy in rng.uniform(-0.35, 0.35, size=(200, 2)):
+        angle = rng.uniform(0, np.pi)
+        dx, dy = 0.01 * np.cos(angle), 0.01 * np.sin(angle)
+        charges.append(ChargeDist(cx - dx, cy - dy, cx + dx, cy + dy,
+                                  density=rng.choice((-1e-8, 1e-8)), depth=0.02))
+
+    results = {}
+    # Outside of the table range the far field expansion takes over
+    for name, table_interp in (('exact', None),
+                               ('table 256', {'extent': 10.0, 'n_sample': 256}),
+                               ('table 1024', {'extent': 10.0, 'n_sample': 1024})):
+        sim_conf = get_sim_conf(device, mpp)
+        sim_conf['charges'] = charges
+        sim_conf['precision'] = 'float64'
+        sim_conf['far_field_ratio'] = 10.0
+        sim_conf['table_interp'] = table_interp
+        sim = Simulation(sim_conf)
+
+        st_tm = time.time()
+        sim.calc.do(Queue(), verbose=False)
+        el_tm = time.time() - st_tm
+
+        results[name] = (el_tm, sim.data.copy())
+
+    ref = results['exact'][1]
+    scale = np.max(np.abs(ref))
+    n_pixel = ref.shape[0] * ref.shape[1]
+
+    print('{:>10} | {:>10} | {:>12} | {:>10} | {:>10}'.format(
+        'mode', 'time(s)', 'pixel/s', 'max err', 'max rel'))
+    for name, (el_tm, data) in results.items():
+        err = np.max(np.abs(data - ref))
+        print('{:>10} | {:>10.3f} | {:>12.1f} | {:>10.3e} | {:>10.3e}'.format(
+            name, el_tm, n_pixel / el_tm, err, err / scale))
+
+
+def bench_near_line() -> None:
+    """
+    Sweep sample points approaching the segment line (inside the segment, at an end and on its extension)
+    and compare float32 and float64 against the same closed form in np.longdouble
+    Only a rough view of the rounding (np.longdouble is float64 on some platforms), the accuracy is checked
+    against an independent reference in tests/test_segment_potential.py (test_near_line)
+
+    :return: None
+    """
+
+    charges = [ChargeDist(-0.1, 0.0, 0.1, 0.0, density=1e-8, depth=0.4),
+               ChargeDist(-0.1, 0.0, 0.1, 0.0, density=(1e-8, -2e-8), depth=0.4, form='linear'),
+               ChargeDist(-0.1, 0.0, 0.1, 0.0, density=1e-8, depth=1e-3)]
+    xs = np.array([0.0, 0.05, 0.1 - 1e-6, 0.1, 0.1 + 1e-6, 0.2, 1.0])
+
+    print('{:>8} | {:>12} | {:>12}'.format('|y|', 'f32 max rel', 'f64 max rel'))
+    for exp in range(1, 16, 2):
+        errs = {np.float32: 0.0, np.float64: 0.0}
+        for y in (10.0 ** -exp, -10.0 ** -exp, 0.0):
+            for charge in charges:
+                ref = charge.get_potential(xs, y, dtype=np.longdouble)
+                for dtype in errs:
+                    val = charge.get_potential(xs, y, dtype=dtype).astype(np.longdouble)
+                    errs[dtype] = max(errs[dtype], float(np.max(np.abs(val - ref) / np.abs(ref))))
+
+        print('{:>8.0e} | {:>12.3e} | {:>12.3e}'.format(10.0 ** -exp, errs[np.float32], errs[np.float64]))
+
+
+def run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('bench', choices=['precision', 'far_field', 'near_line', 'table'])
+    parser.add_argument('--device', default='cpu', choices=['cpu', 'gpu'])
+    parser.add_argument('--mpp', type=float, default=4e-3)
+    args = parser.parse_args()
+
+    if args.bench == 'precision':
+        bench_precision(args.device, args.mpp)
+    elif args.bench == 'far_field':
+        bench_far_field(args.device, args.mpp)
+    elif args.bench == 'near_line':
+        bench_near_line()
+    elif args.bench == 'table':
+        bench_table(args.device, args.mpp)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,34 @@
+from __future__ import annotations
+
+import numpy as np
+
+
+def get_blocks(img: np.ndarray, n_row: int, n_col: int) -> np.ndarray:
+    """
+    Writable strided view of img as the down_sampling x down_sampling pixel blocks of n_row x n_col data cells
+
+    :param img: (n_row * down_sampling, n_col * down_sampling, 3) image rows (a row slice of the image is fine)
+    :return: (n_row, n_col, down_sampling, down_sampling, 3) view, [row][col][pixel row][pixel col]
+    """
+
+    down_sampling = img.shape[1] // n_col
+    s_row, s_col, s_ch = img.strides
+
+    return np.lib.stride_tricks.as_strided(img,
+                                           shape=(n_row, n_col, down_sampling, down_sampling, img.shape[2]),
+                                           strides=(s_row * down_sampling, s_col * down_sampling,
+                                                    s_row, s_col, s_ch),
+                                           writeable=True)
+
+
+def expand(img: np.ndarray, colors: np.ndarray) -> None:
+    """
+    Write colors rendered at data resolution into img at image resolution (one broadcast write)
+
+    :param img: image rows of the data rows of colors
+    :param colors: (n_row, n_col, 3) uint8
+    :return: None
+    """
+
+    blocks = get_blocks(img, colors.shape[0], colors.shape[1])
+    blocks[...] = colors[:, :, None, None, :]
@@ -1,69 +1,182 @@
+from __future__ import annotations
+from typing import Tuple
+
+import math
+
 import numpy as np
 from numba import cuda
 
+from DevicePool import DevicePool
+from PotentialHistogram import PotentialHistogram
+from plots import image_assembly
 
-def cpu(img: np.ndarray, data: np.ndarray, conf: dict) -> None:
-    min_value = np.min(data)
-    max_value = np.max(data)
-    max_abs = max(abs(min_value), abs(max_value))
+# conf 'norm' : mapping of |data - ref_potential| to the color ramp
+# 'linear', 'log' (conf 'decades' below max_abs, default 3) or 'symlog' (linear below conf 'linthresh',
+# default max_abs / 1000, log above)
+NORMS = {
+    'linear': 0,
+    'log': 1,
+    'symlog': 2
+}
 
-    def get_color(value: float):
-        color_from = np.array(conf['ref'])
-        color_to = np.array(conf['max' if value > 0.0 else 'min'])
 
-        pos = abs(value) / max_abs
-        res = np.array([0, 0, 0], dtype=np.uint8)
-        for i in range(3):
-            res[i] = int(color_from[i] + (color_to[i] - color_from[i]) * pos)
+def get_max_abs(data: np.ndarray, ref_potential: float, data_range: Tuple[float, float] | None = None) -> float:
+    """
+    Largest finite |data - ref_potential|, from data_range (min, max) if given (e.g. Calc.data_range)
+    instead of a pass over data
+    """
 
-        return res
+    if data_range is not None:
+        min_value, max_value = data_range
+    else:
+        min_value, max_value = np.min(data), np.max(data)
+        if not (np.isfinite(min_value) and np.isfinite(max_value)):
+            finite = data[np.isfinite(data)]
+            min_value, max_value = (np.min(finite), np.max(finite)) if finite.size != 0 else (np.nan, np.nan)
 
-    data_shape = data.shape
-    down_sampling = img.shape[0] // data_shape[0]
-    for row_idx in range(data_shape[0]):
-        r0 = row_idx * down_sampling
-        r1 = r0 + down_sampling
-        for col_idx in range(data_shape[1]):
-            c0 = col_idx * down_sampling
-            c1 = c0 + down_sampling
-            img[r0:r1, c0:c1] = get_color(data[row_idx][col_idx])
+    return max(abs(min_value - ref_potential), abs(max_value - ref_potential))
+
+
+def needs_histogram(plots: dict) -> bool:
+    """
+    Whether the color scale of plots reads a histogram (a 'percentile' without a fixed 'max_abs'),
+    Calc only collects it then
+    """
+
+    conf = plots.get('potential_color', {})
+    return 'percentile' in conf and 'max_abs' not in conf
+
+
+def get_scale(data: np.ndarray, conf: dict, ref_potential: float,
+              data_range: Tuple[float, float] | None = None, histogram: PotentialHistogram | None = None) -> float:
+    """
+    max_abs of the color scale (magnitude mapped to the max and min colors, larger ones saturate)
+    conf 'max_abs' if given, else the conf 'percentile' percentile of |data - ref_potential|
+    (from histogram, e.g. Calc.histogram, or a pass over data), else the largest one
+
+    :return: max_abs
+    """
+
+    if 'max_abs' in conf:
+        return float(conf['max_abs'])
+
+    max_abs = get_max_abs(data, ref_potential, data_range)
+    if 'percentile' in conf:
+        if histogram is None or histogram.ref_potential != ref_potential:
+            histogram = PotentialHistogram.from_data(data, ref_potential)
+        max_abs = min(max_abs, histogram.get_abs_percentile(conf['percentile']))
+
+    return max_abs
+
+
+def get_norm(conf: dict, max_abs: float) -> Tuple[int, float]:
+    """
+    :return: NORMS id of conf 'norm', its parameter (decades for 'log', linthresh for 'symlog')
+    """
+
+    norm = conf.get('norm', 'linear')
+    if norm not in NORMS:
+        raise ValueError('Unknown norm : {}'.format(norm))
+
+    if norm == 'log':
+        return NORMS[norm], float(conf.get('decades', 3))
+    if norm == 'symlog':
+        return NORMS[norm], float(conf.get('linthresh', max_abs / 1000))
 
+    return NORMS[norm], 1.0
 
-def gpu(img: np.ndarray, data: np.ndarray, conf: dict) -> None:
-    min_value = np.min(data)
-    max_value = np.max(data)
-    max_abs = max(abs(min_value), abs(max_value))
+
+def get_pos(abs_values: np.ndarray, max_abs: float, conf: dict) -> np.ndarray:
+    """
+    Position of |data - ref_potential| on the color ramp (0 : ref color, 1 : max or min color),
+    nan values (degenerate charges) get the ref color
+    """
+
+    norm, norm_param = get_norm(conf, max_abs)
+    if norm == NORMS['log']:
+        with np.errstate(divide='ignore'):
+            pos = np.maximum(1 + np.log10(abs_values / max_abs) / norm_param, 0.0)
+    elif norm == NORMS['symlog']:
+        pos = np.log1p(abs_values / norm_param) / np.log1p(max_abs / norm_param)
+    else:
+        pos = abs_values / max_abs
+
+    return np.where(np.isnan(pos), 0.0, np.minimum(pos, 1.0))
+
+
+def cpu(img: np.ndarray, data: np.ndarray, conf: dict, ref_potential: float = 0.0,
+        data_range: Tuple[float, float] | None = None, histogram: PotentialHistogram | None = None) -> None:
+    max_abs = get_scale(data, conf, ref_potential, data_range, histogram)
+
+    cpu_rows(img, data, 0, data.shape[0] - 1, conf, ref_potential, max_abs)
+
+
+def cpu_rows(img: np.ndarray, data: np.ndarray, st_row: int, en_row: int, conf: dict,
+             ref_potential: float, max_abs: float) -> None:
+    """
+    Color data rows st_row ~ en_row (inclusive) into img, which holds the image rows of those data rows
+    Values beyond max_abs saturate (max_abs may be an estimate, see Simulation streaming), see get_pos for conf 'norm'
+    """
+
+    color_ref = np.array(conf['ref'], dtype=np.float64)
+    color_max = np.array(conf['max'], dtype=np.float64)
+    color_min = np.array(conf['min'], dtype=np.float64)
+
+    # Rendered at data resolution, then expanded to the image
+    values = data[st_row:en_row + 1].astype(np.float64) - ref_potential
+    pos = get_pos(np.abs(values), max_abs, conf)[:, :, None]
+    color_to = np.where((values > 0.0)[:, :, None], color_max, color_min)
+    colors = np.trunc(color_ref + (color_to - color_ref) * pos).astype(np.uint8)
+
+    image_assembly.expand(img, colors)
+
+
+def gpu(img: np.ndarray, data: np.ndarray, conf: dict, ref_potential: float = 0.0,
+        pool: DevicePool | None = None, data_range: Tuple[float, float] | None = None,
+        histogram: PotentialHistogram | None = None) -> None:
+    """
+    If pool is given, data and img are expected to be resident in it ('data', 'img')
+    and img is left on the device, otherwise img is copied back to the host
+    """
+
+    max_abs = get_scale(data, conf, ref_potential, data_range, histogram)
+    norm, norm_param = get_norm(conf, max_abs)
+    max_abs = data.dtype.type(max_abs)
+    norm_param = data.dtype.type(norm_param)
+    ref_potential = data.dtype.type(ref_potential)
 
     data_shape = data.shape
     down_sampling = img.shape[0] // data_shape[0]
 
-    d_img = cuda.to_device(img)
-    d_data = cuda.to_device(data)
+    resident = pool is not None
+    if not resident:
+        pool = DevicePool()
+        pool.to_device('img', img)
+        pool.to_device('data', data)
+    d_img = pool.buffers['img']
+    d_data = pool.buffers['data']
 
-    d_min_color = cuda.to_device(np.array(conf['min'], dtype=np.int32))
-    d_ref_color = cuda.to_device(np.array(conf['ref'], dtype=np.int32))
-    d_max_color = cuda.to_device(np.array(conf['max'], dtype=np.int32))
+    d_min_color = pool.to_device('min_color', np.array(conf['min'], dtype=np.int32), key=tuple(conf['min']))
+    d_ref_color = pool.to_device('ref_color', np.array(conf['ref'], dtype=np.int32), key=tuple(conf['ref']))
+    d_max_color = pool.to_device('max_color', np.array(conf['max'], dtype=np.int32), key=tuple(conf['max']))
 
     n_thread_in_block = (16, 16)
     n_block_in_grid = (
         data.shape[1] // n_thread_in_block[0] + 1,
         data.shape[0] // n_thread_in_block[1] + 1
     )
-    gpu_kernel[n_block_in_grid, n_thread_in_block](d_img, d_data, down_sampling, max_abs,
-                                                   d_min_color, d_ref_color, d_max_color)
+    gpu_kernel[n_block_in_grid, n_thread_in_block](d_img, d_data, down_sampling, max_abs, ref_potential,
+                                                   d_min_color, d_ref_color, d_max_color, norm, norm_param)
     cuda.synchronize()
 
-    img[:] = d_img.copy_to_host()
+    if not resident:
+        d_img.copy_to_host(img)
+        pool.clear()
 
-    del d_max_color
-    del d_ref_color
-    del d_min_color
-    del d_data
-    del d_img
 
-
-@cuda.jit('void(uint8[:,:,:], float32[:,:], int32, float32, int32[:], int32[:], int32[:])')
-def gpu_kernel(img, data, down_sampling, max_abs, min_color, ref_color, max_color):
+@cuda.jit(['void(uint8[:,:,:], float32[:,:], int32, float32, float32, int32[:], int32[:], int32[:], int32, float32)',
+           'void(uint8[:,:,:], float64[:,:], int32, float64, float64, int32[:], int32[:], int32[:], int32, float64)'])
+def gpu_kernel(img, data, down_sampling, max_abs, ref_potential, min_color, ref_color, max_color, norm, norm_param):
     col_idx, row_idx = cuda.grid(2)
     if row_idx >= data.shape[0] or col_idx >= data.shape[1]:
         return
@@ -74,9 +187,21 @@ def gpu_kernel(img, data, down_sampling, max_abs, min_color, ref_color, max_colo
     c0 = col_idx * down_sampling
     c1 = c0 + down_sampling
 
+    value = data[row_idx][col_idx] - ref_potential
+
     color_from = ref_color
-    color_to = max_color if data[row_idx][col_idx] > 0.0 else min_color
+    color_to = max_color if value > 0.0 else min_color
+
+    # See get_pos
+    abs_value = abs(value)
+    if norm == 1:
+        pos = 1 + math.log10(abs_value / max_abs) / norm_param if abs_value > 0 else 0.0
+        pos = max(pos, 0.0)
+    elif norm == 2:
+        pos = math.log1p(abs_value / norm_param) / math.log1p(max_abs / norm_param)
+    else:
+        pos = abs_value / max_abs
+    pos = min(pos, 1.0) if not math.isnan(pos) else 0.0
 
-    pos = abs(data[row_idx][col_idx]) / max_abs
     for i in range(3):
         img[r0:r1, c0:c1, i] = int(color_from[i] + (color_to[i] - color_from[i]) * pos)
\ No newline at end of file
@@ -4,64 +4,77 @@ from typing import TYPE_CHECKING
 import numpy as np
 from numba import cuda
 
+from DevicePool import DevicePool
+from plots import image_assembly
 
-def cpu(img: np.ndarray, data: np.ndarray, conf: dict) -> None:
-    scale = conf['scale']
 
-    def chk(r, c):
-        chk_res = [False, False]  # right, bottom
-        base = data[r][c] // scale
+def cpu(img: np.ndarray, data: np.ndarray, conf: dict, ref_potential: float = 0.0) -> None:
+    cpu_rows(img, data, 0, data.shape[0] - 1, conf, ref_potential)
 
-        if c != data.shape[1] - 1:
-            if base != (data[r][c + 1] // scale):
-                chk_res[0] = True
-        if r != data.shape[0] - 1:
-            if base != (data[r + 1][c] // scale):
-                chk_res[1] = True
 
-        return chk_res
+def cpu_rows(img: np.ndarray, data: np.ndarray, st_row: int, en_row: int, conf: dict,
+             ref_potential: float = 0.0) -> None:
+    """
+    Draw contours of data rows st_row ~ en_row (inclusive) into img, which holds the image rows of those data rows
+    Row en_row + 1 of data has to be filled already (bottom neighbour)
+    """
 
-    data_shape = data.shape
-    down_sampling = img.shape[0] // data_shape[0]
-    for row_idx in range(data_shape[0]):
-        r0 = row_idx * down_sampling
-        r1 = r0 + down_sampling
-        for col_idx in range(data_shape[1]):
-            c0 = col_idx * down_sampling
-            c1 = c0 + down_sampling
+    scale = conf['scale']
 
-            res = chk(row_idx, col_idx)
-            if res[0] is True:
-                img[r0:r1, c1 - 1:c1, :] = 0
-            if res[1] is True:
-                img[r1 - 1:r1, c0:c1, :] = 0
+    # Contour level of the rows and of the bottom neighbour row (if any)
+    en_level_row = min(en_row + 1, data.shape[0] - 1)
+    levels = (data[st_row:en_level_row + 1].astype(np.float64) - ref_potential) // scale
+    n_row = en_row - st_row + 1
+    n_col = data.shape[1]
 
+    right = np.zeros((n_row, n_col), dtype=bool)
+    right[:, :-1] = levels[:n_row, :-1] != levels[:n_row, 1:]
+    bottom = np.zeros((n_row, n_col), dtype=bool)
+    bottom[:levels.shape[0] - 1] = levels[:-1] != levels[1:]
 
-def gpu(img: np.ndarray, data: np.ndarray, conf: dict) -> None:
-    scale = conf['scale']
+    # Last pixel column (right) and row (bottom) of the blocks
+    blocks = image_assembly.get_blocks(img, n_row, n_col)
+    blocks[right, :, -1] = 0
+    blocks[bottom, -1] = 0
+
+
+def gpu(img: np.ndarray, data: np.ndarray, conf: dict, ref_potential: float = 0.0,
+        pool: DevicePool | None = None) -> None:
+    """
+    If pool is given, data and img are expected to be resident in it ('data', 'img')
+    and img is left on the device, otherwise img is copied back to the host
+    """
+
+    scale = data.dtype.type(conf['scale'])
+    ref_potential = data.dtype.type(ref_potential)
 
     data_shape = data.shape
     down_sampling = img.shape[0] // data_shape[0]
 
-    d_img = cuda.to_device(img)
-    d_data = cuda.to_device(data)
+    resident = pool is not None
+    if not resident:
+        pool = DevicePool()
+        pool.to_device('img', img)
+        pool.to_device('data', data)
+    d_img = pool.buffers['img']
+    d_data = pool.buffers['data']
 
     n_thread_in_block = (16, 16)
     n_block_in_grid = (
         data.shape[1] // n_thread_in_block[0] + 1,
         data.shape[0] // n_thread_in_block[1] + 1
     )
-    gpu_kernel[n_block_in_grid, n_thread_in_block](d_img, d_data, scale, down_sampling)
+    gpu_kernel[n_block_in_grid, n_thread_in_block](d_img, d_data, scale, ref_potential, down_sampling)
     cuda.synchronize()
 
-    img[:] = d_img.copy_to_host()
-
-    del d_data
-    del d_img
+    if not resident:
+        d_img.copy_to_host(img)
+        pool.clear()
 
 
-@cuda.jit('void(uint8[:,:,:], float32[:,:], float32, int32)')
-def gpu_kernel(img, data, scale, down_sampling):
+@cuda.jit(['void(uint8[:,:,:], float32[:,:], float32, float32, int32)',
+           'void(uint8[:,:,:], float64[:,:], float64, float64, int32)'])
+def gpu_kernel(img, data, scale, ref_potential, down_sampling):
     col_idx, row_idx = cuda.grid(2)
     if row_idx >= data.shape[0] or col_idx >= data.shape[1]:
         return
@@ -73,12 +86,12 @@ def gpu_kernel(img, data, scale, down_sampling):
 
     chk_right = False
     chk_bottom = False
-    base = data[row_idx][col_idx] // scale
+    base = (data[row_idx][col_idx] - ref_potential) // scale
     if col_idx != data.shape[1] - 1:
-        if base != (data[row_idx][col_idx + 1] // scale):
+        if base != ((data[row_idx][col_idx + 1] - ref_potential) // scale):
             chk_right = True
     if row_idx != data.shape[0] - 1:
-        if base != (data[row_idx + 1][col_idx] // scale):
+        if base != ((data[row_idx + 1][col_idx] - ref_potential) // scale):
             chk_bottom = True
 
     if chk_right is True:
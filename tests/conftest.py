@@ -0,0 +1,42 @@
+import os
+import sys
+
+# The gpu paths run on the CUDA simulator unless a device is requested explicitly,
+# set before numba is imported by the modules under test
+os.environ.setdefault('NUMBA_ENABLE_CUDASIM', '1')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+from Charge import ChargeDist
+
+
+@pytest.fixture
+def sim_conf():
+    """
+    Small two segment scene (20 x 20 samples) with a fixed cpu plan (no autotuning)
+    """
+
+    return {
+        'phy_rect': (-0.4, 0.4, 0.4, -0.4),
+        'mpp': 2e-2,
+        'down_sampling': 1,
+        'plots': {
+            'potential_color': {
+                'min': (0, 0, 255),
+                'max': (255, 0, 0),
+                'ref': (255, 255, 255)
+            },
+            'potential_contour': {
+                'scale': 0.5
+            }
+        },
+        'ref_point': None,
+        'device': 'cpu',
+        'cpu_plan': {'n_worker': 2, 'schedule': 'dynamic', 'chunk_rows': 2},
+        'charges': [
+            ChargeDist(-0.1, 0.05, 0.1, 0.05, density=1e-8, depth=0.4),
+            ChargeDist(-0.1, -0.05, 0.1, -0.05, density=-1e-8, depth=0.4)
+        ]
+    }
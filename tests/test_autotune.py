@@ -0,0 +1,83 @@
+import json
+
+import numpy as np
+
+from Autotune import Autotuner
+from Calc import Calc, CPU_BLOCK_PIXELS
+from Charge import PointCharge
+
+
+def get_calc(n_row: int, n_col: int, n_charge: int) -> Calc:
+    charges = [PointCharge(0.01 * idx, 0.0) for idx in range(n_charge)]
+    return Calc(charges, (-0.4, 0.4, 0.4, -0.4), np.zeros((n_row, n_col), dtype=np.float32))
+
+
+def test_shape_key_buckets_charges():
+    keys = [Autotuner.get_shape_key(get_calc(300, 500, n_charge)) for n_charge in (5, 7, 8)]
+
+    assert keys[0] == keys[1]
+    assert keys[1] != keys[2]
+    assert Autotuner.get_shape_key(get_calc(300, 500, 0)) != keys[0]
+
+
+def test_trial_covers_a_block_per_worker():
+    calc = get_calc(2048, 1024, 2)
+    n_trial_row, n_trial_col = Autotuner().get_trial_shape(calc)
+    max_worker = max(candidate['n_worker'] for candidate in Autotuner.get_candidates(2048))
+
+    assert n_trial_col == 1024
+    assert n_trial_row * n_trial_col >= min(max_worker * CPU_BLOCK_PIXELS, 2048 * 1024)
+    assert n_trial_row * n_trial_col >= 2048 * 1024 / 16
+
+
+def test_trial_capped(monkeypatch):
+    # Many cores would otherwise time every candidate on most of the grid
+    monkeypatch.setattr('os.cpu_count', lambda: 64)
+    calc = get_calc(8192, 8192, 2)
+    autotuner = Autotuner()
+    n_trial_row, n_trial_col = autotuner.get_trial_shape(calc)
+
+    assert n_trial_col == 8192
+    assert n_trial_row * n_trial_col <= autotuner.max_trial_pixels
+
+
+def test_shape_key_approximations():
+    calc = get_calc(300, 500, 5)
+    keys = {Autotuner.get_shape_key(calc)}
+    for name, value in (('cull_tol', 1e-3), ('far_field_ratio', 6.0), ('table_interp', {})):
+        setattr(calc, name, value)
+        keys.add(Autotuner.get_shape_key(calc))
+    assert len(keys) == 4
+
+    # Bucketed : nearby values share one tuning
+    calc.cull_tol = 1.5e-3
+    assert Autotuner.get_shape_key(calc) in keys
+
+
+def test_plan_cached(tmp_path):
+    cache_path = str(tmp_path / 'autotune.json')
+    calc = get_calc(128, 96, 3)
+    autotuner = Autotuner(cache_path=cache_path, block_pixels=1024)
+    plan = autotuner.get_plan(calc, verbose=False)
+
+    with open(cache_path) as f:
+        cache = json.load(f)
+    entry = cache[Autotuner.get_machine_key()][Autotuner.get_shape_key(calc)]
+    assert entry['plan'] == plan
+    assert len(entry['reports']) == len(Autotuner.get_candidates(128))
+
+    # A charge count of the same bucket reuses the plan
+    assert Autotuner.get_shape_key(get_calc(128, 96, 2)) == Autotuner.get_shape_key(calc)
+
+
+def test_candidates_capped(monkeypatch):
+    monkeypatch.setattr('os.cpu_count', lambda: 16)
+    calc = get_calc(2048, 1024, 2)
+
+    assert max(candidate['n_worker'] for candidate in Autotuner.get_candidates(2048)) == 32
+    assert max(candidate['n_worker'] for candidate in Autotuner.get_candidates(2048, max_worker=4)) == 4
+    assert Autotuner.get_default_plan(2048, max_worker=4)['n_worker'] == 4
+    assert Autotuner(max_worker=4).get_trial_shape(calc) < Autotuner().get_trial_shape(calc)
+
+    # Plans tuned under a cap are not shared with uncapped ones
+    assert Autotuner.get_shape_key(calc, 4) != Autotuner.get_shape_key(calc)
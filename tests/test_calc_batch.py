@@ -0,0 +1,24 @@
+from queue import Queue
+
+import numpy as np
+
+from Calc import GPU_SCENE_GROUP
+from Charge import ChargeDist
+from Simulation import Simulation
+
+
+def test_batch_mixed_matches_single(sim_conf):
+    # 'mixed' rounds every scene to float32 once, batched (more scenes than a register group) or not
+    rng = np.random.default_rng(0)
+    charge_sets = []
+    for _ in range(GPU_SCENE_GROUP + 2):
+        charge_sets.append([ChargeDist(*rng.uniform(-0.3, 0.3, 4), density=density, depth=0.4)
+                            for density in rng.choice([-1e-8, 1e-8], 12)])
+
+    sim = Simulation(dict(sim_conf, device='gpu', precision='mixed'))
+    batch, _ = sim.calc_batch(charge_sets, Queue(), verbose=False)
+
+    for scene_idx, charges in enumerate(charge_sets):
+        sim.calc.charges = charges
+        sim.calc.do(Queue(), verbose=False)
+        np.testing.assert_array_max_ulp(batch[scene_idx], sim.data, maxulp=1)
@@ -0,0 +1,127 @@
+from queue import Queue
+
+import numpy as np
+import pytest
+
+import Charge
+from Charge import ChargeDist, PointCharge, ArcCharge
+from Simulation import Simulation
+
+
+def calc_on_grid(sim_conf: dict, charges: list, device: str, precision: str = 'float64'):
+    sim = Simulation(dict(sim_conf, device=device, precision=precision, charges=charges))
+    sim.calc.do(Queue(), verbose=False)
+    sample_x, sample_y = np.broadcast_arrays(*sim.grid.mesh())
+
+    return sim.data.astype(np.float64), sample_x.astype(np.float64), sample_y.astype(np.float64)
+
+
+def calc_segment_quadrature(charge: ChargeDist, x, y, n_node=128) -> np.ndarray:
+    # Tensor Gauss-Legendre quadrature of density(s) / distance over the segment x depth rectangle,
+    # converged to a few ulp at least max(a, h) away from the segment
+    nodes, weights = np.polynomial.legendre.leggauss(n_node)
+    a, h = charge.norm / 2, charge.depth / 2
+    local_x, local_y = Charge.get_local_pos(x, y, charge.cntr, charge.u_vec, np.float64)
+
+    s = a * nodes
+    if charge.form == 'linear':
+        d1, d2 = charge.density
+        density = (d1 + d2) / 2 + (d2 - d1) / charge.norm * s
+    else:
+        density = np.full(n_node, charge.density)
+    z = h * nodes
+
+    dist = np.sqrt((local_x[..., None, None] - s[:, None]) ** 2 + local_y[..., None, None] ** 2 + z[None, :] ** 2)
+    integrand = (weights * density)[:, None] * weights[None, :] / dist
+
+    return a * h * np.sum(integrand, axis=(-2, -1)) / (4 * Charge.pi * Charge.eps)
+
+
+def get_far_samples(charge: ChargeDist, x, y) -> np.ndarray:
+    # Samples at least max(a, h) away from the segment (range of calc_segment_quadrature)
+    a, h = charge.norm / 2, charge.depth / 2
+    local_x, local_y = Charge.get_local_pos(x, y, charge.cntr, charge.u_vec, np.float64)
+    dist = np.sqrt(np.maximum(np.abs(local_x) - a, 0) ** 2 + local_y ** 2)
+
+    return dist >= max(a, h)
+
+
+@pytest.mark.parametrize('device', ['cpu', 'gpu'])
+@pytest.mark.parametrize('precision, rtol', [('float32', 1e-5), ('float64', 1e-12)])
+def test_linear_matches_quadrature(sim_conf, device, precision, rtol):
+    charge = ChargeDist(-0.05, 0.03, 0.07, -0.02, density=(2e-8, -1e-8), depth=0.1, form='linear')
+    data, x, y = calc_on_grid(sim_conf, [charge], device, precision)
+
+    far = get_far_samples(charge, x, y)
+    assert np.count_nonzero(far) > data.size // 2
+    ref = calc_segment_quadrature(charge, x[far], y[far])
+    assert np.max(np.abs(data[far] - ref)) <= rtol * np.max(np.abs(ref))
+
+
+@pytest.mark.parametrize('device', ['cpu', 'gpu'])
+def test_linear_uniform_is_constant(sim_conf, device):
+    # Equal densities at both ends : the slope terms vanish
+    linear = ChargeDist(-0.05, 0.03, 0.07, -0.02, density=(1e-8, 1e-8), depth=0.1, form='linear')
+    constant = ChargeDist(-0.05, 0.03, 0.07, -0.02, density=1e-8, depth=0.1)
+
+    data, _, _ = calc_on_grid(sim_conf, [linear], device)
+    ref, _, _ = calc_on_grid(sim_conf, [constant], device)
+    assert np.allclose(data, ref, rtol=1e-14, atol=0)
+
+
+def test_unknown_form():
+    with pytest.raises(ValueError):
+        ChargeDist(-0.1, 0.0, 0.1, 0.0, form='quadratic')
+
+
+def calc_wire(density, depth, dist) -> np.ndarray:
+    # Finite wire along z : int dz / sqrt(d^2 + z^2) over the depth, in its log form
+    h = depth / 2
+    r = np.sqrt(dist ** 2 + h ** 2)
+    return density / (4 * Charge.pi * Charge.eps) * np.log((r + h) / (r - h))
+
+
+@pytest.mark.parametrize('device', ['cpu', 'gpu'])
+def test_point_matches_wire(sim_conf, device):
+    point = PointCharge(0.013, -0.027, density=1e-8, depth=0.3, radius=1e-4)
+    data, x, y = calc_on_grid(sim_conf, [point], device)
+
+    dist = np.hypot(x - point.p[0], y - point.p[1])
+    assert np.allclose(data, calc_wire(point.density, point.depth, dist), rtol=1e-12, atol=0)
+
+
+@pytest.mark.parametrize('device', ['cpu', 'gpu'])
+def test_point_clamped_inside_radius(sim_conf, device):
+    # Centered on a sample, the samples inside the wire radius all take the potential at the radius
+    grid = Simulation(sim_conf).grid
+    point = PointCharge(float(grid.x[10]), float(grid.y[10]), density=1e-8, depth=0.3, radius=0.1)
+    data, x, y = calc_on_grid(sim_conf, [point], device)
+
+    dist = np.hypot(x - point.p[0], y - point.p[1])
+    inside = dist <= point.radius
+    assert np.count_nonzero(inside) > 1
+    assert np.all(np.isfinite(data))
+    assert np.allclose(data[inside], calc_wire(point.density, point.depth, point.radius), rtol=1e-12, atol=0)
+    assert np.all(data[~inside] < data[inside].min())
+
+
+@pytest.mark.parametrize('device', ['cpu', 'gpu'])
+def test_arc_matches_chords(sim_conf, device):
+    arc = ArcCharge(0.03, -0.02, 0.15, 0.3, 2.5, density=1e-8, depth=0.2)
+    data, x, y = calc_on_grid(sim_conf, [arc], device)
+
+    # Dense chord sum (chord length error (angle / n)^2 / 24, below 1e-8)
+    n_chord = 4000
+    angles = np.linspace(arc.st_angle, arc.en_angle, n_chord + 1)
+    px = arc.cntr[0] + arc.radius * np.cos(angles)
+    py = arc.cntr[1] + arc.radius * np.sin(angles)
+    ref = sum(ChargeDist(px[idx], py[idx], px[idx + 1], py[idx + 1], density=arc.density, depth=arc.depth)
+              .get_potential(x, y, dtype=np.float64) for idx in range(n_chord))
+
+    # The quadrature holds farther than about one node spacing from the arc (measured 1e-3 at one spacing,
+    # 2.3e-5 at two)
+    spacing = arc.radius * (arc.en_angle - arc.st_angle) / arc.n_quad
+    dist = np.abs(np.hypot(x - arc.cntr[0], y - arc.cntr[1]) - arc.radius)
+    for n_spacing, rtol in ((1, 2e-3), (2, 1e-4)):
+        far = dist >= n_spacing * spacing
+        assert np.max(np.abs(data[far] - ref[far]) / np.abs(ref[far])) <= rtol
@@ -0,0 +1,91 @@
+from queue import Queue
+
+import numpy as np
+import pytest
+
+import Calc
+import Charge
+from Charge import ArcCharge, PointCharge
+from Simulation import Simulation
+
+
+@pytest.mark.parametrize('cull_tol', [None, 1e-3])
+def test_cull_stats_same_unit(sim_conf, cull_tol):
+    # A far, weak arc (16 table rows) is culled everywhere, the near segments nowhere :
+    # both devices count the same charge row x sample pairs
+    charges = sim_conf['charges'] + [ArcCharge(50.0, 50.0, 0.1, 0.0, 3.0, density=1e-12, depth=0.4)]
+
+    stats = {}
+    for device in ('cpu', 'gpu'):
+        sim = Simulation(dict(sim_conf, device=device, charges=charges, cull_tol=cull_tol))
+        sim.calc.do(Queue(), verbose=False)
+        stats[device] = sim.calc.cull_stats
+
+    n_sample = sim.data.size
+    assert stats['cpu']['n_eval'] == stats['gpu']['n_eval'] == n_sample * (2 + 16)
+    assert stats['cpu']['n_culled'] == stats['gpu']['n_culled'] == (0 if cull_tol is None else n_sample * 16)
+
+
+def get_corner_conf(sim_conf: dict) -> dict:
+    # 40 x 40 samples, weak points near the corners are culled on the far tiles only
+    corners = [PointCharge(sx * 0.19, sy * 0.18, density=1e-12, depth=0.4) for sx in (-1, 1) for sy in (-1, 1)]
+    return dict(sim_conf, mpp=1e-2, device='gpu', precision='float64', cull_tol=0.05,
+                charges=sim_conf['charges'] + corners)
+
+
+def test_gpu_cull_tiles(sim_conf, monkeypatch):
+    # Tiles of 2 x 2 blocks (32 x 32 samples) : 2 x 2 tiles, partial at the right and bottom
+    monkeypatch.setattr(Calc, 'GPU_CULL_TILE_BLOCKS', 2)
+    sim = Simulation(get_corner_conf(sim_conf))
+    sim.calc.do(Queue(), verbose=False)
+
+    mask = sim.device_pool.buffers['cull_mask'].copy_to_host()
+    assert mask.shape == (4, 6)
+    assert 0 < np.count_nonzero(mask == 0) < mask.size
+
+    # Every sample sums the rows left by the mask of its tile
+    rows, owner = Charge.get_charge_table(sim.charges, dtype=np.float64, with_owner=True)
+    sample_x, sample_y = sim.grid.mesh()
+    row_idx, col_idx = np.indices(sim.data.shape)
+    tile_idx = (row_idx // 32) * 2 + col_idx // 32
+    expected = np.zeros(sim.data.shape)
+    for row, charge_idx in enumerate(owner):
+        potential = sim.charges[charge_idx].get_potential(sample_x, sample_y, dtype=np.float64)
+        expected += mask[tile_idx, row] * potential
+
+    assert np.allclose(sim.data, expected, rtol=1e-12, atol=0)
+
+
+def test_gpu_cull_mask_size():
+    # 8000 x 8000 samples, 4096 charge rows : one mask row per 8 x 8 blocks
+    charges = [PointCharge(idx * 1e-4, 0.0) for idx in range(4096)]
+    calc = Calc.Calc(charges, (-0.4, 0.4, 0.4, -0.4), np.zeros((8000, 8000), dtype=np.float32), cull_tol=1e-3)
+    rows = Charge.get_charge_table(charges, dtype=np.float32)
+    mask = calc.get_gpu_cull_mask(rows, (501, 501), (16, 16))
+
+    assert mask.shape == (63 * 63, 4096)
+    assert mask.dtype == np.uint8
+    assert calc.cull_stats['n_eval'] == 8000 * 8000 * 4096
+
+
+def test_gpu_cull_mask_resident(sim_conf, monkeypatch):
+    n_build = [0]
+    get_gpu_cull_mask = Calc.Calc.get_gpu_cull_mask
+
+    def counted(calc, *args):
+        n_build[0] += 1
+        return get_gpu_cull_mask(calc, *args)
+
+    monkeypatch.setattr(Calc.Calc, 'get_gpu_cull_mask', counted)
+    sim = Simulation(get_corner_conf(sim_conf))
+    sim.calc.do(Queue(), verbose=False)
+    cull_stats = sim.calc.cull_stats
+    sim.calc.do(Queue(), verbose=False)
+
+    # Same charges, cull_tol and grid : neither rebuilt nor uploaded, same statistics
+    assert n_build[0] == 1
+    assert sim.calc.cull_stats == cull_stats
+
+    sim.calc.cull_tol = 0.1
+    sim.calc.do(Queue(), verbose=False)
+    assert n_build[0] == 2
@@ -0,0 +1,92 @@
+import json
+import os
+from queue import Queue
+
+import numpy as np
+import pytest
+
+import DataExport
+from Simulation import Simulation
+
+
+def calc_sim(sim_conf: dict, precision: str, **conf) -> Simulation:
+    sim = Simulation(dict(sim_conf, precision=precision, **conf))
+    sim.calc.do(Queue(), verbose=False)
+    return sim
+
+
+@pytest.mark.parametrize('precision', ['float32', 'float64', 'mixed'])
+def test_npy_round_trip(sim_conf, tmp_path, precision):
+    sim = calc_sim(sim_conf, precision)
+    path = str(tmp_path / 'data.npy')
+    sim.export(path)
+
+    data = np.load(path, mmap_mode='r')
+    with open(path + '.json', 'r') as f:
+        meta = json.load(f)
+
+    assert data.dtype == sim.data.dtype
+    assert np.array_equal(data, sim.data)
+    assert meta == sim.get_meta()
+    assert meta['dtype'] == data.dtype.str and meta['shape'] == list(data.shape)
+
+
+@pytest.mark.parametrize('precision', ['float32', 'float64'])
+def test_zarr_round_trip(sim_conf, tmp_path, precision):
+    sim = calc_sim(sim_conf, precision)
+    path = str(tmp_path / 'data.zarr')
+    sim.export(path, fmt='zarr')
+
+    data, meta = DataExport.load_zarr(path)
+    assert data.dtype == sim.data.dtype
+    assert np.array_equal(data, sim.data)
+    assert meta == sim.get_meta()
+
+
+def test_zarr_partial_chunks(tmp_path):
+    # Edge chunks are padded on disk and cropped on load
+    data = np.arange(20 * 13, dtype=np.float64).reshape(20, 13) - 100.5
+    path = str(tmp_path / 'data.zarr')
+    DataExport.save_zarr(path, data, {'name': 'ramp'}, chunks=(8, 8))
+
+    assert sorted(name for name in os.listdir(path) if not name.startswith('.')) == \
+        ['{}.{}'.format(row, col) for row in range(3) for col in range(2)]
+    loaded, meta = DataExport.load_zarr(path)
+    assert loaded.dtype == data.dtype
+    assert np.array_equal(loaded, data)
+    assert meta == {'name': 'ramp'}
+
+
+def test_zarr_readable_by_zarr(sim_conf, tmp_path):
+    zarr = pytest.importorskip('zarr')
+    sim = calc_sim(sim_conf, 'float32')
+    path = str(tmp_path / 'data.zarr')
+    sim.export(path, fmt='zarr')
+
+    store = zarr.open(path, mode='r')
+    assert store.dtype == sim.data.dtype
+    assert np.array_equal(store[...], sim.data)
+    assert dict(store.attrs) == sim.get_meta()
+
+
+def test_unknown_format(sim_conf, tmp_path):
+    with pytest.raises(ValueError):
+        calc_sim(sim_conf, 'float32').export(str(tmp_path / 'data'), fmt='hdf5')
+
+
+@pytest.mark.parametrize('precision', ['float32', 'mixed'])
+def test_data_path_memmap(sim_conf, tmp_path, precision):
+    # data is computed in place into the .npy file, the sidecar is written after the run
+    path = str(tmp_path / 'data.npy')
+    sim = Simulation(dict(sim_conf, precision=precision, data_path=path))
+    assert isinstance(sim.data, np.memmap)
+    sim.run(Queue(), str(tmp_path / 'result.png'), verbose=False)
+
+    data = np.load(path, mmap_mode='r')
+    with open(path + '.json', 'r') as f:
+        meta = json.load(f)
+    ref = calc_sim(sim_conf, precision)
+
+    assert data.dtype == ref.data.dtype
+    assert np.array_equal(data, ref.data)
+    assert meta == sim.get_meta()
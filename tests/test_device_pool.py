@@ -0,0 +1,42 @@
+from queue import Queue
+
+import numpy as np
+
+from DevicePool import DevicePool
+from Simulation import Simulation
+
+
+def test_buffers_resident_across_runs(sim_conf, tmp_path):
+    sim = Simulation(dict(sim_conf, device='gpu'))
+    sim.run(Queue(), out_path=str(tmp_path / 'a.png'), verbose=False)
+    buffers = dict(sim.device_pool.buffers)
+    img = sim.img.copy()
+
+    # Same charges : no reallocation and the resident data is not uploaded again
+    sim.set_ref_point((0.0, 0.3))
+    sim.run(Queue(), out_path=str(tmp_path / 'b.png'), verbose=False)
+    for name in ('data', 'img', 'charges', 'grid_x', 'grid_y'):
+        assert sim.device_pool.buffers[name] is buffers[name]
+    assert sim.device_pool.keys['data'] == sim.calc.get_data_key()
+
+    sim.set_ref_point(None)
+    sim.run(Queue(), out_path=str(tmp_path / 'c.png'), verbose=False)
+    assert np.array_equal(sim.img, img)
+
+
+def test_shared_pool_no_stale_data(sim_conf, tmp_path):
+    # Same charges and data shape, other grid (shifted rect) and precision, one pool
+    pool = DevicePool()
+    sim_a = Simulation(dict(sim_conf, device='gpu'), device_pool=pool)
+    sim_a.run(Queue(), out_path=str(tmp_path / 'a.png'), verbose=False)
+    img = sim_a.img.copy()
+
+    shifted = (-0.3, 0.4, 0.5, -0.4)
+    for conf in (dict(sim_conf, phy_rect=shifted), dict(sim_conf, precision='mixed')):
+        sim_b = Simulation(dict(conf, device='gpu'), device_pool=pool)
+        assert sim_b.data.shape == sim_a.data.shape and sim_b.data.dtype == sim_a.data.dtype
+        sim_b.run(Queue(), out_path=str(tmp_path / 'b.png'), verbose=False)
+
+        # Re-plot of a without recomputing : its own data is uploaded again
+        sim_a.run(Queue(), out_path=str(tmp_path / 'a.png'), verbose=False)
+        assert np.array_equal(sim_a.img, img)
@@ -0,0 +1,81 @@
+from queue import Queue
+
+import numpy as np
+import pytest
+
+import Charge
+from Charge import ChargeDist
+from Simulation import Simulation
+
+CHARGES = [
+    ChargeDist(-0.05, 0.02, 0.07, -0.03, density=1e-8, depth=0.1),
+    ChargeDist(-0.01, -0.1, 0.01, 0.1, density=-2e-8, depth=0.01),
+    ChargeDist(-0.05, 0.02, 0.07, -0.03, density=(1e-8, 3e-8), depth=0.1, form='linear'),
+    ChargeDist(-0.01, -0.1, 0.01, 0.1, density=(2e-8, -1e-8), depth=0.3, form='linear')
+]
+
+
+def get_abs_charge(charge: ChargeDist) -> float:
+    # Total absolute charge |Q| of the segment
+    if charge.form != 'linear':
+        return abs(charge.density) * charge.norm * charge.depth
+
+    d1, d2 = charge.density
+    if d1 * d2 >= 0:
+        return abs(d1 + d2) / 2 * charge.norm * charge.depth
+    return (d1 ** 2 + d2 ** 2) / (2 * abs(d1 - d2)) * charge.norm * charge.depth
+
+
+def get_error_bound(charge: ChargeDist, x, y, far_field_ratio: float) -> np.ndarray:
+    """
+    Documented bound of Charge.is_far_field at the points of the far field, 0 elsewhere
+        |Q| / (4 pi eps r) * t^4 / (1 - t^2) (constant), t^3 / (1 - t) ('linear'), t = sqrt(a^2 + h^2) / r
+    """
+
+    a, h = charge.norm / 2, charge.depth / 2
+    local_x, local_y = Charge.get_local_pos(x, y, charge.cntr, charge.u_vec, np.float64)
+    r = np.sqrt(local_x ** 2 + local_y ** 2)
+    t = np.sqrt(a ** 2 + h ** 2) / r
+
+    series = t ** 4 / (1 - t ** 2) if charge.form == 'constant' else t ** 3 / (1 - t)
+    bound = get_abs_charge(charge) / (4 * Charge.pi * Charge.eps * r) * series
+
+    return np.where(Charge.is_far_field(local_x, local_y, h, a, far_field_ratio), bound, 0.0)
+
+
+@pytest.mark.parametrize('charge', CHARGES)
+@pytest.mark.parametrize('far_field_ratio', [2.0, 10.0, 30.0, 60.0])
+def test_far_field_within_bound(charge, far_field_ratio):
+    # Rings at the threshold (worst case) and beyond it, all around the segment
+    diag = np.sqrt((charge.norm / 2) ** 2 + (charge.depth / 2) ** 2)
+    angles = np.linspace(0, 2 * np.pi, 256, endpoint=False)
+    dist = far_field_ratio * diag * np.array([1 + 1e-9, 1.1, 1.5, 4.0])
+    x = charge.cntr[0] + (dist[:, None] * np.cos(angles)).reshape(-1)
+    y = charge.cntr[1] + (dist[:, None] * np.sin(angles)).reshape(-1)
+
+    exact = charge.get_potential(x, y, dtype=np.float64)
+    res = charge.get_potential(x, y, dtype=np.float64, far_field_ratio=far_field_ratio)
+    bound = get_error_bound(charge, x, y, far_field_ratio)
+
+    assert np.all(bound > 0)
+    # Rounding of the closed form grows with r / a (see test_segment_potential.get_term_magnitude)
+    assert np.all(np.abs(res - exact) <= bound + 1e-12 * np.abs(exact))
+
+
+@pytest.mark.parametrize('device', ['cpu', 'gpu'])
+@pytest.mark.parametrize('charge', CHARGES)
+def test_far_field_within_bound_on_grid(sim_conf, device, charge):
+    far_field_ratio = 2.0
+    data = {}
+    for ratio in (None, far_field_ratio):
+        # Wider than the charges, so that most samples are in the far field
+        sim = Simulation(dict(sim_conf, phy_rect=(-2.0, 2.0, 2.0, -2.0), mpp=5e-2, device=device,
+                              precision='float64', charges=[charge], far_field_ratio=ratio))
+        sim.calc.do(Queue(), verbose=False)
+        data[ratio] = sim.data
+
+    x, y = np.broadcast_arrays(*sim.grid.mesh())
+    bound = get_error_bound(charge, x, y, far_field_ratio)
+
+    assert np.count_nonzero(bound) > data[None].size // 4
+    assert np.all(np.abs(data[far_field_ratio] - data[None]) <= bound + 1e-12 * np.abs(data[None]))
@@ -0,0 +1,52 @@
+from queue import Queue
+
+import numpy as np
+import pytest
+
+from Charge import ChargeDist
+from Simulation import Simulation
+
+
+def get_progress(progress_q: Queue) -> list:
+    msgs = []
+    while not progress_q.empty():
+        msgs.append(progress_q.get())
+
+    return [msg['progress'] for msg in msgs if msg['task'] == 'calc']
+
+
+@pytest.mark.parametrize('device', ['cpu', 'gpu'])
+def test_progress_monotonic(sim_conf, device):
+    sim = Simulation(dict(sim_conf, device=device))
+    progress_q = Queue()
+    sim.calc.do(progress_q, verbose=False)
+
+    progress = get_progress(progress_q)
+    assert len(progress) != 0
+    assert np.all(np.diff(progress) >= 0)
+    assert progress[-1] == 100
+
+
+def test_block_flags_reset_across_runs(sim_conf):
+    # The pool keeps the flags resident, every run starts from cleared flags and raises all of them
+    sim = Simulation(dict(sim_conf, device='gpu'))
+    for density in (1e-8, 2e-8):
+        sim.calc.charges = [ChargeDist(-0.1, 0.05, 0.1, 0.05, density=density, depth=0.4)]
+        progress_q = Queue()
+        sim.calc.do(progress_q, verbose=False)
+
+        assert get_progress(progress_q)[-1] == 100
+        assert np.all(sim.device_pool.buffers['block_done'].copy_to_host() == 1)
+
+
+@pytest.mark.parametrize('precision', ['float32', 'float64'])
+def test_gpu_matches_cpu(sim_conf, precision):
+    data = {}
+    for device in ('cpu', 'gpu'):
+        sim = Simulation(dict(sim_conf, device=device, precision=precision))
+        sim.calc.do(Queue(), verbose=False)
+        data[device] = sim.data.astype(np.float64)
+
+    scale = np.max(np.abs(data['cpu']))
+    rtol = 1e-4 if precision == 'float32' else 1e-12
+    assert np.max(np.abs(data['gpu'] - data['cpu'])) <= rtol * scale
@@ -0,0 +1,116 @@
+from queue import Queue
+
+import numpy as np
+import pytest
+
+from Calc import Calc
+from Charge import ChargeDist, PointCharge
+from PotentialHistogram import PotentialHistogram, HIST_LOG_MIN, HIST_BINS_PER_DECADE
+from Simulation import Simulation
+
+
+def with_percentile(sim_conf: dict) -> dict:
+    # Calc only collects the histogram for a percentile color scale
+    color_conf = dict(sim_conf['plots']['potential_color'], percentile=99)
+    return dict(sim_conf, plots=dict(sim_conf['plots'], potential_color=color_conf))
+
+
+def test_nonfinite_counted_apart():
+    hist = PotentialHistogram.from_data(np.array([1.0, -2.0, np.nan, np.inf, 0.0]))
+
+    assert hist.n_total == 3
+    assert hist.n_nonfinite == 2
+
+
+@pytest.mark.parametrize('device', ['cpu', 'gpu'])
+def test_zero_length_segment(sim_conf, device, tmp_path):
+    # The direction of a zero length segment is undefined, its potential is nan everywhere
+    sim_conf = with_percentile(sim_conf)
+    sim_conf['device'] = device
+    sim_conf['charges'] = sim_conf['charges'] + [ChargeDist(0.0, 0.0, 0.0, 0.0, density=1e-8, depth=0.4)]
+    with np.errstate(invalid='ignore'):
+        sim = Simulation(sim_conf)
+        sim.run(Queue(), out_path=str(tmp_path / 'result.png'), verbose=False)
+
+    assert np.all(np.isnan(sim.data))
+    assert sim.histogram.n_nonfinite == sim.data.size
+    assert sim.histogram.n_total == 0
+    assert sim.data_range is None
+
+
+def get_point_on_sample_conf(sim_conf: dict) -> dict:
+    # Point charge of radius 0 on a sample : inf there, finite elsewhere
+    grid = Simulation(sim_conf).grid
+    point = PointCharge(float(grid.x[5]), float(grid.y[7]), density=1e-8, depth=0.4, radius=0.0)
+
+    return dict(with_percentile(sim_conf), charges=sim_conf['charges'] + [point])
+
+
+@pytest.mark.parametrize('device', ['cpu', 'gpu'])
+def test_point_on_sample(sim_conf, device, tmp_path):
+    sim = Simulation(dict(get_point_on_sample_conf(sim_conf), device=device))
+    with np.errstate(divide='ignore'):
+        sim.run(Queue(), out_path=str(tmp_path / 'result.png'), verbose=False)
+
+    n_nonfinite = int(np.count_nonzero(~np.isfinite(sim.data)))
+    assert n_nonfinite == 1
+    assert sim.histogram.n_nonfinite == 1
+    assert sim.histogram.n_total == sim.data.size - 1
+
+    finite = sim.data[np.isfinite(sim.data)]
+    assert sim.data_range == (float(finite.min()), float(finite.max()))
+
+
+def test_nonfinite_devices_agree(sim_conf):
+    conf = get_point_on_sample_conf(sim_conf)
+    histograms = []
+    for device in ('cpu', 'gpu'):
+        sim = Simulation(dict(conf, device=device))
+        with np.errstate(divide='ignore'):
+            sim.calc.do(Queue(), verbose=False)
+        histograms.append(sim.calc.histogram)
+
+    assert histograms[0].n_nonfinite == histograms[1].n_nonfinite == 1
+    # float32 rounding may move a value across a bin edge
+    assert np.abs(histograms[0].counts - histograms[1].counts).sum() <= 2
+
+
+@pytest.mark.parametrize('device', ['cpu', 'gpu'])
+def test_histogram_only_for_percentile(sim_conf, device, tmp_path):
+    sim = Simulation(dict(sim_conf, device=device))
+    sim.run(Queue(), out_path=str(tmp_path / 'result.png'), verbose=False)
+    assert sim.histogram is None
+
+    # Re-colored from a pass over data, then collected by Calc
+    plots = with_percentile(sim_conf)['plots']
+    sim.set_plots(plots)
+    sim.run(Queue(), out_path=str(tmp_path / 'result.png'), verbose=False)
+    img = sim.img.copy()
+
+    sim = Simulation(dict(sim_conf, device=device, plots=plots))
+    sim.run(Queue(), out_path=str(tmp_path / 'result.png'), verbose=False)
+    assert sim.histogram is not None
+    assert sim.histogram.n_total == sim.data.size
+    assert np.array_equal(sim.img, img)
+
+
+
+@pytest.mark.parametrize('device', ['cpu', 'gpu'])
+def test_histogram_of_stored_values(sim_conf, device, monkeypatch):
+    # 'mixed' sums in float64 and stores float32, both devices bin the stored values :
+    # ref_potential is placed so that a sample falls across a bin edge between the two
+    conf = dict(with_percentile(sim_conf), device=device)
+    sim = Simulation(dict(conf, precision='float64'))
+    sim.calc.do(Queue(), verbose=False)
+    exact = sim.data
+    idx = np.unravel_index(np.argmax(np.abs(exact.astype(np.float32) - exact)), exact.shape)
+    half_gap = (float(np.float32(exact[idx])) - float(exact[idx])) / 2
+    edge = PotentialHistogram.get_upper_edges()[-HIST_LOG_MIN * HIST_BINS_PER_DECADE]  # about 1 V
+    ref_potential = float(exact[idx]) - edge + half_gap
+    monkeypatch.setattr(Calc, 'get_ref_potential', lambda calc: ref_potential)
+
+    sim = Simulation(dict(conf, precision='mixed'))
+    sim.calc.do(Queue(), verbose=False)
+
+    expected = PotentialHistogram.from_data(sim.data, ref_potential)
+    assert np.array_equal(sim.calc.histogram.counts, expected.counts)
@@ -0,0 +1,103 @@
+import threading
+from queue import Queue
+
+from Autotune import Autotuner
+from Charge import PointCharge
+from JobScheduler import JobScheduler
+from Simulation import Simulation
+
+
+class BrokenCharge(PointCharge):
+    def get_potential(self, x, y, dtype=None, far_field_ratio=None, tables=None):
+        raise RuntimeError('broken charge')
+
+
+def test_cpu_worker_error_raised(sim_conf):
+    sim = Simulation(dict(sim_conf, charges=sim_conf['charges'] + [BrokenCharge(0.0, 0.0)]))
+    errors = []
+
+    def do():
+        try:
+            sim.calc.do(Queue(), verbose=False)
+        except RuntimeError as e:
+            errors.append(e)
+
+    th = threading.Thread(target=do, daemon=True)
+    th.start()
+    th.join(30)
+
+    assert not th.is_alive()
+    assert len(errors) == 1
+
+
+def test_failed_job_ends(sim_conf, tmp_path):
+    scheduler = JobScheduler(n_runner=1)
+    job_id = scheduler.submit(dict(sim_conf, charges=sim_conf['charges'] + [BrokenCharge(0.0, 0.0)]),
+                              str(tmp_path / 'broken.png'))
+    status = scheduler.wait(job_id, timeout=30)
+
+    assert status['state'] == 'failed'
+    assert 'broken charge' in status['error']
+    assert scheduler.get_simulation(job_id) is None
+
+    # The runner is free for the next job
+    job_id = scheduler.submit(sim_conf, str(tmp_path / 'result.png'))
+    assert scheduler.wait(job_id, timeout=30)['state'] == 'done'
+    scheduler.shutdown()
+
+
+def test_results_released(sim_conf, tmp_path):
+    scheduler = JobScheduler(n_runner=1, keep_results=1)
+    job_ids = []
+    for idx, mpp in enumerate((2e-2, 4e-2)):
+        job_ids.append(scheduler.submit(dict(sim_conf, mpp=mpp), str(tmp_path / 'result_{}.png'.format(idx))))
+    for job_id in job_ids:
+        assert scheduler.wait(job_id, timeout=30)['state'] == 'done'
+
+    assert scheduler.jobs[job_ids[0]].sim is None
+    assert scheduler.get_simulation(job_ids[0]) is None
+    assert scheduler.get_simulation(job_ids[1]) is not None
+    assert (tmp_path / 'result_0.png').exists()
+
+    scheduler.remove(job_ids[1])
+    assert len(scheduler.results) == 0
+    scheduler.shutdown()
+
+
+def test_autotune_within_cpu_limit(sim_conf, tmp_path, monkeypatch):
+    monkeypatch.setattr('os.cpu_count', lambda: 16)
+    candidates = []
+
+    def tune(autotuner, calc, verbose=True):
+        candidates.extend(Autotuner.get_candidates(calc.grid_shape[0], autotuner.max_worker))
+        return [{'plan': candidate, 'pixel_per_sec': 1.0} for candidate in candidates]
+
+    monkeypatch.setattr(Autotuner, 'tune', tune)
+    monkeypatch.setattr(Autotuner, 'load', lambda autotuner: {})
+    monkeypatch.setattr(Autotuner, 'save', lambda autotuner, cache: None)
+
+    # 320 x 320 samples : more than one cpu block, so the plan is tuned
+    scheduler = JobScheduler(n_runner=1, cpu_limit=3)
+    job_id = scheduler.submit(dict(sim_conf, mpp=1.25e-3, cpu_plan='auto'), str(tmp_path / 'result.png'))
+    assert scheduler.wait(job_id, timeout=60)['state'] == 'done'
+    scheduler.shutdown()
+
+    assert len(candidates) != 0
+    assert max(candidate['n_worker'] for candidate in candidates) == 3
+
+
+def test_job_records_evicted(sim_conf, tmp_path):
+    scheduler = JobScheduler(n_runner=1, keep_results=1, keep_jobs=2)
+    job_ids = []
+    for idx, mpp in enumerate((2e-2, 4e-2, 5e-2)):
+        job_ids.append(scheduler.submit(dict(sim_conf, mpp=mpp), str(tmp_path / 'result_{}.png'.format(idx))))
+        assert scheduler.wait(job_ids[-1], timeout=30)['state'] == 'done'
+
+    # The oldest ended record is forgotten, the latest result kept
+    assert sorted(scheduler.jobs) == job_ids[1:]
+    assert scheduler.get_simulation(job_ids[2]) is not None
+
+    scheduler.remove(job_ids[1])
+    assert sorted(scheduler.jobs) == job_ids[2:]
+    assert len(scheduler.ended) == 1
+    scheduler.shutdown()
@@ -0,0 +1,119 @@
+from queue import Queue
+
+import numpy as np
+import pytest
+
+from plots import image_assembly, potential_color, potential_contour
+from Simulation import Simulation
+
+COLOR_CONF = {'min': (0, 0, 255), 'max': (255, 0, 0), 'ref': (255, 255, 255)}
+CONTOUR_CONF = {'scale': 0.5}
+
+
+def color_rows_per_block(img, data, st_row, en_row, conf, ref_potential, max_abs):
+    # Per block loop of potential_color.cpu_rows before the vectorized image assembly
+    def get_color(value: float):
+        color_from = np.array(conf['ref'])
+        color_to = np.array(conf['max' if value > 0.0 else 'min'])
+
+        pos = min(abs(value) / max_abs, 1.0)
+        res = np.array([0, 0, 0], dtype=np.uint8)
+        for i in range(3):
+            res[i] = int(color_from[i] + (color_to[i] - color_from[i]) * pos)
+
+        return res
+
+    down_sampling = img.shape[1] // data.shape[1]
+    for row_idx in range(st_row, en_row + 1):
+        r0 = (row_idx - st_row) * down_sampling
+        r1 = r0 + down_sampling
+        for col_idx in range(data.shape[1]):
+            c0 = col_idx * down_sampling
+            c1 = c0 + down_sampling
+            img[r0:r1, c0:c1] = get_color(data[row_idx][col_idx] - ref_potential)
+
+
+def contour_rows_per_block(img, data, st_row, en_row, conf, ref_potential):
+    # Per block loop of potential_contour.cpu_rows before the vectorized image assembly
+    scale = conf['scale']
+
+    def chk(r, c):
+        chk_res = [False, False]  # right, bottom
+        base = (data[r][c] - ref_potential) // scale
+
+        if c != data.shape[1] - 1:
+            if base != ((data[r][c + 1] - ref_potential) // scale):
+                chk_res[0] = True
+        if r != data.shape[0] - 1:
+            if base != ((data[r + 1][c] - ref_potential) // scale):
+                chk_res[1] = True
+
+        return chk_res
+
+    down_sampling = img.shape[1] // data.shape[1]
+    for row_idx in range(st_row, en_row + 1):
+        r0 = (row_idx - st_row) * down_sampling
+        r1 = r0 + down_sampling
+        for col_idx in range(data.shape[1]):
+            c0 = col_idx * down_sampling
+            c1 = c0 + down_sampling
+
+            res = chk(row_idx, col_idx)
+            if res[0] is True:
+                img[r0:r1, c1 - 1:c1, :] = 0
+            if res[1] is True:
+                img[r1 - 1:r1, c0:c1, :] = 0
+
+
+def get_data(sim_conf: dict, dtype) -> np.ndarray:
+    # Potential of the test scene, with samples exactly on contour levels and on the reference
+    sim = Simulation(dict(sim_conf, precision='float32' if dtype == np.float32 else 'float64'))
+    sim.calc.do(Queue(), verbose=False)
+    data = sim.data.copy()
+    data[3, 2:6] = (1.5, -2.0, 0.0, 0.5)
+    return data
+
+
+def render(data: np.ndarray, down_sampling: int, bands: list, color_rows, contour_rows) -> np.ndarray:
+    n_row, n_col = data.shape
+    img = np.zeros((n_row * down_sampling, n_col * down_sampling, 3), dtype=np.uint8)
+    img.fill(255)
+    max_abs = 0.8 * np.max(np.abs(data))  # the largest values saturate
+
+    for st_row, en_row in bands:
+        rows = img[st_row * down_sampling:(en_row + 1) * down_sampling]
+        color_rows(rows, data, st_row, en_row, COLOR_CONF, 0.25, max_abs)
+        contour_rows(rows, data, st_row, en_row, CONTOUR_CONF, 0.25)
+
+    return img
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+@pytest.mark.parametrize('down_sampling', [1, 2, 3])
+@pytest.mark.parametrize('bands', [[(0, 19)], [(0, 6), (7, 7), (8, 18), (19, 19)]])
+def test_matches_per_block(sim_conf, dtype, down_sampling, bands):
+    data = get_data(sim_conf, dtype)
+    assert data.shape == (20, 20)
+
+    img = render(data, down_sampling, bands, potential_color.cpu_rows, potential_contour.cpu_rows)
+    ref = render(data, down_sampling, bands, color_rows_per_block, contour_rows_per_block)
+
+    assert np.count_nonzero(np.all(ref == 0, axis=2)) != 0  # contours drawn
+    assert np.array_equal(img, ref)
+
+
+@pytest.mark.parametrize('down_sampling', [1, 2, 3])
+def test_blocks_view(down_sampling):
+    # Block [row][col] is the down_sampling x down_sampling square of the data cell, also in a row slice
+    img = np.arange(6 * down_sampling * 4 * down_sampling * 3, dtype=np.uint8).reshape(6 * down_sampling,
+                                                                                    4 * down_sampling, 3)
+    rows = img[2 * down_sampling:5 * down_sampling]
+    blocks = image_assembly.get_blocks(rows, 3, 4)
+
+    for row in range(3):
+        for col in range(4):
+            r0, c0 = (row + 2) * down_sampling, col * down_sampling
+            assert np.array_equal(blocks[row, col], img[r0:r0 + down_sampling, c0:c0 + down_sampling])
+
+    blocks[1, 2] = 7
+    assert np.all(img[3 * down_sampling:4 * down_sampling, 2 * down_sampling:3 * down_sampling] == 7)
@@ -0,0 +1,47 @@
+from queue import Queue
+
+import numpy as np
+import pytest
+
+import Calc
+from Charge import ChargePolyline
+from Simulation import Simulation
+
+POINTS = [(-0.3, -0.2), (-0.25, 0.1), (-0.05, 0.12), (0.0, -0.05), (0.2, -0.1), (0.3, 0.25)]
+
+
+def calc_data(sim_conf: dict, charges: list, device: str, cull_tol, far_field_ratio) -> tuple:
+    sim = Simulation(dict(sim_conf, device=device, precision='float64', charges=charges,
+                          cull_tol=cull_tol, far_field_ratio=far_field_ratio))
+    sim.calc.do(Queue(), verbose=False)
+
+    return sim.data, sim.calc.cull_stats
+
+
+@pytest.mark.parametrize('device', ['cpu', 'gpu'])
+@pytest.mark.parametrize('closed', [False, True])
+@pytest.mark.parametrize('cull_tol', [None, 20.0])
+@pytest.mark.parametrize('far_field_ratio', [None, 2.0])
+def test_polyline_matches_edges(sim_conf, device, closed, cull_tol, far_field_ratio, monkeypatch):
+    # The vertex terms carried along the chain (and from the first to the last edge of a closed outline)
+    # give the sum of the separate edges, also when culled or far field edges break the chain
+    # (culling tiles of one gpu block, so that the 20 x 20 grid has several)
+    monkeypatch.setattr(Calc, 'GPU_CULL_TILE_BLOCKS', 1)
+    polyline = ChargePolyline(POINTS, density=1e-8, depth=0.2, closed=closed)
+    data, cull_stats = calc_data(sim_conf, [polyline], device, cull_tol, far_field_ratio)
+    ref, ref_cull_stats = calc_data(sim_conf, polyline.edges, device, cull_tol, far_field_ratio)
+
+    if cull_tol is not None:
+        # Some edges are culled on some tiles, not all of them everywhere
+        assert 0 < ref_cull_stats['n_culled'] < ref_cull_stats['n_eval']
+        if device == 'gpu':
+            assert cull_stats == ref_cull_stats
+
+    if cull_tol is not None and device == 'cpu':
+        # The cpu culls the polyline as a whole and the edges one by one, each skipped part is below cull_tol
+        exact, _ = calc_data(sim_conf, polyline.edges, device, None, far_field_ratio)
+        assert np.max(np.abs(data - exact)) <= cull_tol
+        assert np.max(np.abs(ref - exact)) <= len(polyline.edges) * cull_tol
+    else:
+        # The gpu culls the rows of the polyline as the edges
+        assert np.max(np.abs(data - ref)) <= 1e-12 * np.max(np.abs(ref))
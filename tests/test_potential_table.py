@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+import Charge
+from Charge import ChargeDist
+from PotentialTable import PotentialTable, PotentialTableCache
+
+
+def get_samples(table: PotentialTable) -> tuple:
+    # Cell centers of the rows next to the segment line (largest error), random samples over the table,
+    # in all four quadrants
+    rng = np.random.default_rng(0)
+    cntr = (np.arange(table.n_sample - 1) + 0.5) * table.step
+    near_y = np.linspace(0, 4 * table.step, 41)[1:]
+    x, y = np.meshgrid(cntr, np.concatenate([near_y, rng.uniform(0, table.half_size, 200)]))
+    sign_x, sign_y = rng.choice((-1, 1), size=(2,) + x.shape)
+
+    return sign_x * x, sign_y * y
+
+
+@pytest.mark.parametrize('depth_ratio', [0.1, 1.0, 10.0])
+def test_table_accuracy(depth_ratio):
+    # Documented tolerance : 1% of the peak (a times the peak for calc_linear) for depth / norm in 0.1 ~ 10
+    norm = 0.02
+    table = PotentialTable(norm, norm * depth_ratio)
+    x, y = get_samples(table)
+    h, a = table.half_depth, table.a
+
+    r_1, log_1 = Charge.calc_end_terms(a + x, y, h)
+    r_2, log_2 = Charge.calc_end_terms(a - x, y, h)
+    constant = Charge.calc_constant(x, y, h, a, r_1, r_2, log_1, log_2)
+    linear = Charge.calc_linear(x, y, h, a, r_1, r_2, log_1, log_2)
+    interp_constant, interp_linear = table.interp(x, y, linear=True)
+
+    peak = table.constant[0, 0]
+    assert np.all(table.contains(x, y))
+    assert np.max(np.abs(interp_constant - constant)) <= 1e-2 * peak
+    assert np.max(np.abs(interp_linear - linear)) <= 1e-2 * peak * a
+
+
+@pytest.mark.parametrize('form, density', [('constant', 1e-8), ('linear', (2e-8, -1e-8))])
+def test_charge_with_tables(form, density):
+    # Rotated, off center segment : samples inside the table interpolate, the others take the closed form
+    charge = ChargeDist(-0.05, 0.03, -0.03, 0.02, density=density, depth=0.02, form=form)
+    tables = PotentialTableCache()
+    rng = np.random.default_rng(1)
+    x, y = rng.uniform(-0.4, 0.4, size=(2, 100000))
+
+    exact = charge.get_potential(x, y, dtype=np.float64)
+    res = charge.get_potential(x, y, dtype=np.float64, tables=tables)
+
+    table = tables.get(charge.norm, charge.depth)
+    inside = table.contains(*Charge.get_local_pos(x, y, charge.cntr, charge.u_vec, np.float64))
+    assert 0 < np.count_nonzero(inside) < inside.size
+    assert np.array_equal(res[~inside], exact[~inside])
+
+    peak = np.max(np.abs(density)) / (4 * Charge.pi * Charge.eps) * table.constant[0, 0]
+    assert np.max(np.abs(res - exact)) <= 1e-2 * peak
+
+
+def test_cache_lru_eviction():
+    cache = PotentialTableCache(n_sample=32)
+    table_bytes = PotentialTable(0.01, 0.01, n_sample=32).nbytes
+    cache.max_bytes = 2.5 * table_bytes
+
+    first = cache.get(0.01, 0.01)
+    cache.get(0.02, 0.01)
+    # Rounded key : a copy of the shape at another orientation hits the cached table
+    assert cache.get(0.01 * (1 + 1e-12), 0.01) is first
+    cache.get(0.03, 0.01)
+
+    # The least recently used table is evicted, n_bytes follows the held tables
+    assert list(cache.tables) == [(0.01, 0.01), (0.03, 0.01)]
+    assert cache.n_bytes == 2 * table_bytes <= cache.max_bytes
+
+    # A table over max_bytes is held while in use
+    cache.max_bytes = table_bytes / 2
+    cache.get(0.04, 0.01)
+    assert list(cache.tables) == [(0.04, 0.01)]
+    assert cache.n_bytes == table_bytes
+
+    cache.clear()
+    assert len(cache.tables) == 0 and cache.n_bytes == 0
@@ -0,0 +1,61 @@
+import json
+import os
+from queue import Queue
+
+import numpy as np
+from PIL import Image
+
+from Simulation import Simulation
+
+
+def stitch(level_dir: str, n_tile_col: int, n_tile_row: int) -> np.ndarray:
+    rows = []
+    for tile_row in range(n_tile_row):
+        tiles = [np.asarray(Image.open(os.path.join(level_dir, '{}_{}.png'.format(tile_col, tile_row))))
+                 for tile_col in range(n_tile_col)]
+        rows.append(np.concatenate(tiles, axis=1))
+    return np.concatenate(rows, axis=0)
+
+
+def test_pyramid_levels(sim_conf, tmp_path):
+    # 20 x 20 image in tiles of 8 : 3 levels of 6, 10 and 20 pixels (get_adjusted_size, not exact halves)
+    out_dir = str(tmp_path / 'pyramid')
+    pyramid = Simulation(sim_conf).run_pyramid(Queue(), out_dir, tile_size=8, verbose=False)
+
+    with open(os.path.join(out_dir, 'pyramid.json'), 'r') as f:
+        assert json.load(f) == pyramid
+    assert pyramid['tile_size'] == 8
+    assert pyramid['tile_path'] == '{level}/{col}_{row}.png'
+    assert sorted(os.listdir(out_dir)) == ['0', '1', '2', 'pyramid.json']
+
+    levels = pyramid['levels']
+    assert [level['level'] for level in levels] == [0, 1, 2]
+    assert [level['mpp'] for level in levels] == [sim_conf['mpp'] * 4, sim_conf['mpp'] * 2, sim_conf['mpp']]
+    assert [(level['width'], level['height']) for level in levels] == [(6, 6), (10, 10), (20, 20)]
+
+    for level in levels:
+        sizes = Simulation.get_adjusted_size(sim_conf['phy_rect'], sim_conf['down_sampling'], level['mpp'])
+        assert (level['height'], level['width']) == sizes['image_size']
+        assert level['phy_rect'] == list(sizes['adj_phy_rect'])
+        assert (level['n_tile_col'], level['n_tile_row']) == (-(-level['width'] // 8), -(-level['height'] // 8))
+
+        level_dir = os.path.join(out_dir, str(level['level']))
+        assert sorted(os.listdir(level_dir)) == sorted('{}_{}.png'.format(col, row)
+                                                       for col in range(level['n_tile_col'])
+                                                       for row in range(level['n_tile_row']))
+
+
+def test_pyramid_matches_stream(sim_conf, tmp_path):
+    # Every stitched level is the streamed render at its mpp with the color scale of the pyramid
+    out_dir = str(tmp_path / 'pyramid')
+    pyramid = Simulation(sim_conf).run_pyramid(Queue(), out_dir, tile_size=8, verbose=False)
+
+    for level in pyramid['levels']:
+        color_conf = dict(sim_conf['plots']['potential_color'], max_abs=pyramid['max_abs'])
+        conf = dict(sim_conf, mpp=level['mpp'], stream=True, plots=dict(sim_conf['plots'], potential_color=color_conf))
+        out_path = str(tmp_path / 'level_{}.png'.format(level['level']))
+        Simulation(conf).run(Queue(), out_path, verbose=False)
+
+        img = stitch(os.path.join(out_dir, str(level['level'])), level['n_tile_col'], level['n_tile_row'])
+        assert img.shape == (level['height'], level['width'], 3)
+        assert np.array_equal(img, np.asarray(Image.open(out_path).convert('RGB')))
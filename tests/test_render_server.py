@@ -0,0 +1,107 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+import RenderServer
+from RenderServer import RenderServer as Server, parse_scene
+
+
+@pytest.fixture
+def scene():
+    return {
+        'phy_rect': [-0.4, 0.4, 0.4, -0.4],
+        'mpp': 2e-2,
+        'down_sampling': 1,
+        'plots': {'potential_contour': {'scale': 0.5}},
+        'device': 'cpu',
+        'charges': [
+            {'type': 'segment', 'x1': -0.1, 'y1': 0.05, 'x2': 0.1, 'y2': 0.05, 'density': 1e-8, 'depth': 0.4},
+            {'type': 'point', 'x': 0.0, 'y': -0.1}
+        ]
+    }
+
+
+@pytest.fixture
+def server(tmp_path):
+    server = Server(('127.0.0.1', 0), n_runner=1, out_dir=str(tmp_path))
+    th = threading.Thread(target=server.serve_forever, daemon=True)
+    th.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def request(server, method: str, path: str, body: dict | None = None):
+    url = 'http://127.0.0.1:{}{}'.format(server.server_address[1], path)
+    data = json.dumps(body).encode() if body is not None else None
+    req = urllib.request.Request(url, data=data, method=method)
+    try:
+        with urllib.request.urlopen(req, timeout=30) as res:
+            return res.status, res.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+
+
+def test_parse_scene(scene):
+    sim_conf = parse_scene(scene)
+
+    assert sim_conf['phy_rect'] == (-0.4, 0.4, 0.4, -0.4)
+    assert sim_conf['ref_point'] is None
+    assert len(sim_conf['charges']) == 2
+
+
+@pytest.mark.parametrize('key, value', [
+    ('data_path', '/tmp/data.npy'),
+    ('cpu_plan', {'n_worker': 64, 'schedule': 'static', 'chunk_rows': 0}),
+    ('stream', True)
+])
+def test_server_keys_rejected(scene, key, value):
+    with pytest.raises(ValueError, match='Unknown scene keys'):
+        parse_scene(dict(scene, **{key: value}))
+
+
+@pytest.mark.parametrize('charge', [
+    {'type': 'segment', 'x1': 0.0, 'y1': 0.0, 'x2': 0.0, 'y2': 0.0},
+    {'type': 'polyline', 'points': [[0.0, 0.0], [0.1, 0.0], [0.1, 0.0]]},
+    {'type': 'point', 'x': 0.0, 'y': 0.0, 'radius': 0.0},
+    {'type': 'arc', 'cx': 0.0, 'cy': 0.0, 'radius': 0.0, 'st_angle': 0.0, 'en_angle': 1.0},
+    {'type': 'segment', 'x1': 0.0, 'y1': 0.0, 'x2': 0.1, 'y2': 0.0, 'depth': 0.0},
+    {'type': 'segment', 'x1': 0.0, 'y1': 0.0, 'x2': float('nan'), 'y2': 0.0}
+])
+def test_degenerate_charge_rejected(scene, charge):
+    with pytest.raises(ValueError):
+        parse_scene(dict(scene, charges=scene['charges'] + [charge]))
+
+
+def test_bad_scene_400(server, scene):
+    status, body = request(server, 'POST', '/jobs', dict(scene, data_path='/tmp/data.npy'))
+    assert status == 400
+
+    charge = {'type': 'segment', 'x1': 0.0, 'y1': 0.0, 'x2': 0.0, 'y2': 0.0}
+    status, body = request(server, 'POST', '/jobs', dict(scene, charges=[charge]))
+    assert status == 400
+    assert len(server.scheduler.jobs) == 0
+
+
+def test_events_evicted(server, scene, monkeypatch):
+    monkeypatch.setattr(RenderServer, 'MAX_EVENT_JOBS', 1)
+
+    job_ids = []
+    for mpp in (2e-2, 4e-2):
+        status, body = request(server, 'POST', '/jobs', dict(scene, mpp=mpp))
+        assert status == 202
+        job_ids.append(json.loads(body)['job_id'])
+        server.scheduler.wait(job_ids[-1], timeout=30)
+
+    # Events of the last job are streamed until its end, the evicted job only reports its end
+    status, body = request(server, 'GET', '/jobs/{}/events'.format(job_ids[1]))
+    assert status == 200
+    assert json.loads(body.decode().strip().split('\n\n')[-1][len('data: '):])['state'] == 'done'
+
+    with server.cond:
+        assert list(server.events) == [job_ids[1]]
+    status, body = request(server, 'GET', '/jobs/{}/events'.format(job_ids[0]))
+    assert json.loads(body.decode().strip()[len('data: '):]) == {'task': 'job', 'job_id': job_ids[0], 'state': 'done'}
@@ -0,0 +1,99 @@
+from queue import Queue
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import Resample
+from SampleGrid import SampleGrid
+from Simulation import Simulation, PLOT_MODULES
+
+
+def calc_field(row: np.ndarray, col: np.ndarray, degree: int) -> np.ndarray:
+    # Polynomial of the given degree in sample index units, on the (row, col) mesh
+    row, col = row[:, None], col[None, :]
+    res = 0.3 + 1.7 * row - 0.9 * col
+    if degree >= 2:
+        res = res + 0.05 * row * row - 0.02 * row * col + 0.07 * col * col
+    if degree >= 3:
+        res = res + 0.004 * row ** 3 - 0.003 * row * row * col + 0.002 * col ** 3
+    return res
+
+
+def get_interior(pos: np.ndarray, n: int, method: str) -> np.ndarray:
+    # Pixels whose taps are all inside the grid (no edge clamping)
+    halo = Resample.RESAMPLE_HALO[method]
+    base = np.floor(pos)
+    return (base - (halo - 1) >= 0) & (base + halo <= n - 1)
+
+
+@pytest.mark.parametrize('method, degree', [('bilinear', 1), ('bicubic', 1), ('bicubic', 2)])
+@pytest.mark.parametrize('down_sampling', [2, 3])
+def test_reproduces_polynomials(method, degree, down_sampling):
+    # Bilinear reproduces linear fields, Catmull-Rom up to quadratic ones, away from the clamped edges
+    grid = SampleGrid((-0.1, 0.1, 0.1, -0.1), (16, 21), down_sampling=down_sampling)
+    n_img_row, n_img_col = 16 * down_sampling, 21 * down_sampling
+    pos_row = grid.get_img_pos(0, n_img_row - 1)
+    pos_col = grid.get_img_pos(0, n_img_col - 1)
+    data = calc_field(np.arange(16.0), np.arange(21.0), degree)
+    ref = calc_field(pos_row, pos_col, degree)
+
+    res = Resample.upsample_rows(data, grid, 0, n_img_row - 1, method)
+    inside = get_interior(pos_row, 16, method)[:, None] & get_interior(pos_col, 21, method)[None, :]
+    assert np.count_nonzero(inside) > inside.size // 2
+    assert np.allclose(res[inside], ref[inside], rtol=0, atol=1e-12 * np.max(np.abs(ref)))
+
+    # Row bands give the rows of the whole image
+    band = Resample.upsample_rows(data, grid, 5, 11, method)
+    assert np.array_equal(band, res[5:12])
+
+
+def test_bicubic_cubic_order():
+    # Cubic terms are not reproduced by Catmull-Rom : the error falls by about 8 per halving of the spacing
+    errors = []
+    for n in (16, 32, 64):
+        grid = SampleGrid((-0.1, 0.1, 0.1, -0.1), (n, n), down_sampling=3)
+        pos = grid.get_img_pos(0, 3 * n - 1)
+        # Same field over the same extent for every n
+        scale = 16 / n
+        data = calc_field(np.arange(n) * scale, np.arange(n) * scale, 3)
+        ref = calc_field(pos * scale, pos * scale, 3)
+
+        res = Resample.upsample_rows(data, grid, 0, 3 * n - 1, 'bicubic')
+        inside = get_interior(pos, n, 'bicubic')
+        errors.append(np.max(np.abs(res - ref)[inside[:, None] & inside[None, :]]))
+
+    assert errors[0] / errors[1] > 6 and errors[1] / errors[2] > 6
+
+
+@pytest.mark.parametrize('supersample', [2, 3])
+def test_supersample_is_block_mean(sim_conf, tmp_path, supersample):
+    # Supersampled run : mean of supersample x supersample blocks of a run at mpp / supersample
+    color_conf = dict(sim_conf['plots']['potential_color'], max_abs=300.0)
+    conf = dict(sim_conf, plots=dict(sim_conf['plots'], potential_color=color_conf))
+    sim = Simulation(dict(conf, supersample=supersample))
+    out_path = str(tmp_path / 'result.png')
+    sim.run(Queue(), out_path, verbose=False)
+
+    full = Simulation(dict(conf, mpp=conf['mpp'] / supersample))
+    full.calc.do(Queue(), verbose=False)
+    # Same samples (up to the rounding of the rect)
+    assert np.allclose(full.grid.x, sim.grid.x, rtol=0, atol=1e-15)
+    assert np.allclose(full.grid.y, sim.grid.y, rtol=0, atol=1e-15)
+    assert np.allclose(full.data, sim.data, rtol=1e-6, atol=0)
+
+    n_row, n_col = full.data.shape
+    pixels = full.data.astype(np.float64).reshape(n_row // supersample, supersample,
+                                                  n_col // supersample, supersample).mean(axis=(1, 3))
+    assert np.allclose(Resample.block_average_rows(full.data, 0, n_row // supersample - 1, supersample),
+                       pixels, rtol=1e-15, atol=0)
+
+    img = np.zeros(pixels.shape + (3,), dtype=np.uint8)
+    img.fill(255)
+    ref_potential = full.calc.get_ref_potential()
+    for plot, plot_conf in conf['plots'].items():
+        if plot == 'potential_color':
+            PLOT_MODULES[plot].cpu_rows(img, pixels, 0, pixels.shape[0] - 1, plot_conf, ref_potential, 300.0)
+        else:
+            PLOT_MODULES[plot].cpu_rows(img, pixels, 0, pixels.shape[0] - 1, plot_conf, ref_potential)
+    assert np.array_equal(np.asarray(Image.open(out_path)), img)
@@ -0,0 +1,82 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from Simulation import Simulation
+
+
+def run_sync(sim_conf: dict, out_path: str) -> list:
+    progress_q = Queue()
+    Simulation(sim_conf).run(progress_q, out_path, verbose=False)
+    return [progress_q.get() for _ in range(progress_q.qsize())]
+
+
+async def collect(sim: Simulation, out_path: str, executor=None) -> list:
+    return [msg async for msg in sim.run_async(out_path, executor=executor)]
+
+
+def get_tasks(msgs: list) -> list:
+    # Task sequence without repeats
+    tasks = [msg['task'] for msg in msgs]
+    return [task for idx, task in enumerate(tasks) if idx == 0 or tasks[idx - 1] != task]
+
+
+def test_messages_in_order(sim_conf, tmp_path):
+    ref = run_sync(sim_conf, str(tmp_path / 'ref.png'))
+    msgs = asyncio.run(collect(Simulation(sim_conf), str(tmp_path / 'result.png')))
+
+    assert get_tasks(msgs) == get_tasks(ref)
+    assert len(msgs) == len(ref)
+    for task in set(get_tasks(msgs)):
+        progress = [msg['progress'] for msg in msgs if msg['task'] == task]
+        assert progress == sorted(progress)
+    assert np.array_equal(np.asarray(Image.open(str(tmp_path / 'result.png'))),
+                          np.asarray(Image.open(str(tmp_path / 'ref.png'))))
+
+
+def test_error_after_last_message(sim_conf, tmp_path):
+    # Saving fails after calc and plots have reported
+    out_path = str(tmp_path / 'missing' / 'result.png')
+    ref = run_sync(sim_conf, str(tmp_path / 'ref.png'))
+
+    async def run():
+        msgs = []
+        with pytest.raises(FileNotFoundError):
+            async for msg in Simulation(sim_conf).run_async(out_path):
+                msgs.append(msg)
+        return msgs
+
+    msgs = asyncio.run(run())
+    assert get_tasks(msgs) == get_tasks(ref)
+    assert len(msgs) == len(ref)
+    assert not os.path.exists(out_path)
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_concurrent_runs(sim_conf, tmp_path, stream):
+    confs = [dict(sim_conf, mpp=mpp, stream=stream) for mpp in (2e-2, 1e-2, 4e-2)]
+    refs = [run_sync(conf, str(tmp_path / 'ref_{}.png'.format(idx))) for idx, conf in enumerate(confs)]
+
+    async def run():
+        with ThreadPoolExecutor(len(confs)) as executor:
+            return await asyncio.gather(*(collect(Simulation(conf), str(tmp_path / 'result_{}.png'.format(idx)),
+                                                  executor)
+                                          for idx, conf in enumerate(confs)))
+
+    # Each iterator receives the messages of its own run, every run writes its own image
+    # (the bands of a streamed run depend on the timing, each task still ends at 100%)
+    for idx, (msgs, ref) in enumerate(zip(asyncio.run(run()), refs)):
+        if stream:
+            assert set(get_tasks(msgs)) == set(get_tasks(ref))
+            for task in set(get_tasks(msgs)):
+                assert [msg['progress'] for msg in msgs if msg['task'] == task][-1] == pytest.approx(100)
+        else:
+            assert get_tasks(msgs) == get_tasks(ref)
+            assert len(msgs) == len(ref)
+        assert np.array_equal(np.asarray(Image.open(str(tmp_path / 'result_{}.png'.format(idx)))),
+                              np.asarray(Image.open(str(tmp_path / 'ref_{}.png'.format(idx)))))
@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+
+from Simulation import Simulation
+
+
+@pytest.mark.parametrize('down_sampling, supersample', [(1, 1), (3, 1), (1, 2)])
+def test_img_pos_spans_full_rect(sim_conf, down_sampling, supersample):
+    sim = Simulation(dict(sim_conf, down_sampling=down_sampling, supersample=supersample))
+    grid = sim.grid
+    n_img_row, n_img_col = sim.get_img_shape()
+
+    step_x = grid.x[1] - grid.x[0]
+    step_y = grid.y[1] - grid.y[0]
+    img_x = grid.x[0] + grid.get_img_pos(0, n_img_col - 1) * step_x
+    img_y = grid.y[0] + grid.get_img_pos(0, n_img_row - 1) * step_y
+
+    # Outermost pixel centers on full_phy_rect, pixels mpp apart (float32 axes)
+    tol = 1e-6
+    assert img_x[0] == pytest.approx(grid.full_phy_rect[0], abs=tol)
+    assert img_x[-1] == pytest.approx(grid.full_phy_rect[2], abs=tol)
+    assert img_y[0] == pytest.approx(grid.full_phy_rect[1], abs=tol)
+    assert img_y[-1] == pytest.approx(grid.full_phy_rect[3], abs=tol)
+    assert np.allclose(np.diff(img_x), sim.mpp, atol=tol)
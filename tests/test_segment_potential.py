@@ -0,0 +1,208 @@
+from queue import Queue
+
+import numpy as np
+import pytest
+from numba import cuda
+
+import Charge
+from Charge import ChargeDist
+from Simulation import Simulation
+
+EPS = np.finfo(np.float64).eps
+
+
+def calc_constant_1(x, y, z, a):
+    # Antiderivative of one depth limit z, the evaluator before the +-h limits were fused
+    buf00 = x ** 2 + y ** 2 + z ** 2
+    buf01 = a - x
+    buf02 = a + x
+
+    buf10 = a ** 2 - 2 * a * x + buf00
+    buf11 = a ** 2 + 2 * a * x + buf00
+
+    buf20 = buf01 * np.log(np.sqrt(buf10) + z)
+    buf21 = buf02 * np.log(np.sqrt(buf11) + z)
+    buf22 = y * np.arctan((z * buf01) / (y * np.sqrt(buf10)))
+    buf23 = y * np.arctan((z * buf02) / (y * np.sqrt(buf11)))
+    buf24 = z * np.arctanh(buf01 / np.sqrt(buf01 ** 2 + y ** 2 + z ** 2))
+    buf25 = z * np.arctanh(buf02 / np.sqrt(buf02 ** 2 + y ** 2 + z ** 2))
+
+    return buf20 + buf21 - buf22 - buf23 + buf24 + buf25
+
+
+def calc_constant_two_limits(x, y, h, a):
+    return calc_constant_1(x, y, h, a) - calc_constant_1(x, y, -h, a)
+
+
+def calc_constant_fused(x, y, h, a):
+    r_1, log_1 = Charge.calc_end_terms(a + x, y, h)
+    r_2, log_2 = Charge.calc_end_terms(a - x, y, h)
+
+    return Charge.calc_constant(x, y, h, a, r_1, r_2, log_1, log_2)
+
+
+def get_term_magnitude(x, y, h, a):
+    """
+    Sum of the magnitudes of the terms of Charge.calc_constant
+
+    Every term is evaluated to a few ulp, so the rounding error of the sum is a few EPS times this magnitude.
+    Far from the segment the terms cancel down to about 4 a h / r, the relative error of the result
+    grows with that cancellation (about r / a), which is a property of the closed form, not of the evaluation.
+    """
+
+    r_1, log_1 = Charge.calc_end_terms(a + x, y, h)
+    r_2, log_2 = Charge.calc_end_terms(a - x, y, h)
+    rho = np.sqrt(y ** 2 + h ** 2)
+
+    return (np.abs(a - x) * log_2 + np.abs(a + x) * log_1
+            + 2 * np.abs(y) * (np.abs(np.arctan2(h * (a - x), np.abs(y) * r_2))
+                               + np.abs(np.arctan2(h * (a + x), np.abs(y) * r_1)))
+            + 2 * h * (np.abs(np.arcsinh((a - x) / rho)) + np.abs(np.arcsinh((a + x) / rho))))
+
+
+def calc_constant_quadrature(x, y, h, a, n_node=128):
+    # Reference : tensor Gauss-Legendre quadrature of the 1 / distance integral over the 2a x 2h rectangle,
+    # converged to a few ulp of the result at least max(a, h) away from the segment
+    nodes, weights = np.polynomial.legendre.leggauss(n_node)
+    w = (weights[:, None] * weights[None, :]).reshape(-1)
+
+    res = np.zeros(x.shape)
+    for idx in range(len(x)):
+        s = a[idx] * nodes[:, None]
+        z = h[idx] * nodes[None, :]
+        values = w / np.sqrt((x[idx] - s) ** 2 + y[idx] ** 2 + z ** 2).reshape(-1)
+        res[idx] = np.sum(np.sort(values)) * a[idx] * h[idx]
+
+    return res
+
+
+@pytest.fixture(scope='module')
+def samples():
+    # Segments of various shapes, points from max(a, h) to 50 max(a, h) beyond the segment in any direction
+    rng = np.random.default_rng(0)
+    n = 400
+    a = rng.uniform(0.001, 0.2, n)
+    h = rng.uniform(0.001, 0.4, n)
+    angle = rng.uniform(0, 2 * np.pi, n)
+    dist = a + np.exp(rng.uniform(0, np.log(50), n)) * np.maximum(a, h)
+
+    x = dist * np.cos(angle)
+    y = dist * np.sin(angle)
+
+    return x, y, h, a, calc_constant_quadrature(x, y, h, a)
+
+
+def test_fused_matches_quadrature(samples):
+    x, y, h, a, ref = samples
+    res = calc_constant_fused(x, y, h, a)
+
+    assert np.all(np.abs(res - ref) <= 4 * EPS * get_term_magnitude(x, y, h, a))
+
+
+def test_fused_matches_two_limits(samples):
+    # The two limit formula loses digits in log(r - h) (relative error up to about 1e-11 here),
+    # the fused evaluator agrees with it up to that error plus its own rounding bound
+    x, y, h, a, ref = samples
+    res = calc_constant_fused(x, y, h, a)
+    old = calc_constant_two_limits(x, y, h, a)
+
+    assert np.all(np.abs(res - old) <= np.abs(old - ref) + 4 * EPS * get_term_magnitude(x, y, h, a))
+    assert np.max(np.abs(res - ref) / np.abs(ref)) < np.max(np.abs(old - ref) / np.abs(ref))
+
+
+def test_gpu_matches_cpu_float64(sim_conf):
+    charge = ChargeDist(-0.1, 0.05, 0.15, -0.02, density=1e-8, depth=0.4)
+    data = {}
+    for device in ('cpu', 'gpu'):
+        sim = Simulation(dict(sim_conf, device=device, precision='float64', charges=[charge]))
+        sim.calc.do(Queue(), verbose=False)
+        data[device] = sim.data
+
+    sample_x, sample_y = sim.grid.mesh()
+    x, y = Charge.get_local_pos(sample_x, sample_y, charge.cntr, charge.u_vec, np.float64)
+    bound = 8 * EPS * charge.density / (4 * Charge.pi * Charge.eps) * \
+        get_term_magnitude(x, y, charge.depth / 2, charge.norm / 2)
+
+    assert np.all(np.abs(data['gpu'] - data['cpu']) <= bound)
+
+
+def get_log_sum(p, rho2):
+    # log(p + sqrt(p^2 + rho^2)), without cancellation for p < 0 (p + r = rho^2 / (r - p))
+    r = np.sqrt(p ** 2 + rho2)
+    with np.errstate(divide='ignore'):
+        return np.where(p >= 0, np.log(p + r), np.log(rho2) - np.log(r - p))
+
+
+def calc_segment_reference(x, y, h, a, n_level=120, n_node=16):
+    """
+    Independent reference of the unit density (F0) and unit slope (F1, density s) segment integrals on and
+    near the segment line : closed form along the segment, then Gauss-Legendre over the depth on intervals
+    halving towards z = 0, where the integrand has a log singularity for y = 0 (converged to a few ulp)
+
+    :return: F0, F1 (as calc_constant and (x * calc_constant + calc_linear))
+    """
+
+    nodes, weights = np.polynomial.legendre.leggauss(n_node)
+    edges = h * 0.5 ** np.arange(n_level + 1)
+    z = np.concatenate([lo + (hi - lo) * (nodes + 1) / 2 for hi, lo in zip(edges[:-1], edges[1:])])
+    w = np.concatenate([weights * (hi - lo) / 2 for hi, lo in zip(edges[:-1], edges[1:])])
+
+    x = np.asarray(x, dtype=np.float64)[:, None]
+    rho2 = np.asarray(y, dtype=np.float64)[:, None] ** 2 + z[None, :] ** 2
+    # int ds / dist = asinh((a - x) / rho) + asinh((a + x) / rho), int (s - x) ds / dist = r_2 - r_1
+    f0 = get_log_sum(a - x, rho2) + get_log_sum(a + x, rho2) - np.log(rho2)
+    f1 = -4 * a * x / (np.sqrt((a - x) ** 2 + rho2) + np.sqrt((a + x) ** 2 + rho2)) + x * f0
+
+    # Even in z
+    return 2 * np.sum(f0 * w, axis=1), 2 * np.sum(f1 * w, axis=1)
+
+
+@cuda.jit
+def potential_kernel(x, y, charge, res):
+    idx = cuda.grid(1)
+    if idx < x.shape[0]:
+        res[idx] = Charge.gpu_get_potential(x[idx], y[idx], charge, charge[10] * 0)
+
+
+def get_near_line_potential(charge: ChargeDist, x, y, dtype, device: str) -> np.ndarray:
+    if device == 'cpu':
+        return charge.get_potential(x, y, dtype=dtype).astype(np.float64)
+
+    res = np.zeros(len(x), dtype=dtype)
+    row = charge.get_table_rows()[0].astype(dtype)
+    potential_kernel[(len(x) + 63) // 64, 64](x.astype(dtype), y.astype(dtype), row, res)
+    return res.astype(np.float64)
+
+
+# Relative tolerances (in eps of the evaluation dtype), the float32 inputs themselves are rounded
+# (e.g. the end at 0.1 +- 1e-6) and the 'linear' form adds two closed forms weighted by
+# density_c + slope x and slope, which partially cancel. Measured worst cases :
+# 'constant' 26 (float32) and 21 (float64), 'linear' 144 (float32) and 128 (float64)
+NEAR_LINE_RTOL = {'constant': 64, 'linear': 512}
+
+
+@pytest.mark.parametrize('device', ['cpu', 'gpu'])
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+@pytest.mark.parametrize('form', ['constant', 'linear'])
+@pytest.mark.parametrize('depth', [0.4, 1e-3])
+def test_near_line(device, dtype, form, depth):
+    # y -> 0 inside the segment, at its ends (and just beside them) and on its extension
+    a = 0.1
+    xs = np.array([0.0, 0.05, -0.05, a - 1e-6, a, a + 1e-6, -a, 0.2, 1.0])
+    ys = [sign * 10.0 ** -exp for exp in range(1, 16, 2) for sign in (1, -1)] + [0.0]
+    x = np.tile(xs, len(ys))
+    y = np.repeat(ys, len(xs))
+
+    # Densities of 4 pi eps : the potential is the integral itself
+    unit = 4 * Charge.pi * Charge.eps
+    if form == 'constant':
+        charge = ChargeDist(-a, 0.0, a, 0.0, density=unit, depth=depth)
+    else:
+        charge = ChargeDist(-a, 0.0, a, 0.0, density=(unit, 3 * unit), depth=depth, form='linear')
+
+    f0, f1 = calc_segment_reference(x, y, depth / 2, a)
+    ref = f0 if form == 'constant' else 2 * f0 + 2 / (2 * a) * f1
+
+    res = get_near_line_potential(charge, x, y, dtype, device)
+    assert np.all(np.isfinite(res))
+    assert np.max(np.abs(res - ref) / np.abs(ref)) <= NEAR_LINE_RTOL[form] * np.finfo(dtype).eps
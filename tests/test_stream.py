@@ -0,0 +1,43 @@
+import os
+from queue import Queue
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from PngStreamWriter import PngStreamWriter
+from Simulation import Simulation
+
+
+def get_stream_conf(sim_conf: dict, stream: bool) -> dict:
+    plots = dict(sim_conf['plots'], potential_color=dict(sim_conf['plots']['potential_color'], max_abs=300.0))
+    return dict(sim_conf, plots=plots, stream=stream)
+
+
+@pytest.mark.parametrize('device', ['cpu', 'gpu'])
+def test_stream_matches_run(sim_conf, tmp_path, device):
+    # With a fixed color scale the streamed image is the one of a run without stream
+    images = {}
+    for stream in (False, True):
+        out_path = str(tmp_path / '{}.png'.format(stream))
+        Simulation(dict(get_stream_conf(sim_conf, stream), device=device)).run(Queue(), out_path, verbose=False)
+        images[stream] = np.asarray(Image.open(out_path).convert('RGB'))
+
+    assert np.array_equal(images[True], images[False])
+
+
+def test_stream_error_removes_image(sim_conf, tmp_path, monkeypatch):
+    write_rows = PngStreamWriter.write_rows
+
+    def failing(writer, rows):
+        if writer.n_written_row != 0:
+            raise OSError('No space left on device')
+        write_rows(writer, rows)
+
+    monkeypatch.setattr(PngStreamWriter, 'write_rows', failing)
+    out_path = str(tmp_path / 'result.png')
+    sim = Simulation(dict(get_stream_conf(sim_conf, True), cpu_plan=dict(sim_conf['cpu_plan'], chunk_rows=1)))
+
+    with pytest.raises(OSError):
+        sim.run(Queue(), out_path, verbose=False)
+    assert not os.path.exists(out_path)